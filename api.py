@@ -0,0 +1,170 @@
+"""Versioned JSON API for Warbler's client-side code.
+
+    GET  /api/v1/timeline                 the logged-in user's home feed
+    GET  /api/v1/users/<id>/messages      a user's messages
+    GET  /api/v1/suggestions              who the logged-in user might follow
+    POST /api/v1/likes:batch              like/unlike many messages at once
+
+Listings return `{"messages": [...], "next_cursor": ...}`, newest first,
+and take the same `before` cursor as the HTML pages. Responses carry an
+ETag, so a client re-polling an unchanged page gets a 304.
+
+The batch endpoint takes `{"ops": [{"op": "like" | "unlike",
+"message_id": 1}, ...]}` and applies them all in one transaction, the
+last op for a message winning. Requests authenticate with the site's
+session cookie; like POSTs must be sent as JSON, which a cross-site form
+can't do.
+"""
+
+from flask import Blueprint, g, jsonify, request
+
+from models import db, Message
+import likes
+import pagination
+import queries
+import recommendations
+import timeline
+
+MAX_BATCH_OPS = 100
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+def error(status, message):
+    """Return a JSON error response."""
+
+    resp = jsonify({'error': message})
+    resp.status_code = status
+    return resp
+
+
+def serialize_user(user):
+    """Return the compact JSON form of `user`."""
+
+    return {
+        'id': user.id,
+        'username': user.username,
+        'image_url': user.image_url,
+    }
+
+
+def serialize_message(msg, liked):
+    """Return the compact JSON form of `msg`."""
+
+    return {
+        'id': msg.id,
+        'text': msg.text,
+        'timestamp': msg.timestamp.isoformat(),
+        'liked': liked,
+        'user': serialize_user(msg.user),
+    }
+
+
+def message_listing(page):
+    """Return a conditional JSON response for a Page of messages."""
+
+    liked = likes.liked_ids(g.user, [msg.id for msg in page.items])
+
+    resp = jsonify({
+        'messages': [serialize_message(msg, msg.id in liked)
+                     for msg in page.items],
+        'next_cursor': page.next_cursor,
+    })
+    resp.add_etag()
+
+    return resp.make_conditional(request)
+
+
+@api.route('/timeline')
+def timeline_messages():
+    """The logged-in user's home feed."""
+
+    if not g.user:
+        return error(401, "Login required")
+
+    before = pagination.parse_message_cursor(request.args.get('before'))
+    messages = timeline.get_timeline(g.user.id,
+                                     limit=pagination.PAGE_SIZE + 1,
+                                     before=before)
+
+    return message_listing(pagination.make_page(messages,
+                                                pagination.message_cursor))
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """Messages posted by `user_id`."""
+
+    user = queries.active_user_or_404(user_id)
+    before = pagination.parse_message_cursor(request.args.get('before'))
+
+    return message_listing(
+        queries.message_page(queries.user_messages(user.id), before))
+
+
+@api.route('/suggestions')
+def suggestions():
+    """Users the logged-in user might want to follow, best first."""
+
+    if not g.user:
+        return error(401, "Login required")
+
+    return jsonify({'users': [serialize_user(user) for user
+                              in recommendations.for_user(g.user)]})
+
+
+@api.route('/likes:batch', methods=['POST'])
+def likes_batch():
+    """Apply a batch of like/unlike ops for the logged-in user."""
+
+    if not g.user:
+        return error(401, "Login required")
+
+    body = request.get_json(silent=True)
+    ops = body.get('ops') if isinstance(body, dict) else None
+
+    if not isinstance(ops, list):
+        return error(400, "Expected a JSON body with a list of ops")
+
+    if len(ops) > MAX_BATCH_OPS:
+        return error(400, f"At most {MAX_BATCH_OPS} ops per batch")
+
+    # the last op for each message decides whether it ends up liked
+    wanted = {}
+    for op in ops:
+        if (not isinstance(op, dict)
+                or op.get('op') not in ('like', 'unlike')
+                or type(op.get('message_id')) is not int):
+            return error(400, f"Bad op: {op!r}")
+        wanted[op['message_id']] = op['op'] == 'like'
+
+    found = {message_id for (message_id,) in
+             db.session.query(Message.id)
+             .filter(Message.id.in_(list(wanted)))}
+
+    missing = set(wanted) - found
+    if missing:
+        return error(404, f"No such messages: {sorted(missing)}")
+
+    changed = 0
+    for message_id, like in wanted.items():
+        if like:
+            changed += likes.like(g.user.id, message_id)
+        else:
+            changed += likes.unlike(g.user.id, message_id)
+
+    db.session.commit()
+
+    for message_id, like in wanted.items():
+        if like:
+            likes.record_like(g.user.id, message_id)
+        else:
+            likes.record_unlike(g.user.id, message_id)
+
+    return jsonify({
+        'liked': sorted(message_id for message_id, like in wanted.items()
+                        if like),
+        'unliked': sorted(message_id for message_id, like in wanted.items()
+                          if not like),
+        'changed': changed,
+    })
@@ -1,12 +1,29 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, url_for
+from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, url_for, abort
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import desc
 import os
 from forms import UserAddForm, UserEditForm, LoginForm, MessageForm
 from models import db, connect_db, User, Message
+import api
+import assets
+import counters
+import deletion
+import follow_graph
+import fragments
+import http_cache
+import instrumentation
+import jobs
+import likes
+import pagination
+import passwords
+import queries
+import recommendations
+import replicas
+import search
+import timeline
+import user_cache
 
 CURR_USER_KEY = "curr_user"
 
@@ -17,13 +34,136 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 
+# Each worker keeps up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections per
+# database, checks them before use and replaces them after DB_POOL_RECYCLE
+# seconds (see replicas.py).
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = (
+    os.environ.get('DB_POOL_PRE_PING', '1') == '1')
+
+# Comma-separated read replica URLs. Read-only pages are served from them,
+# except for REPLICA_STICKY_SECONDS after a browser writes something.
+app.config['REPLICA_URLS'] = [
+    url for url in os.environ.get('REPLICA_URLS', '').split(',') if url]
+app.config['REPLICA_STICKY_SECONDS'] = int(
+    os.environ.get('REPLICA_STICKY_SECONDS', 10))
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Authors with at least this many followers aren't fanned out to on write;
+# their messages are pulled into followers' timelines at read time.
+app.config['TIMELINE_PULL_THRESHOLD'] = int(
+    os.environ.get('TIMELINE_PULL_THRESHOLD', 10000))
+
+# Logged-in users are cached between requests; 'memory' keeps them in each
+# worker, 'redis' shares them through REDIS_URL.
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'memory')
+app.config['REDIS_URL'] = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 300))
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10000))
+
+# Each worker caches the ids of messages a user liked, for users with up to
+# LIKED_IDS_CACHE_MAX_LIKES likes (see likes.py).
+app.config['LIKED_IDS_CACHE_TTL'] = int(
+    os.environ.get('LIKED_IDS_CACHE_TTL', 300))
+app.config['LIKED_IDS_CACHE_SIZE'] = int(
+    os.environ.get('LIKED_IDS_CACHE_SIZE', 10000))
+app.config['LIKED_IDS_CACHE_MAX_LIKES'] = int(
+    os.environ.get('LIKED_IDS_CACHE_MAX_LIKES', 10000))
+
+# With LIKE_WRITE_BEHIND=1, star clicks are buffered in each worker and
+# written in batches every LIKE_BUFFER_INTERVAL seconds or LIKE_BUFFER_SIZE
+# likes; a worker that dies loses its unwritten likes (see likes.py).
+app.config['LIKE_WRITE_BEHIND'] = os.environ.get('LIKE_WRITE_BEHIND') == '1'
+app.config['LIKE_BUFFER_SIZE'] = int(os.environ.get('LIKE_BUFFER_SIZE', 500))
+app.config['LIKE_BUFFER_INTERVAL'] = float(
+    os.environ.get('LIKE_BUFFER_INTERVAL', 1.0))
+
+# Rendered message list items, shared by every viewer (see fragments.py).
+app.config['FRAGMENT_CACHE_TTL'] = int(
+    os.environ.get('FRAGMENT_CACHE_TTL', 3600))
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 50000))
+
+# Passwords are hashed in a pool of PASSWORD_HASH_WORKERS processes (0 to
+# hash inline); once PASSWORD_HASH_QUEUE hashes are running or waiting,
+# signups and logins get a 503 (see passwords.py).
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_QUEUE'] = int(
+    os.environ.get('PASSWORD_HASH_QUEUE', 8))
+app.config['PASSWORD_HASH_TIMEOUT'] = float(
+    os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+app.config['PASSWORD_HASH_RETRY_AFTER'] = int(
+    os.environ.get('PASSWORD_HASH_RETRY_AFTER', 1))
+
+# Timeline fan-out/backfill/prune and account deletion run as jobs. With
+# JOBS_EAGER they run inline in the request, which is the default for
+# development and the tests; the Procfile sets JOBS_EAGER=0 so production
+# queues them for `flask worker` (see jobs.py and deletion.py).
+app.config['JOBS_EAGER'] = os.environ.get('JOBS_EAGER', '1') == '1'
+app.config['JOB_BATCH_SIZE'] = int(os.environ.get('JOB_BATCH_SIZE', 10))
+app.config['JOB_POLL_INTERVAL'] = float(
+    os.environ.get('JOB_POLL_INTERVAL', 1.0))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+app.config['JOB_RETRY_DELAY'] = int(os.environ.get('JOB_RETRY_DELAY', 5))
+app.config['JOB_LOCK_TIMEOUT'] = int(os.environ.get('JOB_LOCK_TIMEOUT', 300))
+app.config['JOB_RETENTION'] = int(os.environ.get('JOB_RETENTION', 86400))
+app.config['JOB_STATS_INTERVAL'] = int(
+    os.environ.get('JOB_STATS_INTERVAL', 60))
+
+# Deleted accounts are hidden at once, then their rows are removed at most
+# DELETE_CHUNK_SIZE per job run, each run's statements limited to
+# DELETE_STATEMENT_TIMEOUT milliseconds on PostgreSQL (0 for no limit).
+app.config['DELETE_CHUNK_SIZE'] = int(
+    os.environ.get('DELETE_CHUNK_SIZE', 1000))
+app.config['DELETE_STATEMENT_TIMEOUT'] = int(
+    os.environ.get('DELETE_STATEMENT_TIMEOUT', 5000))
+
+# Each worker holds the follow graph in memory, reloading it every
+# FOLLOW_GRAPH_TTL seconds to pick up other workers' follows; FOLLOW_GRAPH=0
+# reads follows from the database instead (see follow_graph.py).
+app.config['FOLLOW_GRAPH'] = os.environ.get('FOLLOW_GRAPH', '1') == '1'
+app.config['FOLLOW_GRAPH_TTL'] = int(os.environ.get('FOLLOW_GRAPH_TTL', 300))
+
+# `flask recommend` stores each user's RECOMMEND_TOP_K who-to-follow
+# suggestions, scoring RECOMMEND_BLOCK_SIZE users at a time (see
+# recommendations.py).
+app.config['RECOMMEND_TOP_K'] = int(os.environ.get('RECOMMEND_TOP_K', 20))
+app.config['RECOMMEND_BLOCK_SIZE'] = int(
+    os.environ.get('RECOMMEND_BLOCK_SIZE', 2000))
+app.config['RECOMMEND_LIKES_WEIGHT'] = float(
+    os.environ.get('RECOMMEND_LIKES_WEIGHT', 0.5))
+app.config['RECOMMEND_MAX_LIKERS'] = int(
+    os.environ.get('RECOMMEND_MAX_LIKERS', 1000))
+
+# Log a warning when a request runs more SQL statements than this.
+app.config['QUERY_BUDGET'] = int(os.environ.get('QUERY_BUDGET', 20))
 # toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+assets.init_app(app)
+jobs.init_app(app)
+recommendations.init_app(app)
+
+app.add_template_global(fragments.render_message)
+app.register_blueprint(api.api)
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Repair drift in the denormalized user and message counters."""
+
+    fixed = counters.reconcile()
+    db.session.commit()
+    print(f"Repaired counters on {fixed} rows")
 
 
 ######################
@@ -34,12 +174,24 @@ connect_db(app)
 # Helper functions
 
 
+@app.before_request
+def start_query_stats():
+    """Count SQL statements for this request (see instrumentation.py)."""
+
+    instrumentation.start_request()
+
+
 @app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = user_cache.load_user(session[CURR_USER_KEY])
+
+        # logged in elsewhere when they deleted their account
+        if g.user is None or g.user.deleted_at is not None:
+            del session[CURR_USER_KEY]
+            g.user = None
 
     else:
         g.user = None
@@ -58,10 +210,6 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-def get_liked_message_ids():
-    return set([msg.id for msg in g.user.messages_liked])
-
-
 ##############################################################################
 # Routes for signup/login/logout
 
@@ -112,6 +260,8 @@ def login():
                                  form.data['password'])
 
         if user:
+            # saves the password if authenticate() rehashed it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -134,31 +284,86 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@replicas.read_only
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and a
+    'before' cursor to page back through older users.
     """
 
     search = request.args.get('q')
+    before = pagination.parse_user_cursor(request.args.get('before'))
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = User.query
+
+    if search:
+        users = users.filter(User.username.like(f"%{search}%"))
+
+    page = queries.user_page(users, before)
+    next_url = page.next_cursor and url_for('list_users',
+                                            q=search,
+                                            before=page.next_cursor)
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html',
+                           users=page.items,
+                           next_url=next_url,
+                           following_ids=queries.following_ids(g.user))
+
+
+@app.route('/users/suggestions')
+@replicas.read_only
+def suggestions():
+    """Show users the logged-in user might want to follow."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    return render_template('users/index.html',
+                           users=recommendations.for_user(g.user),
+                           next_url=None,
+                           following_ids=queries.following_ids(g.user))
 
 
 @app.route('/users/<int:user_id>')
+@replicas.read_only
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/show.html', user=user, msg_ids=get_liked_message_ids())
+    user = queries.active_user_or_404(user_id)
+
+    # the profile, its counts and its messages all bump user.updated_at
+    not_modified = http_cache.not_modified(user.updated_at)
+    if not_modified:
+        return not_modified
+
+    before = pagination.parse_message_cursor(request.args.get('before'))
+
+    page = queries.message_page(queries.user_messages(user.id), before)
+    next_url = page.next_cursor and url_for('users_show',
+                                            user_id=user.id,
+                                            before=page.next_cursor)
+
+    page_ids = [msg.id for msg in page.items]
+
+    known_followers = []
+    if g.user and g.user.id != user.id:
+        known_followers = follow_graph.followed_by_followees(g.user.id,
+                                                             user.id)
+
+    return render_template('users/show.html',
+                           user=user,
+                           messages=page.items,
+                           next_url=next_url,
+                           next_cursor=page.next_cursor,
+                           msg_ids=likes.liked_ids(g.user, page_ids),
+                           following_ids=queries.following_ids(g.user),
+                           known_followers=known_followers)
 
 
 @app.route('/users/<int:user_id>/following')
+@replicas.read_only
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -166,11 +371,28 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=g.user)
+    user = queries.active_user_or_404(user_id)
+    before = pagination.parse_user_cursor(request.args.get('before'))
+
+    if user.id == g.user.id:
+        following_ids = follow_graph.own_following_ids(user.id)
+    else:
+        following_ids = follow_graph.following_ids(user.id)
+
+    page = queries.user_id_page(following_ids, before)
+    next_url = page.next_cursor and url_for('show_following',
+                                            user_id=user.id,
+                                            before=page.next_cursor)
+
+    return render_template('users/following.html',
+                           user=user,
+                           following=page.items,
+                           next_url=next_url,
+                           following_ids=queries.following_ids(g.user))
 
 
 @app.route('/users/<int:user_id>/followers')
+@replicas.read_only
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -178,7 +400,19 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    return render_template('users/followers.html', user=g.user)
+    user = queries.active_user_or_404(user_id)
+    before = pagination.parse_user_cursor(request.args.get('before'))
+
+    page = queries.user_id_page(follow_graph.follower_ids(user.id), before)
+    next_url = page.next_cursor and url_for('users_followers',
+                                            user_id=user.id,
+                                            before=page.next_cursor)
+
+    return render_template('users/followers.html',
+                           user=user,
+                           followers=page.items,
+                           next_url=next_url,
+                           following_ids=queries.following_ids(g.user))
 
 
 @app.route("/users/<int:user_id>/likes")
@@ -189,7 +423,22 @@ def users_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    return render_template('/users/likes.html', user=g.user)
+    user = queries.active_user_or_404(user_id)
+    before = pagination.parse_message_cursor(request.args.get('before'))
+
+    page = queries.message_page(queries.liked_messages(user.id), before)
+    next_url = page.next_cursor and url_for('users_likes',
+                                            user_id=user.id,
+                                            before=page.next_cursor)
+
+    page_ids = [msg.id for msg in page.items]
+
+    return render_template('/users/likes.html',
+                           user=user,
+                           messages=page.items,
+                           next_url=next_url,
+                           msg_ids=likes.liked_ids(g.user, page_ids),
+                           following_ids=queries.following_ids(g.user))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -200,9 +449,23 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followee = User.query.get_or_404(follow_id)
-    g.user.following.append(followee)
-    db.session.commit()
+    if follow_id == g.user.id:
+        flash("You can't follow yourself.", "danger")
+        return redirect(f"/users/{g.user.id}")
+
+    followee = queries.active_user_or_404(follow_id)
+
+    # a repeated follow (a double click, or a stale button) changes nothing
+    if not timeline.is_following(g.user.id, followee.id):
+        g.user.following.append(followee)
+        jobs.enqueue('backfill', user_id=g.user.id, followee_id=followee.id)
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+
+    follow_graph.mark_changed()
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -215,9 +478,15 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followee = User.query.get(follow_id)
-    g.user.following.remove(followee)
-    db.session.commit()
+    followee = queries.active_user_or_404(follow_id)
+
+    # a repeated unfollow (a double click, or a stale button) changes nothing
+    if timeline.is_following(g.user.id, followee.id):
+        g.user.following.remove(followee)
+        jobs.enqueue('prune', user_id=g.user.id, followee_id=followee.id)
+        db.session.commit()
+
+    follow_graph.mark_changed()
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -248,6 +517,7 @@ def profile():
         user.bio = form.data.get('bio')
 
         db.session.commit()
+        user_cache.invalidate(user.id)
 
         return redirect(f'/users/{user.id}')
 
@@ -263,8 +533,10 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user_id = g.user.id
+    deletion.soft_delete(g.user)
     db.session.commit()
+    user_cache.invalidate(user_id)
 
     return redirect("/signup")
 
@@ -288,7 +560,10 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.data['text'])
         g.user.messages.append(msg)
+        db.session.flush()
+        jobs.enqueue('fan_out', key=f'fan_out:{msg.id}', message_id=msg.id)
         db.session.commit()
+        search.index_message(msg)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -296,11 +571,24 @@ def messages_add():
 
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@replicas.read_only
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg, msg_ids=get_liked_message_ids())
+    msg = Message.query.get_or_404(message_id)
+
+    if msg.user.deleted_at is not None:
+        abort(404)
+
+    not_modified = http_cache.not_modified(msg.updated_at,
+                                           msg.user.updated_at)
+    if not_modified:
+        return not_modified
+
+    return render_template('messages/show.html',
+                           message=msg,
+                           msg_ids=likes.liked_ids(g.user, [msg.id]),
+                           following_ids=queries.following_ids(g.user))
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -311,12 +599,53 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.get_or_404(message_id)
+
+    if msg.user_id != g.user.id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    fragments.invalidate(msg)
+    message_id, text = msg.id, msg.text
     db.session.delete(msg)
     db.session.commit()
+    search.unindex_message(message_id, text)
 
     return redirect(f"/users/{g.user.id}")
 
+##############################################################################
+# Search
+
+
+@app.route('/search')
+def search_page():
+    """Search messages by text and users by username prefix.
+
+    Takes the search terms in 'q' and a 'before' cursor to page through
+    less relevant messages.
+    """
+
+    q = request.args.get('q', '').strip()
+    before = pagination.parse_search_cursor(request.args.get('before'))
+
+    if not q:
+        return render_template('search.html', q=q, users=[], messages=[],
+                               msg_ids=set(), next_url=None)
+
+    page = search.search_messages(q, before)
+    next_url = page.next_cursor and url_for('search_page',
+                                            q=q,
+                                            before=page.next_cursor)
+
+    return render_template('search.html',
+                           q=q,
+                           users=[] if before else search.search_users(q),
+                           messages=page.items,
+                           next_url=next_url,
+                           msg_ids=likes.liked_ids(
+                               g.user, [msg.id for msg in page.items]))
+
+
 ##############################################################################
 # Handle Likes etc.
 # /like/add /like/remove to determine add or remove like
@@ -327,18 +656,30 @@ def toggle_like(action):
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-    message_id = request.form.get('message_id')
-    message = Message.query.get(message_id)
+    message_id = request.form.get('message_id', type=int)
+    if message_id is None:
+        return jsonify({'response': "Missing message_id"}), 400
+
+    liked = action == 'add'
+
+    if app.config['LIKE_WRITE_BEHIND']:
+        Message.query.get_or_404(message_id)
+        likes.get_buffer().set(g.user.id, message_id, liked)
+    elif liked:
+        if not likes.like(g.user.id, message_id):
+            Message.query.get_or_404(message_id)
+        db.session.commit()
+    else:
+        likes.unlike(g.user.id, message_id)
+        db.session.commit()
 
-    if action == 'add':
-        g.user.messages_liked.append(message)
+    if liked:
+        likes.record_like(g.user.id, message_id)
         resp = "You liked that!"
     else:
-        g.user.messages_liked.remove(message)
+        likes.record_unlike(g.user.id, message_id)
         resp = "You unliked that!"
 
-    db.session.commit()
-
     return jsonify({'response': resp})
 
 
@@ -347,6 +688,7 @@ def toggle_like(action):
 
 
 @app.route('/')
+@replicas.read_only
 def homepage():
     """Show homepage:
 
@@ -355,16 +697,22 @@ def homepage():
     """
     
     if g.user:
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
+        before = pagination.parse_message_cursor(request.args.get('before'))
+
+        messages = timeline.get_timeline(g.user.id,
+                                         limit=pagination.PAGE_SIZE + 1,
+                                         before=before)
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        page = pagination.make_page(messages, pagination.message_cursor)
+        next_url = page.next_cursor and url_for('homepage',
+                                                before=page.next_cursor)
 
-        return render_template('home.html', messages=messages, msg_ids=get_liked_message_ids())
+        return render_template('home.html',
+                               messages=page.items,
+                               next_url=next_url,
+                               next_cursor=page.next_cursor,
+                               msg_ids=likes.liked_ids(
+                                   g.user, [msg.id for msg in page.items]))
 
     else:
         return render_template('home-anon.html')
@@ -377,20 +725,51 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 
+@app.errorhandler(passwords.HasherBusy)
+def hasher_busy(e):
+    """503 when too many passwords are being hashed to take another."""
+
+    db.session.rollback()
+    return ("Too many sign-ins right now; please try again shortly.", 503,
+            {'Retry-After': str(e.retry_after)})
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Caching headers: immutable fingerprinted assets, revalidated pages
+# (see http_cache.py)
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_cache_headers(resp):
+    """Set Cache-Control, and the page's ETag if it computed one."""
+
+    return http_cache.set_cache_headers(resp)
+
+
+@app.after_request
+def add_query_stats(resp):
+    """Report this request's SQL statements and warn if over budget."""
+
+    stats = instrumentation.request_stats()
+
+    if stats is None:
+        return resp
+
+    resp.headers.add('Server-Timing', stats.server_timing())
+
+    hash_time = passwords.request_hash_time()
+    if hash_time is not None:
+        resp.headers.add('Server-Timing', f'hash;dur={hash_time * 1000:.2f}')
+
+    budget = app.config.get('QUERY_BUDGET',
+                            instrumentation.DEFAULT_QUERY_BUDGET)
+
+    if stats.count > budget:
+        shape, times = stats.most_repeated()
+        app.logger.warning(
+            "%s %s ran %d queries (budget %d, %d duplicate); "
+            "most repeated (%dx): %s",
+            request.method, request.path, stats.count, budget,
+            stats.duplicates, times, shape)
+
+    return resp
 
@@ -0,0 +1,49 @@
+"""ASGI entry point, for serving Warbler with uvicorn and friends:
+
+    uvicorn asgi:app --workers 2
+
+or under gunicorn:
+
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+
+The Flask app is WSGI, so each request still runs synchronously, on a pool
+of ASGI_THREADS threads per process; what the ASGI server adds is handling
+many idle keep-alive connections per process without a thread each. Each
+request in flight can hold a database connection, so size DB_POOL_SIZE and
+DB_MAX_OVERFLOW to match.
+
+asgiref's own WsgiToAsgi runs the app with `thread_sensitive=True`, which
+outside Django means on one shared thread per process, so it would serve a
+single request at a time. ThreadedWsgiToAsgi runs it on the pool instead.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+from app import app as wsgi_app
+
+executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('ASGI_THREADS', 20)),
+    thread_name_prefix='asgi')
+
+
+class ThreadedWsgiToAsgiInstance(WsgiToAsgiInstance):
+    """Handles one request, running the app on `executor`."""
+
+    run_wsgi_app = sync_to_async(
+        WsgiToAsgiInstance.__dict__['run_wsgi_app'].func,
+        thread_sensitive=False, executor=executor)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi that serves requests concurrently."""
+
+    async def __call__(self, scope, receive, send):
+        await ThreadedWsgiToAsgiInstance(self.wsgi_application)(
+            scope, receive, send)
+
+
+app = ThreadedWsgiToAsgi(wsgi_app)
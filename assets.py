@@ -0,0 +1,218 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies every file under static/ into static/dist/
+with a hash of its contents in the name (`stylesheets/style.css` becomes
+`dist/stylesheets/style.1a2b3c4d5e6f.css`), and writes the mapping to
+static/dist/manifest.json. `/static/...` URLs inside stylesheets are
+rewritten to the fingerprinted names too. Text assets also get `.gz` and,
+if the `brotli` package is installed, `.br` copies, compressed once here
+rather than by the workers on every request.
+
+Templates link assets with `asset_url('stylesheets/style.css')`, which
+looks the path up in the manifest, so a changed file gets a new URL and
+browsers can cache each URL forever (see http_cache.py). Without a
+manifest (a checkout that hasn't been built) it links the plain file.
+
+The static route serves a precompressed copy when the client accepts its
+encoding. It's a plain file response either way, so gunicorn hands it to
+the kernel with sendfile() instead of copying it through the worker.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+
+from flask import current_app, request, send_from_directory, url_for
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+HASH_LENGTH = 12
+
+COMPRESSIBLE = {'.css', '.js', '.json', '.svg', '.ico', '.txt', '.html'}
+
+# (Accept-Encoding name, file suffix), preferred first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+_STATIC_URL = re.compile(r'/static/([\w./-]+)')
+
+_manifest = None
+
+
+##############################################################################
+# Building
+
+
+def fingerprint(path, content):
+    """Return `path` with a hash of `content` before its extension."""
+
+    root, ext = os.path.splitext(path)
+    digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    return f'{root}.{digest}{ext}'
+
+
+def compress(content):
+    """Return {file suffix: compressed content} for each encoding we can do."""
+
+    # mtime=0 so rebuilding the same file gives the same bytes
+    variants = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        variants['.br'] = brotli.compress(content)
+
+    return variants
+
+
+def write_file(path, content):
+    """Write `content` to `path`, creating its directory if needed."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def source_files(static_dir):
+    """Yield paths under `static_dir`, relative to it, outside dist/."""
+
+    for root, dirs, files in os.walk(static_dir):
+        if root == static_dir and DIST_DIR in dirs:
+            dirs.remove(DIST_DIR)
+        dirs.sort()
+        for name in sorted(files):
+            yield os.path.relpath(os.path.join(root, name),
+                                  static_dir).replace(os.sep, '/')
+
+
+def build(static_dir):
+    """Fingerprint and compress everything in `static_dir`.
+
+    Returns the manifest, {source path: path under static_dir}. Files
+    from earlier builds are left in place, so pages rendered before a
+    deploy can still load the assets they link.
+    """
+
+    dist_dir = os.path.join(static_dir, DIST_DIR)
+    manifest = {}
+
+    # stylesheets go last so the URLs in them can be rewritten
+    paths = sorted(source_files(static_dir),
+                   key=lambda path: path.endswith('.css'))
+
+    for path in paths:
+        with open(os.path.join(static_dir, path), 'rb') as f:
+            content = f.read()
+
+        if path.endswith('.css'):
+            content = _STATIC_URL.sub(
+                lambda m: f'/static/{manifest.get(m.group(1), m.group(1))}',
+                content.decode()).encode()
+
+        built = fingerprint(path, content)
+        built_path = os.path.join(dist_dir, built)
+        write_file(built_path, content)
+
+        if os.path.splitext(path)[1] in COMPRESSIBLE:
+            for suffix, compressed in compress(content).items():
+                if len(compressed) < len(content):
+                    write_file(built_path + suffix, compressed)
+
+        manifest[path] = f'{DIST_DIR}/{built}'
+
+    manifest_path = os.path.join(dist_dir, MANIFEST_NAME)
+    write_file(manifest_path + '.tmp',
+               json.dumps(manifest, indent=2, sort_keys=True).encode())
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    return manifest
+
+
+##############################################################################
+# Serving
+
+
+def get_manifest():
+    """Return the built manifest, or {} if assets haven't been built."""
+
+    global _manifest
+
+    if _manifest is None:
+        path = os.path.join(current_app.static_folder, DIST_DIR,
+                            MANIFEST_NAME)
+        try:
+            with open(path) as f:
+                _manifest = json.load(f)
+        except FileNotFoundError:
+            _manifest = {}
+
+    return _manifest
+
+
+def reset_manifest():
+    """Forget the loaded manifest; the next lookup reads it again."""
+
+    global _manifest
+    _manifest = None
+
+
+def manifest_version():
+    """Return a short hash of the manifest, which changes with any asset."""
+
+    return hashlib.md5(json.dumps(get_manifest(), sort_keys=True)
+                       .encode()).hexdigest()[:HASH_LENGTH]
+
+
+def asset_url(path):
+    """Return the URL for the static file `path`, fingerprinted if built."""
+
+    return url_for('static', filename=get_manifest().get(path, path))
+
+
+def send_static(filename):
+    """Serve a static file, or a precompressed copy the client accepts."""
+
+    # anything odd goes to Flask's static route, which will refuse it
+    if (posixpath.normpath(filename) != filename
+            or filename.startswith(('/', '../'))):
+        return current_app.send_static_file(filename)
+
+    static_dir = current_app.static_folder
+    variants = [(encoding, suffix) for encoding, suffix in ENCODINGS
+                if os.path.isfile(os.path.join(static_dir,
+                                               filename + suffix))]
+
+    if not variants:
+        return current_app.send_static_file(filename)
+
+    for encoding, suffix in variants:
+        if request.accept_encodings[encoding]:
+            mimetype = mimetypes.guess_type(filename)[0]
+            resp = send_from_directory(static_dir, filename + suffix,
+                                       mimetype=mimetype)
+            resp.headers['Content-Encoding'] = encoding
+            break
+    else:
+        resp = current_app.send_static_file(filename)
+
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+def init_app(app):
+    """Serve static files with send_static and add asset_url to templates."""
+
+    app.view_functions['static'] = send_static
+    app.add_template_global(asset_url)
+
+    @app.cli.command('build-assets')
+    def build_assets():
+        """Fingerprint and precompress static files into static/dist."""
+
+        manifest = build(app.static_folder)
+        print(f"Built {len(manifest)} assets")
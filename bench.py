@@ -0,0 +1,600 @@
+"""Benchmark Warbler's core routes.
+
+Seeds a database with generator/create_csvs.py and seed.py, then times
+homepage(), users_show(), list_users(), toggle_like() and messages_add():
+
+- in process, through `app.test_client()`, counting queries with
+  instrumentation.count_queries(); and
+- over HTTP against gunicorn (started here unless --url is given),
+  reading the query count from each response's Server-Timing header.
+  --servers picks which deployments to start: 'sync' and 'gevent'
+  gunicorn workers (see gunicorn.conf.py) and 'asgi' (uvicorn workers
+  running asgi.py).
+
+For each route it reports throughput, p50/p95/p99 latency and queries per
+request, plus, for servers started here, their peak memory and
+requests/sec per GB of it. Results are written as JSON so runs can be
+compared:
+
+    python bench.py --users 10000 --messages 100000 --follows 500000 \\
+        --likes 200000 --out bench_results/before.json
+    python bench.py --skip-seed --out bench_results/after.json
+    python bench.py --compare bench_results/before.json \\
+        bench_results/after.json
+    python bench.py --skip-seed --mode http --servers sync gevent asgi \\
+        --concurrency 64
+
+--compare exits non-zero if any route got slower, lost throughput by more
+than --threshold, or runs more queries. The database comes from
+DATABASE_URL (default postgresql:///warbler-bench) and is wiped when
+seeding. Messages posted while a route runs are deleted after it, so
+repeated --skip-seed runs benchmark the same data.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+os.environ.setdefault('DATABASE_URL', 'postgresql:///warbler-bench')
+
+from app import app, CURR_USER_KEY
+from models import db, FollowersFollowee, Like, Message, User
+import instrumentation
+
+BENCH_PASSWORD = 'benchmark'
+GENERATOR_END_DATE = '2019-01-01'
+
+# Server-Timing: db;dur=1.23;desc="4 queries, 0 duplicate"
+QUERY_COUNT = re.compile(r'desc="(\d+) queries')
+CSRF_TOKEN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+
+##############################################################################
+# Dataset
+
+
+def seed(opts):
+    """Generate a dataset of the requested size and load it."""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        subprocess.run([sys.executable, 'generator/create_csvs.py',
+                        '--users', str(opts.users),
+                        '--messages', str(opts.messages),
+                        '--follows', str(opts.follows),
+                        '--likes', str(opts.likes),
+                        '--seed', str(opts.seed),
+                        '--end-date', GENERATOR_END_DATE,
+                        '--out-dir', data_dir], check=True)
+        subprocess.run([sys.executable, 'seed.py', '--data-dir', data_dir],
+                       check=True)
+
+
+def bench_users(opts):
+    """Return ids of --concurrency users with a known password.
+
+    They're created on the first run, each following the --follow most
+    popular users so their homepages have something to show.
+    """
+
+    client = app.test_client()
+    ids = []
+
+    for i in range(opts.concurrency):
+        username = f'bench{i}'
+        user = User.query.filter_by(username=username).first()
+
+        if user is None:
+            user = User.signup(username, f'{username}@bench.test',
+                               BENCH_PASSWORD)
+            db.session.commit()
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user.id
+
+            popular = (User.query
+                       .filter(User.id != user.id)
+                       .order_by(User.follower_count.desc())
+                       .limit(opts.follow))
+            for followee_id in [u.id for u in popular]:
+                client.post(f'/users/follow/{followee_id}')
+
+        ids.append(user.id)
+
+    return ids
+
+
+##############################################################################
+# Drivers: how requests get to the app
+
+
+class InProcessDriver:
+    """Sends requests through app.test_client(), logged in as `user_id`."""
+
+    def __init__(self, user_id):
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def request(self, method, path, data=None):
+        """Return (status code, queries run) for one request."""
+
+        with instrumentation.count_queries() as stats:
+            resp = self.client.open(path, method=method, data=data)
+
+        db.session.remove()
+        return resp.status_code, stats.count
+
+
+class HTTPDriver:
+    """Sends requests to a running server, logged in as `username`."""
+
+    def __init__(self, url, username):
+        import requests
+
+        self.url = url
+        self.session = requests.Session()
+        self.csrf_token = None
+
+        login = self.session.get(f'{url}/login')
+        self.session.post(f'{url}/login', allow_redirects=False, data={
+            'username': username,
+            'password': BENCH_PASSWORD,
+            'csrf_token': self._token(login.text),
+        })
+        self.csrf_token = self._token(
+            self.session.get(f'{url}/messages/new').text)
+
+    @staticmethod
+    def _token(html):
+        match = CSRF_TOKEN.search(html)
+        return match and match.group(1)
+
+    def request(self, method, path, data=None):
+        """Return (status code, queries run) for one request."""
+
+        if data is not None:
+            data = dict(data, csrf_token=self.csrf_token)
+
+        resp = self.session.request(method, f'{self.url}{path}', data=data,
+                                    allow_redirects=False)
+        match = QUERY_COUNT.search(resp.headers.get('Server-Timing', ''))
+        return resp.status_code, int(match.group(1)) if match else None
+
+
+SERVERS = ['sync', 'gevent', 'asgi']
+
+
+def server_command(kind, bind, opts):
+    """Return the command line that starts a `kind` server on `bind`."""
+
+    if kind == 'asgi':
+        return ['gunicorn', '--bind', bind, '--workers', str(opts.workers),
+                '--worker-class', 'uvicorn.workers.UvicornWorker',
+                'asgi:app']
+
+    return ['gunicorn', '-c', 'gunicorn.conf.py', '--bind', bind,
+            '--workers', str(opts.workers), '--worker-class', kind,
+            'app:app']
+
+
+def start_server(opts, kind):
+    """Start a `kind` server on a free port; return (process, base URL)."""
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    # gunicorn.conf.py reads the worker class from the environment too, to
+    # decide whether to patch psycopg2
+    env = dict(os.environ, WEB_WORKER_CLASS=kind)
+    server = subprocess.Popen(
+        server_command(kind, f'127.0.0.1:{port}', opts), env=env)
+    url = f'http://127.0.0.1:{port}'
+
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server, url
+        except OSError:
+            time.sleep(0.1)
+
+    server.terminate()
+    raise RuntimeError(f"{kind} server didn't start")
+
+
+def tree_rss(pid):
+    """Return the resident memory in bytes of `pid` and its descendants.
+
+    Reads /proc, so it returns None on systems without one.
+    """
+
+    children = {}
+
+    try:
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    # the command name can contain spaces; ppid follows it
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    except OSError:
+        return None
+
+    total = 0
+    pending = [pid]
+
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+
+    return total
+
+
+class MemorySampler:
+    """Tracks the peak memory of a server's process tree in the background."""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, tree_rss(self.pid) or 0)
+
+    def reset(self):
+        """Start tracking a new peak from the current memory use."""
+
+        self.peak = tree_rss(self.pid) or 0
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+##############################################################################
+# Workloads
+
+
+def workloads(dataset):
+    """Return {route: fn(rng, state) -> (method, path, data)}."""
+
+    def homepage(rng, state):
+        return 'GET', '/', None
+
+    def users_show(rng, state):
+        return 'GET', f'/users/{rng.randint(1, dataset["max_user_id"])}', None
+
+    def list_users(rng, state):
+        return 'GET', '/users', None
+
+    def toggle_like(rng, state):
+        # alternately like a message and unlike it again
+        message_id = state.pop('liked', None)
+        if message_id is not None:
+            return 'POST', '/like/remove', {'message_id': message_id}
+
+        state['liked'] = rng.randint(1, dataset['max_message_id'])
+        return 'POST', '/like/add', {'message_id': state['liked']}
+
+    def messages_add(rng, state):
+        return 'POST', '/messages/new', {'text': f'bench {rng.random()}'}
+
+    return {
+        'homepage': homepage,
+        'users_show': users_show,
+        'list_users': list_users,
+        'toggle_like': toggle_like,
+        'messages_add': messages_add,
+    }
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank `p`th percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def run_route(drivers, workload, opts, name):
+    """Run --requests requests of `workload` spread over `drivers`."""
+
+    latencies = []
+    queries = []
+    errors = 0
+    lock = threading.Lock()
+
+    def worker(index, driver, count):
+        nonlocal errors
+        rng = random.Random(f'{opts.seed}:{name}:{index}')
+        state = {}
+
+        for i in range(opts.warmup + count):
+            method, path, data = workload(rng, state)
+
+            start = time.perf_counter()
+            status, n = driver.request(method, path, data)
+            elapsed = time.perf_counter() - start
+
+            if i < opts.warmup:
+                continue
+
+            with lock:
+                latencies.append(elapsed)
+                if n is not None:
+                    queries.append(n)
+                if status >= 400:
+                    errors += 1
+
+    per_driver = [opts.requests // len(drivers)] * len(drivers)
+    per_driver[0] += opts.requests % len(drivers)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(drivers)) as pool:
+        list(pool.map(worker, range(len(drivers)), drivers, per_driver))
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': round(len(latencies) / wall, 2),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'queries_per_request': (round(sum(queries) / len(queries), 2)
+                                if queries else None),
+    }
+
+
+def run_mode(drivers, dataset, opts, memory=None):
+    """Benchmark every route through `drivers`; return {route: stats}.
+
+    With a MemorySampler for the server, each route's stats include its
+    peak memory and throughput per GB of it.
+    """
+
+    results = {}
+
+    for name, workload in workloads(dataset).items():
+        if memory:
+            memory.reset()
+
+        last_message_id = max_id(Message)
+        results[name] = stats = run_route(drivers, workload, opts, name)
+        delete_messages_after(last_message_id)
+
+        if memory and memory.peak:
+            stats['rss_mb'] = round(memory.peak / 2**20, 1)
+            stats['throughput_per_gb'] = round(
+                stats['throughput'] / (memory.peak / 2**30), 2)
+
+        print(f"  {name:<13} {stats['throughput']:>9.1f} req/s  "
+              f"p50 {stats['p50_ms']:>8.2f}ms  p95 {stats['p95_ms']:>8.2f}ms  "
+              f"p99 {stats['p99_ms']:>8.2f}ms  "
+              f"{stats['queries_per_request']} queries/req  "
+              f"{stats['errors']} errors"
+              + (f"  {stats['rss_mb']:.0f}MB, "
+                 f"{stats['throughput_per_gb']:.1f} req/s per GB"
+                 if 'rss_mb' in stats else ''), flush=True)
+
+    return results
+
+
+##############################################################################
+# Comparing runs
+
+# metric: True if bigger is better
+METRICS = {
+    'throughput': True,
+    'throughput_per_gb': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+    'queries_per_request': False,
+}
+
+
+def compare(old, new, threshold):
+    """Print how `new` differs from `old`; return the regressions found."""
+
+    regressions = []
+
+    for mode, routes in new['results'].items():
+        for route, stats in routes.items():
+            before = old['results'].get(mode, {}).get(route)
+            if before is None:
+                continue
+
+            for metric, higher_is_better in METRICS.items():
+                a, b = before.get(metric), stats.get(metric)
+                if not a or b is None:
+                    continue
+
+                change = (b - a) / a
+                worse = -change if higher_is_better else change
+                limit = 0 if metric == 'queries_per_request' else threshold
+                flag = ''
+
+                if worse > limit:
+                    flag = '  REGRESSION'
+                    regressions.append((mode, route, metric))
+
+                print(f"{mode:<10} {route:<13} {metric:<20} "
+                      f"{a:>10} -> {b:<10} {change:+.1%}{flag}")
+
+    return regressions
+
+
+def max_id(model):
+    """Return the largest id in `model`'s table, or 0."""
+
+    return db.session.query(db.func.max(model.id)).scalar() or 0
+
+
+def delete_messages_after(message_id):
+    """Delete messages posted by a route run, so repeated runs see the
+    same dataset.
+
+    Deleted through the ORM, so counters are adjusted as for any delete.
+    """
+
+    for msg in Message.query.filter(Message.id > message_id).all():
+        db.session.delete(msg)
+
+    db.session.commit()
+    db.session.remove()
+
+
+def describe_dataset():
+    """Return row counts and id ranges of the data being benchmarked."""
+
+    return {
+        'users': User.query.count(),
+        'messages': Message.query.count(),
+        'follows': FollowersFollowee.query.count(),
+        'likes': Like.query.count(),
+        'max_user_id': max_id(User),
+        'max_message_id': max_id(Message),
+    }
+
+
+def git_commit():
+    """Return the current commit hash, or None outside a git checkout."""
+
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--follows', type=int, default=200000)
+    parser.add_argument('--likes', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-seed', action='store_true',
+                        help="benchmark the data already in the database")
+    parser.add_argument('--mode', choices=['inprocess', 'http', 'both'],
+                        default='both')
+    parser.add_argument('--requests', type=int, default=500,
+                        help="timed requests per route")
+    parser.add_argument('--warmup', type=int, default=20,
+                        help="untimed requests per route and client first")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="concurrent HTTP clients")
+    parser.add_argument('--follow', type=int, default=50,
+                        help="popular users each benchmark user follows")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="worker processes, if starting servers here")
+    parser.add_argument('--servers', nargs='+', choices=SERVERS,
+                        default=['sync'],
+                        help="deployments to start and benchmark over HTTP")
+    parser.add_argument('--url', help="benchmark this server over HTTP "
+                                      "instead of starting any")
+    parser.add_argument('--out', help="write results to this JSON file")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="compare two results files and exit")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="allowed slowdown before --compare fails")
+    return parser.parse_args()
+
+
+def main():
+    opts = parse_args()
+
+    if opts.compare:
+        with open(opts.compare[0]) as f:
+            old = json.load(f)
+        with open(opts.compare[1]) as f:
+            new = json.load(f)
+        sys.exit(1 if compare(old, new, opts.threshold) else 0)
+
+    if not opts.skip_seed:
+        seed(opts)
+
+    user_ids = bench_users(opts)
+    dataset = describe_dataset()
+    db.session.remove()
+    usernames = [f'bench{i}' for i in range(len(user_ids))]
+    results = {}
+
+    if opts.mode in ('inprocess', 'both'):
+        print("in process:", flush=True)
+        app.config['WTF_CSRF_ENABLED'] = False
+        results['inprocess'] = run_mode([InProcessDriver(user_ids[0])],
+                                        dataset, opts)
+
+    if opts.mode in ('http', 'both') and opts.url:
+        print(f"http ({opts.url}):", flush=True)
+        drivers = [HTTPDriver(opts.url, username) for username in usernames]
+        results['http'] = run_mode(drivers, dataset, opts)
+
+    elif opts.mode in ('http', 'both'):
+        for kind in opts.servers:
+            server, url = start_server(opts, kind)
+            memory = MemorySampler(server.pid)
+            mode = 'http' if kind == 'sync' else f'http-{kind}'
+            print(f"{mode} ({url}):", flush=True)
+
+            try:
+                drivers = [HTTPDriver(url, username)
+                           for username in usernames]
+                results[mode] = run_mode(drivers, dataset, opts, memory)
+            finally:
+                memory.stop()
+                server.terminate()
+                server.wait()
+
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.utcnow().isoformat(),
+        'database': db.engine.dialect.name,
+        'dataset': dict(dataset, generator_seed=(None if opts.skip_seed
+                                                else opts.seed)),
+        'settings': {key: getattr(opts, key) for key in
+                     ('requests', 'warmup', 'concurrency', 'follow',
+                      'workers', 'servers')},
+        'results': results,
+    }
+
+    if opts.out:
+        os.makedirs(os.path.dirname(opts.out) or '.', exist_ok=True)
+        with open(opts.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"wrote {opts.out}")
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        main()
@@ -0,0 +1,117 @@
+"""Small key/value caches for Warbler.
+
+Two interchangeable backends:
+
+- MemoryCache keeps entries in the current process, evicting the least
+  recently used entry once it holds `max_size` and expiring entries after
+  `ttl` seconds.
+- RedisCache stores JSON-encoded entries in a shared Redis (or anything
+  with the same get/setex/delete API), so every worker sees invalidations.
+
+`make_cache()` picks one based on the app's CACHE_BACKEND setting.
+"""
+
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_SIZE = 10000
+
+
+class MemoryCache:
+    """In-process LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return the value for `key`, or None if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store `value` under `key`, evicting the oldest entry if full."""
+
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Remove `key` if present."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry."""
+
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    """Shared cache on a Redis client; values must be JSON-serializable.
+
+    Redis does its own eviction (configure it with an LRU maxmemory policy),
+    so only the TTL is applied here.
+    """
+
+    def __init__(self, client, prefix, ttl=DEFAULT_TTL):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(f'{self.prefix}:{key}')
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self.client.setex(f'{self.prefix}:{key}', self.ttl, json.dumps(value))
+
+    def delete(self, key):
+        self.client.delete(f'{self.prefix}:{key}')
+
+    def clear(self):
+        for key in self.client.scan_iter(f'{self.prefix}:*'):
+            self.client.delete(key)
+
+
+def make_cache(config, prefix, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+    """Create the cache backend named by config['CACHE_BACKEND'].
+
+    'memory' (the default) gives a MemoryCache; 'redis' gives a RedisCache
+    connected to config['REDIS_URL'].
+    """
+
+    backend = config.get('CACHE_BACKEND', 'memory')
+
+    if backend == 'memory':
+        return MemoryCache(max_size=max_size, ttl=ttl)
+
+    if backend == 'redis':
+        import redis
+        client = redis.Redis.from_url(config['REDIS_URL'])
+        return RedisCache(client, prefix, ttl=ttl)
+
+    raise ValueError(f"Unknown CACHE_BACKEND: {backend!r}")
@@ -0,0 +1,194 @@
+"""Denormalized counters for users and messages.
+
+User.message_count, following_count, follower_count and likes_count and
+Message.like_count are kept in step with the rows they count by session
+events, so they are updated in the same transaction as the write that
+changed them (posting or deleting a message, following, liking), and
+cached user snapshots are invalidated when it commits:
+
+- appends/removes on User.following and User.messages_liked are recorded
+  as they happen and applied as atomic `col = col + n` UPDATEs after the
+  flush that writes the association rows;
+- inserted and deleted Message rows adjust their author's message_count.
+
+Code that writes like rows with plain SQL (likes.py) calls
+`like_changed()` in the same transaction instead.
+
+Bulk operations (bulk_insert_mappings, Query.delete, database cascades)
+bypass these events. `reconcile()` recomputes every counter from scratch
+to repair any drift they cause.
+"""
+
+from collections import defaultdict
+
+from sqlalchemy import event, func, or_, select
+from sqlalchemy.orm import configure_mappers, object_session
+
+from models import db, FollowersFollowee, Like, Message, User
+import user_cache
+
+PENDING_KEY = 'counter_deltas'
+
+users = User.__table__
+messages = Message.__table__
+
+
+def _pending(session):
+    """Return the session's pending {(table, column, obj): delta} map."""
+
+    return session.info.setdefault(PENDING_KEY, defaultdict(int))
+
+
+def _record(session, table, column, obj, delta):
+    """Record that `obj`'s `column` should change by `delta`."""
+
+    if session is not None:
+        _pending(session)[(table, column, obj)] += delta
+
+
+def _on_follow(user, followee, initiator):
+    session = object_session(user) or object_session(followee)
+    _record(session, users, 'following_count', user, 1)
+    _record(session, users, 'follower_count', followee, 1)
+    return followee
+
+
+def _on_unfollow(user, followee, initiator):
+    session = object_session(user) or object_session(followee)
+    _record(session, users, 'following_count', user, -1)
+    _record(session, users, 'follower_count', followee, -1)
+
+
+def _on_like(user, message, initiator):
+    session = object_session(user) or object_session(message)
+    _record(session, users, 'likes_count', user, 1)
+    _record(session, messages, 'like_count', message, 1)
+    return message
+
+
+def _on_unlike(user, message, initiator):
+    session = object_session(user) or object_session(message)
+    _record(session, users, 'likes_count', user, -1)
+    _record(session, messages, 'like_count', message, -1)
+
+
+def _increment(conn, table, column, where, delta):
+    """Atomically add `delta` to `column` for the rows matching `where`."""
+
+    conn.execute(table.update()
+                 .where(where)
+                 .values({column: table.c[column] + delta}))
+
+
+def like_changed(session, user_id, message_id, delta):
+    """Adjust counters for `delta` like rows written outside the ORM."""
+
+    conn = session.connection()
+    _increment(conn, users, 'likes_count', users.c.id == user_id, delta)
+    _increment(conn, messages, 'like_count', messages.c.id == message_id,
+               delta)
+    user_cache.mark_changed(session, user_id)
+
+
+def _before_flush(session, flush_context, instances):
+    """Account for messages about to be deleted.
+
+    Their like rows are removed along with them, so the likers' counts are
+    decremented here while those rows can still be seen.
+    """
+
+    for obj in session.deleted:
+        if isinstance(obj, Message):
+            conn = session.connection()
+            likers = [user_id for (user_id,) in conn.execute(
+                select([Like.user_id]).where(Like.message_id == obj.id))]
+
+            if likers:
+                _increment(conn, users, 'likes_count',
+                           users.c.id.in_(likers), -1)
+
+            _increment(conn, users, 'message_count',
+                       users.c.id == obj.user_id, -1)
+
+            for user_id in likers + [obj.user_id]:
+                user_cache.mark_changed(session, user_id)
+
+
+def _after_flush(session, flush_context):
+    """Apply recorded deltas once the rows they describe are written."""
+
+    conn = session.connection()
+
+    for obj in session.new:
+        if isinstance(obj, Message):
+            _increment(conn, users, 'message_count',
+                       users.c.id == obj.user_id, 1)
+            user_cache.mark_changed(session, obj.user_id)
+
+    pending = session.info.pop(PENDING_KEY, {})
+
+    for (table, column, obj), delta in pending.items():
+        if delta and obj.id is not None:
+            _increment(conn, table, column, table.c.id == obj.id, delta)
+
+            if table is users:
+                user_cache.mark_changed(session, obj.id)
+
+
+def _after_soft_rollback(session, previous_transaction):
+    """Forget deltas for writes that were rolled back."""
+
+    session.info.pop(PENDING_KEY, None)
+
+
+def reconcile(conn=None):
+    """Recompute every counter from the rows it counts.
+
+    Runs on `conn` if given, otherwise on the current session. Returns the
+    number of users and messages whose counters were wrong.
+    """
+
+    conn = conn or db.session
+
+    def count(model, where):
+        return (select([func.count()])
+                .select_from(model.__table__)
+                .where(where)
+                .as_scalar())
+
+    # followee_id is the user doing the following (see FollowersFollowee)
+    user_counts = {
+        'message_count': count(Message, Message.user_id == users.c.id),
+        'following_count': count(FollowersFollowee,
+                                 FollowersFollowee.followee_id == users.c.id),
+        'follower_count': count(FollowersFollowee,
+                                FollowersFollowee.follower_id == users.c.id),
+        'likes_count': count(Like, Like.user_id == users.c.id),
+    }
+
+    message_counts = {
+        'like_count': count(Like, Like.message_id == messages.c.id),
+    }
+
+    fixed = 0
+
+    for table, counts in ((users, user_counts), (messages, message_counts)):
+        drifted = or_(*[table.c[col] != value
+                        for col, value in counts.items()])
+
+        result = conn.execute(
+            table.update().where(drifted).values(counts))
+        fixed += result.rowcount
+
+    return fixed
+
+
+configure_mappers()
+
+event.listen(User.following, 'append', _on_follow, retval=True)
+event.listen(User.following, 'remove', _on_unfollow)
+event.listen(User.messages_liked, 'append', _on_like, retval=True)
+event.listen(User.messages_liked, 'remove', _on_unlike)
+event.listen(db.session, 'before_flush', _before_flush)
+event.listen(db.session, 'after_flush', _after_flush)
+event.listen(db.session, 'after_soft_rollback', _after_soft_rollback)
@@ -0,0 +1,338 @@
+"""Deleting an account in two phases.
+
+Deleting a user row and letting ON DELETE CASCADE remove their follows,
+likes, messages and timeline entries does it all in one transaction,
+holding locks on every row it touches (and on the counters of everyone
+they followed or liked) until it finishes. For a big account that's long
+enough to stall other requests.
+
+`soft_delete()` instead just stamps the user's `deleted_at`, which hides
+them at once: they can't log in, their profile 404s, and they and their
+messages drop out of user lists, timelines and search (see queries.py).
+It records a row in `deletion_progress` and queues a 'delete_user' job in
+the same transaction.
+
+The job removes the data in STEPS, at most the batch size (normally
+DELETE_CHUNK_SIZE) rows per run, adjusting the counters those rows fed as
+it goes, and requeues itself until only the user row is left, which goes
+last along with its progress row. The step reached and the rows deleted
+so far are saved with each run, so the next one resumes there instead of
+re-checking finished steps, and a retried or interrupted run is harmless.
+
+On PostgreSQL each run's statements are also limited to
+DELETE_STATEMENT_TIMEOUT milliseconds. A run that hits it is rolled back
+and the user's batch size halved, so every batch finishes in bounded time
+however slow the tables are.
+"""
+
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+
+from models import db, FollowersFollowee, Like, Message, TimelineEntry, User
+import follow_graph
+import jobs
+import timeline
+import user_cache
+
+# PostgreSQL's SQLSTATE for a statement cancelled by statement_timeout
+QUERY_CANCELED = '57014'
+
+users = User.__table__
+messages = Message.__table__
+likes = Like.__table__
+follows = FollowersFollowee.__table__
+timelines = TimelineEntry.__table__
+
+progress = db.Table(
+    'deletion_progress',
+    db.Column('user_id', db.Integer, primary_key=True),
+    db.Column('step', db.Integer, nullable=False, default=0),
+    # null means DELETE_CHUNK_SIZE; set when a batch times out
+    db.Column('batch_size', db.Integer),
+    db.Column('rows_deleted', db.Integer, nullable=False, default=0),
+    db.Column('started_at', db.DateTime, nullable=False,
+              default=datetime.utcnow),
+    db.Column('updated_at', db.DateTime, nullable=False,
+              default=datetime.utcnow),
+)
+
+
+def _decrement(conn, table, column, ids):
+    """Subtract 1 from `column` once per occurrence of an id in `ids`."""
+
+    by_amount = defaultdict(list)
+    for row_id, count in Counter(ids).items():
+        by_amount[count].append(row_id)
+
+    for amount, row_ids in by_amount.items():
+        conn.execute(table.update()
+                     .where(table.c.id.in_(row_ids))
+                     .values({column: table.c[column] - amount}))
+
+
+def _delete_pairs(conn, table, group_column, other_column, pairs):
+    """Delete rows matching (group, other) `pairs`, one statement a group."""
+
+    grouped = defaultdict(list)
+    for group, other in pairs:
+        grouped[group].append(other)
+
+    for group, others in grouped.items():
+        conn.execute(table.delete().where(
+            (table.c[group_column] == group)
+            & table.c[other_column].in_(others)))
+
+
+def _own_messages(user_id):
+    """Select the ids of `user_id`'s messages."""
+
+    return select([messages.c.id]).where(messages.c.user_id == user_id)
+
+
+##############################################################################
+# Steps: each deletes up to `limit` rows and returns how many it deleted
+
+
+def _delete_likes(conn, session, user_id, limit):
+    """Their likes: each liked message loses a like."""
+
+    liked = [m for (m,) in conn.execute(
+        select([likes.c.message_id])
+        .where(likes.c.user_id == user_id).limit(limit))]
+
+    if liked:
+        _delete_pairs(conn, likes, 'user_id', 'message_id',
+                      [(user_id, m) for m in liked])
+        _decrement(conn, messages, 'like_count', liked)
+
+    return len(liked)
+
+
+def _delete_likers(conn, session, user_id, limit):
+    """Likes of their messages: each liker loses a like."""
+
+    likers = conn.execute(
+        select([likes.c.message_id, likes.c.user_id])
+        .where(likes.c.message_id.in_(_own_messages(user_id)))
+        .limit(limit)).fetchall()
+
+    if likers:
+        _delete_pairs(conn, likes, 'message_id', 'user_id', likers)
+        _decrement(conn, users, 'likes_count', [u for m, u in likers])
+        for u in {u for m, u in likers}:
+            user_cache.mark_changed(session, u)
+
+    return len(likers)
+
+
+def _follows_step(own, other, count):
+    """Make a step deleting follows with the user in column `own`."""
+
+    def delete_follows(conn, session, user_id, limit):
+        others = [o for (o,) in conn.execute(
+            select([follows.c[other]])
+            .where(follows.c[own] == user_id).limit(limit))]
+
+        if others:
+            _delete_pairs(conn, follows, own, other,
+                          [(user_id, o) for o in others])
+            _decrement(conn, users, count, others)
+            for o in others:
+                user_cache.mark_changed(session, o)
+                pair = (user_id, o) if own == 'followee_id' else (o, user_id)
+                follow_graph.follow_changed(session, *pair, False)
+
+            # losing a follower can take a pulled author under the threshold
+            if count == 'follower_count':
+                timeline.check_unpulled(others)
+
+        return len(others)
+
+    return delete_follows
+
+
+def _delete_fanned_out(conn, session, user_id, limit):
+    """Their messages in other users' timelines."""
+
+    entries = conn.execute(
+        select([timelines.c.message_id, timelines.c.user_id])
+        .where(timelines.c.message_id.in_(_own_messages(user_id)))
+        .limit(limit)).fetchall()
+
+    if entries:
+        _delete_pairs(conn, timelines, 'message_id', 'user_id', entries)
+
+    return len(entries)
+
+
+def _delete_timeline(conn, session, user_id, limit):
+    """Their own timeline."""
+
+    entries = [m for (m,) in conn.execute(
+        select([timelines.c.message_id])
+        .where(timelines.c.user_id == user_id).limit(limit))]
+
+    if entries:
+        _delete_pairs(conn, timelines, 'user_id', 'message_id',
+                      [(user_id, m) for m in entries])
+
+    return len(entries)
+
+
+def _delete_messages(conn, session, user_id, limit):
+    """Their messages, once nothing refers to them."""
+
+    own = [m for (m,) in conn.execute(_own_messages(user_id).limit(limit))]
+
+    if own:
+        conn.execute(messages.delete().where(messages.c.id.in_(own)))
+
+    return len(own)
+
+
+# followee_id is the user doing the following (see FollowersFollowee)
+STEPS = [
+    _delete_likes,
+    _delete_likers,
+    _follows_step('followee_id', 'follower_id', 'follower_count'),
+    _follows_step('follower_id', 'followee_id', 'following_count'),
+    _delete_fanned_out,
+    _delete_timeline,
+    _delete_messages,
+]
+
+
+##############################################################################
+# Running a deletion
+
+
+def soft_delete(user):
+    """Hide `user` now and queue the deletion of their data.
+
+    The caller commits.
+    """
+
+    user.deleted_at = datetime.utcnow()
+    db.session.flush()
+
+    _start(db.session.connection(), user.id)
+    jobs.enqueue('delete_user', key=f'delete_user:{user.id}',
+                 user_id=user.id)
+
+
+def _start(conn, user_id):
+    """Insert `user_id`'s progress row, unless it's already there."""
+
+    if conn.execute(select([progress.c.user_id])
+                    .where(progress.c.user_id == user_id)).first():
+        return
+
+    conn.execute(progress.insert().values(
+        user_id=user_id, step=0, rows_deleted=0,
+        started_at=datetime.utcnow(), updated_at=datetime.utcnow()))
+
+
+def _progress(conn, user_id):
+    """Return `user_id`'s progress row, starting one if there's none."""
+
+    _start(conn, user_id)
+
+    return conn.execute(progress.select()
+                        .where(progress.c.user_id == user_id)).first()
+
+
+def batch_size(row):
+    """Return how many rows a run may delete for progress `row`."""
+
+    return row.batch_size or current_app.config.get('DELETE_CHUNK_SIZE', 1000)
+
+
+def delete_chunk(user_id):
+    """Delete the next batch of `user_id`'s data, resuming where the last
+    one stopped.
+
+    Returns True if there may be more to delete, False once the user row
+    itself has been deleted.
+    """
+
+    session = db.session
+    conn = session.connection()
+
+    row = _progress(conn, user_id)
+    step, remaining = row.step, batch_size(row)
+
+    # a step that deletes less than it was allowed is finished, so the
+    # rest of the batch goes to the next one
+    while remaining and step < len(STEPS):
+        deleted = STEPS[step](conn, session, user_id, remaining)
+        remaining -= deleted
+        if remaining:
+            step += 1
+
+    if step < len(STEPS):
+        conn.execute(progress.update()
+                     .where(progress.c.user_id == user_id)
+                     .values(step=step,
+                             rows_deleted=(progress.c.rows_deleted
+                                           + batch_size(row) - remaining),
+                             updated_at=datetime.utcnow()))
+        return True
+
+    conn.execute(users.delete().where(users.c.id == user_id))
+    conn.execute(progress.delete().where(progress.c.user_id == user_id))
+    conn.execute(timeline.pulled_authors.delete()
+                 .where(timeline.pulled_authors.c.user_id == user_id))
+    user_cache.mark_changed(session, user_id)
+    return False
+
+
+def _shrink_batch(user_id):
+    """Halve `user_id`'s batch size after a batch ran out of time."""
+
+    conn = db.session.connection()
+    size = batch_size(_progress(conn, user_id))
+
+    if size <= 1:
+        return False
+
+    conn.execute(progress.update()
+                 .where(progress.c.user_id == user_id)
+                 .values(batch_size=size // 2, updated_at=datetime.utcnow()))
+    current_app.logger.warning(
+        "Deleting user %s timed out; batch size now %d", user_id, size // 2)
+    return True
+
+
+@jobs.handler('delete_user')
+def delete_user_job(user_id):
+    """Delete the next batch of a departing user's data."""
+
+    timeout = current_app.config.get('DELETE_STATEMENT_TIMEOUT')
+
+    if not timeout or db.session.bind.dialect.name != 'postgresql':
+        return delete_chunk(user_id)
+
+    # in a savepoint, so a timeout doesn't lose the caller's writes when
+    # the job runs eagerly. Releasing the savepoint keeps a SET LOCAL, so
+    # the caller's timeout is put back once the batch is done.
+    previous = db.session.execute('SHOW statement_timeout').scalar()
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(f'SET LOCAL statement_timeout = {int(timeout)}')
+            more = delete_chunk(user_id)
+            db.session.execute(
+                "SELECT set_config('statement_timeout', :previous, true)",
+                {'previous': previous})
+            return more
+    except OperationalError as exc:
+        if getattr(exc.orig, 'pgcode', None) != QUERY_CANCELED:
+            raise
+        if not _shrink_batch(user_id):
+            raise
+
+    return True
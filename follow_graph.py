@@ -0,0 +1,345 @@
+"""Who follows whom, held in memory.
+
+Nearly every page asks about follows: the follow buttons on a listing, a
+profile's "followed by people you follow", the following and followers
+lists. Rather than query the follows table for each, every worker keeps a
+FollowGraph: each user's following ids and follower ids as IntSets, so a
+membership test is a bisection and an intersection is a merge of two
+sorted arrays.
+
+The graph is loaded in bulk, with one index-ordered scan of the follows
+table per direction, the first time it's needed (gunicorn workers warm it
+at startup; see gunicorn.conf.py) and reloaded every FOLLOW_GRAPH_TTL
+seconds. Between reloads it is kept up to date incrementally:
+
+- appends to and removes from User.following, and deleted users, are
+  recorded as they are flushed and applied after the commit;
+- code that writes follows with plain SQL (deletion.py) calls
+  `follow_changed()` in the same transaction instead;
+- bulk deletes of users or follows (Query.delete) reset the graph, to be
+  reloaded on next use.
+
+Each worker only sees its own writes between reloads, so another worker's
+follow can take up to FOLLOW_GRAPH_TTL seconds to show. That's fine for
+other people's follows, but users must see their own at once, whichever
+worker took the follow. So the follow routes call `mark_changed()`, which
+stamps the browser's session, and `own_following_ids()` reads the
+viewer's follows from the database only while this worker's graph was
+loaded before that stamp; everyone else is served from the graph. Jobs
+and routes that must see the latest follows (timeline.py) ask the
+database.
+
+With FOLLOW_GRAPH off, the same functions query the follows table.
+"""
+
+import time
+from itertools import groupby
+from operator import itemgetter
+from threading import Lock
+
+from flask import has_request_context, session as flask_session
+from sqlalchemy import event, select
+from sqlalchemy.orm import configure_mappers, object_session
+
+from intset import IntSet
+from models import db, FollowersFollowee, User
+
+PENDING_KEY = 'follow_graph_pending'
+CHANGES_KEY = 'follow_graph_changes'
+RESET_KEY = 'follow_graph_reset'
+
+# in the browser's session: when its user last followed or unfollowed
+CHANGED_AT_KEY = 'follows_changed_at'
+
+FOLLOW = 'follow'
+UNFOLLOW = 'unfollow'
+REMOVE = 'remove'
+
+follows = FollowersFollowee.__table__
+
+_graph = None
+_replay = None
+
+# _lock guards changes to the graph; _load_lock lets one request reload it
+_lock = Lock()
+_load_lock = Lock()
+
+
+class FollowGraph:
+    """Every user's following and follower ids, as IntSets.
+
+    Lookups return the stored sets; callers must not modify them.
+    """
+
+    def __init__(self, following, followers, started_at=None):
+        self._following = following
+        self._followers = followers
+        self.loaded_at = time.monotonic()
+        # wall-clock time the load began; follows committed before it are in
+        self.started_at = time.time() if started_at is None else started_at
+
+    @classmethod
+    def load(cls):
+        """Build the graph from the follows table.
+
+        Reads on a connection of its own, outside the caller's transaction.
+        """
+
+        started_at = time.time()
+
+        with db.engine.connect() as conn:
+            conn = conn.execution_options(stream_results=True)
+
+            # followee_id is the user doing the following (see
+            # FollowersFollowee)
+            return cls(_adjacency(conn, follows.c.followee_id,
+                                  follows.c.follower_id),
+                       _adjacency(conn, follows.c.follower_id,
+                                  follows.c.followee_id),
+                       started_at)
+
+    def following(self, user_id):
+        """Return the ids `user_id` follows."""
+
+        return self._following.get(user_id) or IntSet()
+
+    def followers(self, user_id):
+        """Return the ids following `user_id`."""
+
+        return self._followers.get(user_id) or IntSet()
+
+    def apply(self, changes):
+        """Apply (op, user_id, other_id) changes, in order."""
+
+        for op, user_id, other_id in changes:
+            if op == FOLLOW:
+                self._following.setdefault(user_id, IntSet()).add(other_id)
+                self._followers.setdefault(other_id, IntSet()).add(user_id)
+
+            elif op == UNFOLLOW:
+                self._following.get(user_id, IntSet()).discard(other_id)
+                self._followers.get(other_id, IntSet()).discard(user_id)
+
+            elif op == REMOVE:
+                for followee_id in self._following.pop(user_id, ()):
+                    self._followers.get(followee_id, IntSet()).discard(
+                        user_id)
+                for follower_id in self._followers.pop(user_id, ()):
+                    self._following.get(follower_id, IntSet()).discard(
+                        user_id)
+
+
+def _adjacency(conn, key_column, value_column):
+    """Return {key: IntSet of values} from one ordered scan of follows."""
+
+    rows = conn.execute(select([key_column, value_column])
+                        .order_by(key_column, value_column))
+
+    return {key: IntSet.from_sorted(value for _, value in group)
+            for key, group in groupby(rows, key=itemgetter(0))}
+
+
+def get_graph():
+    """Return this process's FollowGraph, loading it if needed.
+
+    Returns None if FOLLOW_GRAPH is off. Once the graph has expired, one
+    request reloads it while the others carry on with the old one.
+    """
+
+    global _graph, _replay
+
+    config = db.get_app().config
+    if not config.get('FOLLOW_GRAPH', True):
+        return None
+
+    graph = _graph
+    ttl = config.get('FOLLOW_GRAPH_TTL', 300)
+
+    if graph is not None and time.monotonic() - graph.loaded_at < ttl:
+        return graph
+
+    if not _load_lock.acquire(blocking=graph is None):
+        return graph
+
+    try:
+        if _graph is not graph:
+            return _graph
+
+        # changes committed while loading may be missing from the load, so
+        # they're applied again afterwards
+        with _lock:
+            _replay = []
+
+        loaded = FollowGraph.load()
+
+        with _lock:
+            loaded.apply(_replay)
+            _graph, _replay = loaded, None
+
+        return loaded
+
+    finally:
+        _load_lock.release()
+
+
+def reset():
+    """Drop this process's graph; it's reloaded on next use."""
+
+    global _graph
+
+    with _lock:
+        _graph = None
+
+
+def _apply(changes):
+    """Apply committed changes to the graph, and to any load under way."""
+
+    with _lock:
+        if _graph is not None:
+            _graph.apply(changes)
+        if _replay is not None:
+            _replay.extend(changes)
+
+
+##############################################################################
+# Lookups
+
+
+def following_ids(user_id, changed_at=None):
+    """Return an IntSet of the ids `user_id` follows.
+
+    `changed_at` is when they last changed their follows, if known; a graph
+    loaded before then may not have the change, so the database is asked.
+    """
+
+    graph = get_graph()
+    if graph is not None and (changed_at is None
+                              or changed_at < graph.started_at):
+        return graph.following(user_id)
+
+    # followee_id is the user doing the following (see FollowersFollowee)
+    rows = (db.session
+            .query(FollowersFollowee.follower_id)
+            .filter(FollowersFollowee.followee_id == user_id)
+            .order_by(FollowersFollowee.follower_id))
+
+    return IntSet.from_sorted(followee_id for (followee_id,) in rows)
+
+
+def follower_ids(user_id):
+    """Return an IntSet of the ids following `user_id`."""
+
+    graph = get_graph()
+    if graph is not None:
+        return graph.followers(user_id)
+
+    # followee_id is the user doing the following (see FollowersFollowee)
+    rows = (db.session
+            .query(FollowersFollowee.followee_id)
+            .filter(FollowersFollowee.follower_id == user_id)
+            .order_by(FollowersFollowee.followee_id))
+
+    return IntSet.from_sorted(follower_id for (follower_id,) in rows)
+
+
+def is_following(user_id, other_id):
+    """Does `user_id` follow `other_id`?"""
+
+    return other_id in following_ids(user_id)
+
+
+def own_following_ids(user_id):
+    """Return an IntSet of the ids the request's own user, `user_id`,
+    follows, including follows they just made through another worker."""
+
+    changed_at = None
+    if has_request_context():
+        changed_at = flask_session.get(CHANGED_AT_KEY)
+
+    return following_ids(user_id, changed_at)
+
+
+def followed_by_followees(viewer_id, user_id):
+    """Return an IntSet of the users `viewer_id` follows who follow
+    `user_id`."""
+
+    return own_following_ids(viewer_id).intersection(follower_ids(user_id))
+
+
+##############################################################################
+# Keeping the graph up to date
+
+
+def mark_changed():
+    """Note in the browser's session that its user just changed their
+    follows, so their next pages see it (see `own_following_ids()`)."""
+
+    flask_session[CHANGED_AT_KEY] = time.time()
+
+
+def follow_changed(session, user_id, other_id, following):
+    """Record a follow written outside the ORM, applied once `session`
+    commits."""
+
+    session.info.setdefault(CHANGES_KEY, []).append(
+        (FOLLOW if following else UNFOLLOW, user_id, other_id))
+
+
+def _record(op, user, followee):
+    """Record a follow change made through User.following."""
+
+    session = object_session(user) or object_session(followee)
+    if session is not None:
+        session.info.setdefault(PENDING_KEY, []).append((op, user, followee))
+
+
+def _on_follow(user, followee, initiator):
+    _record(FOLLOW, user, followee)
+    return followee
+
+
+def _on_unfollow(user, followee, initiator):
+    _record(UNFOLLOW, user, followee)
+
+
+def _after_flush(session, flush_context):
+    """Turn recorded follows into ids, now new users have them."""
+
+    changes = session.info.setdefault(CHANGES_KEY, [])
+
+    for op, user, followee in session.info.pop(PENDING_KEY, ()):
+        changes.append((op, user.id, followee.id))
+
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            changes.append((REMOVE, obj.id, None))
+
+
+def _after_bulk_delete(delete_context):
+    entity = delete_context.query.column_descriptions[0]['entity']
+    if entity in (User, FollowersFollowee):
+        delete_context.session.info[RESET_KEY] = True
+
+
+def _after_commit(session):
+    changes = session.info.pop(CHANGES_KEY, ())
+
+    if session.info.pop(RESET_KEY, False):
+        reset()
+    elif changes:
+        _apply(changes)
+
+
+def _after_soft_rollback(session, previous_transaction):
+    for key in (PENDING_KEY, CHANGES_KEY, RESET_KEY):
+        session.info.pop(key, None)
+
+
+configure_mappers()
+
+event.listen(User.following, 'append', _on_follow, retval=True)
+event.listen(User.following, 'remove', _on_unfollow)
+event.listen(db.session, 'after_flush', _after_flush)
+event.listen(db.session, 'after_bulk_delete', _after_bulk_delete)
+event.listen(db.session, 'after_commit', _after_commit)
+event.listen(db.session, 'after_soft_rollback', _after_soft_rollback)
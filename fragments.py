@@ -0,0 +1,90 @@
+"""Cached HTML for the message list items shown in feeds.
+
+The same message `<li>` (templates/message.html) appears on many pages for
+many viewers. `render_message()` renders it once per message and version,
+caches the HTML on either side of the star's class, and only puts in the
+viewer's star state on the way out, so a full page of messages is mostly
+cache lookups.
+
+A fragment's key also holds a digest of the author fields it shows, so
+editing a username or avatar changes the key of every fragment by that
+author and the stale ones age out of the cache, and a digest of the
+template and the asset manifest, so a deploy that changes either starts
+afresh even with a shared (Redis) cache. Deleted messages are dropped with
+`invalidate()`.
+"""
+
+from hashlib import md5
+
+from flask import current_app, render_template
+from markupsafe import Markup
+
+from cache import make_cache
+from models import db
+import assets
+
+TEMPLATE = 'message.html'
+
+# rendered where the star's class goes; user text can't produce it, since
+# autoescaping turns any '<' in it into '&lt;'
+STAR_MARKER = Markup('<star>')
+
+_cache = None
+_template_version = None
+
+
+def get_cache():
+    """Return this process's fragment cache, creating it if needed."""
+
+    global _cache
+
+    if _cache is None:
+        config = db.get_app().config
+        _cache = make_cache(config, 'fragment',
+                            ttl=config.get('FRAGMENT_CACHE_TTL', 3600),
+                            max_size=config.get('FRAGMENT_CACHE_SIZE', 50000))
+
+    return _cache
+
+
+def template_version():
+    """Return a digest of the fragment template and the asset manifest."""
+
+    global _template_version
+
+    if _template_version is None:
+        env = current_app.jinja_env
+        source, _, _ = env.loader.get_source(env, TEMPLATE)
+        version = md5(f'{source}\0{assets.manifest_version()}'.encode())
+        _template_version = version.hexdigest()[:8]
+
+    return _template_version
+
+
+def fragment_key(msg):
+    """Return the cache key for `msg`'s list item as its author looks now."""
+
+    author = msg.user
+    version = md5(f'{author.username}\0{author.image_url}'.encode())
+
+    return f'{msg.id}:{template_version()}:{version.hexdigest()[:12]}'
+
+
+def render_message(msg, liked):
+    """Return the `<li>` for `msg`, with a solid star if `liked`."""
+
+    key = fragment_key(msg)
+    parts = get_cache().get(key)
+
+    if parts is None:
+        html = render_template(TEMPLATE, msg=msg, star=STAR_MARKER)
+        parts = html.split(STAR_MARKER)
+        get_cache().set(key, parts)
+
+    return Markup(('fas' if liked else 'far').join(parts))
+
+
+def invalidate(msg):
+    """Drop the cached list item for `msg`."""
+
+    get_cache().delete(fragment_key(msg))
@@ -2,27 +2,57 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load testing:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 50000000 --likes 20000000 --processes 8
+
+Rows are written as they're generated, so memory use stays flat however
+many are asked for. Followers, likes and message authors follow power-law
+(Zipf) distributions: a few users (the lowest ids) are followed, liked and
+posted by far more than the rest, and how many users each user follows or
+likes is heavy-tailed too.
+
+The work is split into fixed-size shards, each with its own random seed
+derived from --seed, and shards run in parallel across --processes. The
+output depends only on --seed, --end-date and the row counts, not on the
+number of processes. Nothing is fetched from the network.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import random
+import shutil
+from datetime import date, datetime
+from functools import lru_cache
+from multiprocessing import Pool
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import HEADER_IMAGE_URLS, ZipfSampler, get_random_datetime
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['followee_id', 'follower_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
+NUM_LIKES = 2000
+
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-fake = Faker()
+# how skewed popularity is (the Zipf exponent) and per-user activity is
+# (the Pareto shape; lower is more skewed)
+FOLLOW_SKEW = 1.0
+LIKE_SKEW = 1.0
+AUTHOR_SKEW = 0.8
+ACTIVITY_SHAPE = 2.0
+
+SHARD_SIZE = 50000
 
 # Generate random profile image URLs to use for users
 
@@ -32,46 +62,148 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+@lru_cache(maxsize=None)
+def zipf(n, s):
+    """Return a ZipfSampler over 1..n, built once per process."""
+
+    return ZipfSampler(n, s)
+
+
+def activity(rng, mean, most):
+    """Return a heavy-tailed count averaging about `mean`, at most `most`."""
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
+    scale = mean * (ACTIVITY_SHAPE - 1) / ACTIVITY_SHAPE
+    return min(most, round(rng.paretovariate(ACTIVITY_SHAPE) * scale))
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
+
+def write_users(writer, rng, fake, start, end, opts):
+    for user_id in range(start, end):
+        username = f"{fake.user_name()}_{user_id}"
+        writer.writerow(dict(
+            email=f"{username}@{fake.free_email_domain()}",
+            username=username,
+            image_url=rng.choice(image_urls),
+            password=PASSWORD,
             bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
+            header_image_url=rng.choice(HEADER_IMAGE_URLS),
             location=fake.city()
         ))
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
+def write_messages(writer, rng, fake, start, end, opts):
+    authors = zipf(opts.users, AUTHOR_SKEW)
+
+    for i in range(start, end):
+        writer.writerow(dict(
             text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
+            timestamp=get_random_datetime(rng=rng, now=opts.end_date),
+            user_id=authors.sample(rng)
         ))
 
-# Generate follows.csv from random pairings of users
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+def write_follows(writer, rng, fake, start, end, opts):
+    # "user follows other" is stored as followee_id=user, follower_id=other
+    # (see FollowersFollowee in models.py), so the popular users go in
+    # follower_id.
+    popular = zipf(opts.users, FOLLOW_SKEW)
+    mean = opts.follows / opts.users
+
+    for user_id in range(start, end):
+        k = activity(rng, mean, opts.users - 1)
+        for other_id in sorted(popular.sample_distinct(rng, k, user_id)):
+            writer.writerow(dict(followee_id=user_id, follower_id=other_id))
+
+
+def write_likes(writer, rng, fake, start, end, opts):
+    popular = zipf(opts.messages, LIKE_SKEW)
+    mean = opts.likes / opts.users
+
+    for user_id in range(start, end):
+        k = activity(rng, mean, opts.messages)
+        for message_id in sorted(popular.sample_distinct(rng, k)):
+            writer.writerow(dict(user_id=user_id, message_id=message_id))
+
+
+# name: (headers, writer, number of ids to shard over, given the options)
+FILES = {
+    'users': (USERS_CSV_HEADERS, write_users, lambda opts: opts.users),
+    'messages': (MESSAGES_CSV_HEADERS, write_messages,
+                 lambda opts: opts.messages),
+    'follows': (FOLLOWS_CSV_HEADERS, write_follows, lambda opts: opts.users),
+    'likes': (LIKES_CSV_HEADERS, write_likes, lambda opts: opts.users),
+}
+
+
+def write_shard(task):
+    """Write one shard of a file to its own part file; return its path."""
+
+    name, shard, start, end, opts = task
+    headers, write, _ = FILES[name]
+
+    # str seeds hash the same way in every process and run
+    seed = f"{opts.seed}:{name}:{shard}"
+    rng = random.Random(seed)
+    fake = Faker()
+    fake.seed_instance(seed)
+
+    path = os.path.join(opts.out_dir, f".{name}.{shard}.csv")
+    with open(path, 'w', newline='') as f:
+        write(csv.DictWriter(f, fieldnames=headers), rng, fake, start, end,
+              opts)
+
+    return path
+
+
+def shards(name, opts):
+    """Yield a task for each SHARD_SIZE ids of `name`'s file."""
+
+    _, _, count = FILES[name]
+    total = count(opts)
+
+    for shard, start in enumerate(range(1, total + 1, SHARD_SIZE)):
+        yield name, shard, start, min(start + SHARD_SIZE, total + 1), opts
+
+
+def generate(opts, pool):
+    """Write every file, its shards in parallel and joined in order."""
+
+    for name, (headers, _, _) in FILES.items():
+        path = os.path.join(opts.out_dir, f"{name}.csv")
+
+        with open(path, 'w', newline='') as out:
+            csv.DictWriter(out, fieldnames=headers).writeheader()
+
+            for part in pool.imap(write_shard, shards(name, opts)):
+                with open(part, newline='') as f:
+                    shutil.copyfileobj(f, out)
+                os.remove(part)
+
+        print(f"wrote {path}", flush=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS,
+                        help="roughly how many follows to generate")
+    parser.add_argument('--likes', type=int, default=NUM_LIKES,
+                        help="roughly how many likes to generate")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--end-date', type=date.fromisoformat,
+                        default=date.today(),
+                        help="messages are from the two years before this")
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--out-dir', default='generator')
+
+    opts = parser.parse_args()
+    opts.end_date = datetime.combine(opts.end_date, datetime.min.time())
+    return opts
+
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
+if __name__ == '__main__':
+    opts = parse_args()
 
-    for followee, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(followee_id=followee, follower_id=follower))
+    with Pool(opts.processes) as pool:
+        generate(opts, pool)
@@ -1,14 +1,106 @@
 """Support functions for CSV generation."""
 
+from array import array
+from bisect import bisect_left
 from datetime import datetime
+from itertools import accumulate
 from random import uniform
 
+# Header images from the splashbase API, kept here so generating data
+# doesn't need the network.
+SPLASHBASE_URL = 'https://splashbase.s3.amazonaws.com/unsplash/regular/'
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+HEADER_IMAGE_URLS = [SPLASHBASE_URL + name for name in [
+    'tumblr_mnh0n9pHJW1st5lhmo1_1280.jpg',
+    'tumblr_mnh0uemhCk1st5lhmo1_1280.jpg',
+    'tumblr_mnh121HEWa1st5lhmo1_1280.jpg',
+    'tumblr_mnh17lfd9R1st5lhmo1_1280.jpg',
+    'tumblr_mnh1d7s3UD1st5lhmo1_1280.jpg',
+    'tumblr_mnh1jdFvHR1st5lhmo1_1280.jpg',
+    'tumblr_mnh1uhYnog1st5lhmo1_1280.jpg',
+    'tumblr_mnh25vNOvI1st5lhmo1_1280.jpg',
+    'tumblr_mnh29fxz111st5lhmo1_1280.jpg',
+    'tumblr_mnh2m1hnS81st5lhmo1_1280.jpg',
+    'tumblr_mo1h6tGOZf1st5lhmo1_1280.jpg',
+    'tumblr_mo2wz2LTCs1st5lhmo1_1280.jpg',
+    'tumblr_mo2x3aAnRH1st5lhmo1_1280.jpg',
+    'tumblr_mo2x80NkDu1st5lhmo1_1280.jpg',
+    'tumblr_mo2x9xqeef1st5lhmo1_1280.jpg',
+    'tumblr_mo2xbk8JUK1st5lhmo1_1280.jpg',
+    'tumblr_mo2xdqmle51st5lhmo1_1280.jpg',
+    'tumblr_mo2xfarCvW1st5lhmo1_1280.jpg',
+    'tumblr_mo2xgqdEFn1st5lhmo1_1280.jpg',
+    'tumblr_mo2xijE2nr1st5lhmo1_1280.jpg',
+    'tumblr_mopq4kHmAg1st5lhmo1_1280.jpg',
+    'tumblr_mopq69jlcS1st5lhmo1_1280.jpg',
+    'tumblr_mopq8fyQwI1st5lhmo1_1280.jpg',
+    'tumblr_mopqamedKu1st5lhmo1_1280.jpg',
+    'tumblr_mopqc3ZZcz1st5lhmo1_1280.jpg',
+    'tumblr_mopqdfx05t1st5lhmo1_1280.jpg',
+    'tumblr_mopqfpSTPN1st5lhmo1_1280.jpg',
+    'tumblr_mopqhxFulr1st5lhmo1_1280.jpg',
+    'tumblr_mopqj9QUeq1st5lhmo1_1280.jpg',
+    'tumblr_mopqkkwK2M1st5lhmo1_1280.jpg',
+    'tumblr_mp6rzyNlAN1st5lhmo1_1280.jpg',
+    'tumblr_mp6s1hAudo1st5lhmo1_1280.jpg',
+    'tumblr_mp6s32zb6l1st5lhmo1_1280.jpg',
+    'tumblr_mp6s4dzqHA1st5lhmo1_1280.jpg',
+    'tumblr_mp6s661UgK1st5lhmo1_1280.jpg',
+    'tumblr_mp6s7lR1lS1st5lhmo1_1280.jpg',
+    'tumblr_mp6s995bvI1st5lhmo1_1280.jpg',
+    'tumblr_mp6sasSvPZ1st5lhmo1_1280.jpg',
+    'tumblr_mp6scv2xrZ1st5lhmo1_1280.jpg',
+    'tumblr_mpp6f50W261st5lhmo1_1280.jpg',
+    'tumblr_mpp6gwrYvm1st5lhmo1_1280.jpg',
+    'tumblr_mpp6l06zXi1st5lhmo1_1280.jpg',
+    'tumblr_mpp6poZxE51st5lhmo1_1280.jpg',
+    'tumblr_mpp6tjdFhf1st5lhmo1_1280.jpg',
+    'tumblr_mpp6w0dxAm1st5lhmo1_1280.jpg',
+]]
 
-    now = datetime.now()
+
+def get_random_datetime(year_gap=2, rng=None, now=None):
+    """Get a random datetime within the last few years.
+
+    Pass `rng` (a random.Random) and a fixed `now` for repeatable output.
+    """
+
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = (rng.uniform if rng else uniform)(then.timestamp(),
+                                                         now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+class ZipfSampler:
+    """Draw ids 1..n, id k with probability proportional to 1 / k**s.
+
+    Low ids are the popular ones: with s around 1, a handful of ids get
+    most draws and the long tail gets a few each, as with followers and
+    likes on a real site. Holds one 8-byte float per id.
+    """
+
+    def __init__(self, n, s=1.0):
+        self.n = n
+        self._cumulative = array('d', accumulate(1 / k ** s
+                                                 for k in range(1, n + 1)))
+
+    def sample(self, rng):
+        """Return one id, using `rng` (a random.Random)."""
+
+        x = rng.random() * self._cumulative[-1]
+        return min(bisect_left(self._cumulative, x), self.n - 1) + 1
+
+    def sample_distinct(self, rng, k, exclude=None):
+        """Return a set of `k` distinct ids, none equal to `exclude`."""
+
+        k = min(k, self.n - (exclude is not None))
+        ids = set()
+
+        while len(ids) < k:
+            id = self.sample(rng)
+            if id != exclude:
+                ids.add(id)
+
+        return ids
@@ -0,0 +1,48 @@
+"""gunicorn settings for Warbler.
+
+WEB_WORKER_CLASS picks how each worker process serves requests:
+
+- 'sync' (the default): one request at a time per process;
+- 'gevent': up to WEB_WORKER_CONNECTIONS requests per process, switching
+  between them whenever one waits on the network. psycopg2 is patched
+  with psycogreen so waiting on PostgreSQL yields too. Each request in
+  flight can hold a database connection, so raise DB_POOL_SIZE and
+  DB_MAX_OVERFLOW (or put pgbouncer in front of the database) to match.
+
+Password hashing runs in its own process pool (see passwords.py), which
+keeps bcrypt off the worker's CPU, but a sync worker still waits for the
+hash and serves nothing else meanwhile. Only a gevent worker (or asgi.py,
+which runs requests on a pool of ASGI_THREADS threads) goes on serving
+other requests while a hash is waited on.
+
+Each worker loads the follow graph (see follow_graph.py) before it takes
+its first request.
+
+Run it with:
+
+    gunicorn -c gunicorn.conf.py app:app
+
+For an ASGI server, see asgi.py.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'sync')
+worker_connections = int(os.environ.get('WEB_WORKER_CONNECTIONS', 100))
+
+
+def post_worker_init(worker):
+    """Make psycopg2 cooperate with gevent before any connection opens,
+    then warm the follow graph."""
+
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+    from app import app
+    import follow_graph
+
+    with app.app_context():
+        follow_graph.get_graph()
@@ -0,0 +1,114 @@
+"""HTTP caching policies and conditional GETs.
+
+Every response gets a Cache-Control header from `set_cache_headers()`:
+
+- fingerprinted static files (a content hash in the filename, like
+  `style.0123abcd.css`; see assets.py) never change, so browsers and
+  CDNs may keep them for a year without asking again;
+- other static files may be cached but are revalidated on each use,
+  against the ETag/Last-Modified that Flask's static route already sends;
+- pages are `private, no-cache`: a browser may keep a copy but must check
+  it with us before showing it, and shared caches must not store it.
+
+Pages whose content follows a few `updated_at` timestamps call
+`not_modified()` before doing any real work. It builds a weak ETag from
+those timestamps, the viewer and the URL, and returns a 304 response if
+the browser already has that version; otherwise the ETag is added to the
+page once it's rendered.
+"""
+
+import hashlib
+import os
+import re
+
+from flask import current_app, g, request, session
+
+import assets
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+ETAG_KEY = 'page_etag'
+
+_FINGERPRINTED = re.compile(r'\.[0-9a-f]{8,}\.\w+$')
+
+_template_version = None
+
+
+def template_version():
+    """Return a hash of the templates, so a deploy changes every ETag.
+
+    Pages also link assets by fingerprinted URL, so their ETags include
+    the asset manifest's version as well.
+    """
+
+    global _template_version
+
+    if _template_version is None:
+        digest = hashlib.md5()
+        folder = os.path.join(current_app.root_path,
+                              current_app.template_folder)
+
+        for root, dirs, files in sorted(os.walk(folder)):
+            dirs.sort()
+            for name in sorted(files):
+                with open(os.path.join(root, name), 'rb') as f:
+                    digest.update(name.encode())
+                    digest.update(f.read())
+
+        _template_version = digest.hexdigest()
+
+    return _template_version
+
+
+def page_etag(*parts):
+    """Return a weak ETag for this URL and viewer, varying with `parts`."""
+
+    viewer = g.get('user')
+    key = [template_version(), assets.manifest_version(), request.full_path,
+           viewer and viewer.id, viewer and viewer.updated_at, *parts]
+
+    return hashlib.md5(repr(key).encode()).hexdigest()
+
+
+def not_modified(*parts):
+    """Return a 304 response if the client's copy of this page is current.
+
+    `parts` are the values the page's content depends on, typically the
+    `updated_at` of the rows it shows; the viewer is always included.
+    Returns None when the page should be rendered.
+    """
+
+    # a pending flash message has to be rendered, and consumed, by a 200
+    if session.get('_flashes'):
+        return None
+
+    etag = page_etag(*parts)
+    g.setdefault(ETAG_KEY, etag)
+
+    if request.if_none_match.contains_weak(etag):
+        resp = current_app.response_class(status=304)
+        resp.set_etag(etag, weak=True)
+        resp.headers['Cache-Control'] = 'private, no-cache'
+        return resp
+
+    return None
+
+
+def set_cache_headers(resp):
+    """Apply the cache policy for this request's endpoint to `resp`."""
+
+    if request.endpoint == 'static':
+        if (resp.status_code in (200, 304)
+                and _FINGERPRINTED.search(request.path)):
+            resp.headers['Cache-Control'] = (
+                f'public, max-age={STATIC_MAX_AGE}, immutable')
+        else:
+            resp.headers['Cache-Control'] = 'public, no-cache'
+        return resp
+
+    etag = g.get(ETAG_KEY)
+    if etag is not None and resp.status_code == 200:
+        resp.set_etag(etag, weak=True)
+
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
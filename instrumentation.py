@@ -0,0 +1,140 @@
+"""Per-request SQL instrumentation for Warbler.
+
+Every statement the app's engines run is timed and recorded against the
+current Flask request: how many statements ran, how long they took in
+total, and how many repeated the same query shape (a likely N+1). app.py
+reports these in a Server-Timing header and logs routes that go over
+QUERY_BUDGET.
+
+Tests can count statements outside of a request with `count_queries()`,
+or mix in QueryCountAssertions to use `assertMaxQueries`.
+"""
+
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_QUERY_BUDGET = 20
+
+# collapse IN lists and runs of whitespace so "the same query" compares equal
+_IN_LIST = re.compile(r'\((?:\s*(?:\?|%\(\w+\)s|:\w+)\s*,?)+\)')
+_SPACE = re.compile(r'\s+')
+
+_recorders = []
+
+
+class QueryStats:
+    """Statements seen during one request or `count_queries()` block."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, duration):
+        """Record one statement that took `duration` seconds."""
+
+        self.count += 1
+        self.total_time += duration
+        self.shapes[query_shape(statement)] += 1
+
+    @property
+    def duplicates(self):
+        """Number of statements that repeated an earlier query shape."""
+
+        return sum(n - 1 for n in self.shapes.values() if n > 1)
+
+    def most_repeated(self):
+        """Return the (shape, count) that ran most often."""
+
+        return self.shapes.most_common(1)[0] if self.shapes else (None, 0)
+
+    def server_timing(self):
+        """Format these stats as a Server-Timing header value."""
+
+        return (f'db;dur={self.total_time * 1000:.2f};'
+                f'desc="{self.count} queries, {self.duplicates} duplicate"')
+
+
+def query_shape(statement):
+    """Normalize a SQL statement so repeats with different params match."""
+
+    return _SPACE.sub(' ', _IN_LIST.sub('(?)', statement)).strip()
+
+
+def start_request():
+    """Start recording statements for the current request."""
+
+    g.query_stats = QueryStats()
+
+
+def request_stats():
+    """Return the current request's QueryStats, or None outside one."""
+
+    return g.get('query_stats') if has_app_context() else None
+
+
+@contextmanager
+def count_queries():
+    """Record every statement run inside the block.
+
+        with count_queries() as stats:
+            client.get('/')
+        print(stats.count)
+    """
+
+    stats = QueryStats()
+    _recorders.append(stats)
+
+    try:
+        yield stats
+    finally:
+        _recorders.remove(stats)
+
+
+class QueryCountAssertions:
+    """TestCase mixin for asserting how many queries a block issues."""
+
+    @contextmanager
+    def assertMaxQueries(self, limit):
+        with count_queries() as stats:
+            yield stats
+
+        shape, times = stats.most_repeated()
+        self.assertLessEqual(
+            stats.count, limit,
+            f"{stats.count} queries issued, expected at most {limit}; "
+            f"most repeated ({times}x): {shape}")
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    duration = time.perf_counter() - conn.info['query_start_times'].pop()
+
+    stats = request_stats()
+    if stats is not None:
+        stats.record(statement, duration)
+
+    for recorder in _recorders:
+        recorder.record(statement, duration)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # after_cursor_execute won't run for a failed statement
+    if context.connection is not None:
+        start_times = context.connection.info.get('query_start_times')
+        if start_times:
+            start_times.pop()
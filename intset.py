@@ -0,0 +1,94 @@
+"""Compact sorted sets of ids.
+
+An IntSet keeps its ids in a sorted `array('I')`, 4 bytes per id instead
+of the ~60 a Python set spends, with O(log n) membership tests. Ids are
+database Integer primary keys, so they always fit in 32 bits.
+"""
+
+from array import array
+from bisect import bisect_left
+
+
+class IntSet:
+    """A sorted set of non-negative 32-bit ints."""
+
+    __slots__ = ('_ids',)
+
+    def __init__(self, ids=()):
+        self._ids = array('I', sorted(set(ids)))
+
+    @classmethod
+    def from_sorted(cls, ids):
+        """Build an IntSet from ids already sorted with no duplicates."""
+
+        intset = cls()
+        intset._ids = array('I', ids)
+        return intset
+
+    def __contains__(self, value):
+        i = bisect_left(self._ids, value)
+        return i < len(self._ids) and self._ids[i] == value
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __repr__(self):
+        return f"<IntSet of {len(self._ids)} ids>"
+
+    def add(self, value):
+        """Add `value` if it isn't already present."""
+
+        i = bisect_left(self._ids, value)
+        if i == len(self._ids) or self._ids[i] != value:
+            self._ids.insert(i, value)
+
+    def discard(self, value):
+        """Remove `value` if present."""
+
+        i = bisect_left(self._ids, value)
+        if i < len(self._ids) and self._ids[i] == value:
+            del self._ids[i]
+
+    def before(self, value, limit):
+        """Return up to `limit` ids less than `value`, largest first.
+
+        With `value` None, starts from the largest id.
+        """
+
+        end = len(self._ids)
+        if value is not None:
+            end = bisect_left(self._ids, value)
+
+        return self._ids[max(end - limit, 0):end].tolist()[::-1]
+
+    def intersection(self, other):
+        """Return a new IntSet of ids in both this set and `other`.
+
+        `other` may be an IntSet or any iterable of ints. Walks both sorted
+        arrays in step when `other` is an IntSet, otherwise tests each of
+        its values by bisection.
+        """
+
+        if not isinstance(other, IntSet):
+            return IntSet(value for value in other if value in self)
+
+        a, b = self._ids, other._ids
+        i = j = 0
+        common = array('I')
+
+        while i < len(a) and j < len(b):
+            if a[i] == b[j]:
+                common.append(a[i])
+                i += 1
+                j += 1
+            elif a[i] < b[j]:
+                i += 1
+            else:
+                j += 1
+
+        result = IntSet()
+        result._ids = common
+        return result
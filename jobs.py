@@ -0,0 +1,296 @@
+"""Background jobs, queued in the database.
+
+Work that doesn't have to finish before a response (timeline fan-out and
+backfill, deleting an account's data) is handed to `enqueue()` as a job
+kind and a JSON payload. The job row is inserted in the caller's
+transaction, so it's queued if and only if the request's own writes
+commit.
+
+`flask worker` runs jobs: it claims a batch of due jobs with
+`SELECT ... FOR UPDATE SKIP LOCKED`, so any number of workers can share
+the queue without waiting on each other, then runs each one in its own
+transaction, which also marks the job done. A job that raises is retried
+with exponential backoff until JOB_MAX_ATTEMPTS, then left as 'failed'
+for someone to look at. Jobs claimed by a worker that died are requeued
+after JOB_LOCK_TIMEOUT seconds.
+
+A handler may return True to say it did one chunk of a larger task; the
+job is then requeued to run again straight away, so long tasks commit as
+they go instead of holding locks in one huge transaction.
+
+Jobs enqueued with a `key` are idempotent: a second job with the same key
+is dropped while the first is still in the table.
+
+Per-write counter updates (counters.py) are not queued: each is one
+single-row UPDATE, no dearer than the job row that would replace it.
+
+With JOBS_EAGER (the default, and what the tests use) there is no queue:
+`enqueue()` runs the handler inline in the caller's transaction, chunked
+handlers included, so a single process behaves exactly as before. The
+Procfile turns it off for the web and worker processes, so in production
+jobs are queued.
+
+`flask job-stats` prints queue depth by state and the age of the oldest
+due job; workers also log them every JOB_STATS_INTERVAL seconds.
+"""
+
+import json
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+HANDLERS = {}
+
+jobs = db.Table(
+    'jobs',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('kind', db.Text, nullable=False),
+    db.Column('payload', db.Text, nullable=False),
+    db.Column('key', db.Text, unique=True),
+    db.Column('status', db.Text, nullable=False, default=QUEUED),
+    db.Column('attempts', db.Integer, nullable=False, default=0),
+    db.Column('run_at', db.DateTime, nullable=False,
+              default=datetime.utcnow),
+    db.Column('locked_at', db.DateTime),
+    db.Column('locked_by', db.Text),
+    db.Column('last_error', db.Text),
+    db.Column('created_at', db.DateTime, nullable=False,
+              default=datetime.utcnow),
+    db.Column('finished_at', db.DateTime),
+    db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+)
+
+
+def handler(kind):
+    """Register the decorated function as the handler for `kind` jobs."""
+
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+
+    return register
+
+
+def config(name, default):
+    """Return the app's `name` setting, or `default`."""
+
+    return current_app.config.get(name, default)
+
+
+##############################################################################
+# Queueing
+
+
+def enqueue(kind, key=None, **payload):
+    """Queue a `kind` job with `payload` in the current transaction.
+
+    Returns False if a job with the same `key` is already queued (or, in
+    eager mode, never).
+    """
+
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind!r}")
+
+    if config('JOBS_EAGER', True):
+        while HANDLERS[kind](**payload):
+            pass
+        return True
+
+    values = {'kind': kind, 'payload': json.dumps(payload), 'key': key,
+              'status': QUEUED, 'attempts': 0,
+              'run_at': datetime.utcnow(), 'created_at': datetime.utcnow()}
+
+    if db.session.bind.dialect.name == 'postgresql':
+        stmt = (postgresql.insert(jobs).values(values)
+                .on_conflict_do_nothing(index_elements=['key']))
+    else:
+        stmt = jobs.insert().prefix_with('OR IGNORE').values(values)
+
+    return db.session.execute(stmt).rowcount > 0
+
+
+##############################################################################
+# Running
+
+
+def requeue_stale():
+    """Requeue jobs whose worker stopped without finishing them."""
+
+    cutoff = datetime.utcnow() - timedelta(
+        seconds=config('JOB_LOCK_TIMEOUT', 300))
+
+    result = db.session.execute(
+        jobs.update()
+        .where((jobs.c.status == RUNNING) & (jobs.c.locked_at < cutoff))
+        .values(status=QUEUED, locked_at=None, locked_by=None))
+    db.session.commit()
+
+    return result.rowcount
+
+
+def claim(worker_id, limit):
+    """Mark up to `limit` due jobs as running by `worker_id`; return them."""
+
+    now = datetime.utcnow()
+
+    due = (select([jobs.c.id])
+           .where((jobs.c.status == QUEUED) & (jobs.c.run_at <= now))
+           .order_by(jobs.c.run_at, jobs.c.id)
+           .limit(limit)
+           .with_for_update(skip_locked=True))
+
+    ids = [job_id for (job_id,) in db.session.execute(due)]
+    claimed = []
+
+    # without SKIP LOCKED (SQLite) another worker may have got there first
+    for job_id in ids:
+        result = db.session.execute(
+            jobs.update()
+            .where((jobs.c.id == job_id) & (jobs.c.status == QUEUED))
+            .values(status=RUNNING, locked_at=now, locked_by=worker_id,
+                    attempts=jobs.c.attempts + 1))
+        if result.rowcount:
+            claimed.append(job_id)
+
+    rows = []
+    if claimed:
+        rows = db.session.execute(
+            jobs.select().where(jobs.c.id.in_(claimed))
+            .order_by(jobs.c.run_at, jobs.c.id)).fetchall()
+
+    db.session.commit()
+    return rows
+
+
+def run(job):
+    """Run a claimed job, then mark it done, requeued or failed."""
+
+    try:
+        more = HANDLERS[job.kind](**json.loads(job.payload))
+    except Exception as exc:
+        db.session.rollback()
+        logger.exception("Job %s (%s) failed", job.id, job.kind)
+
+        if job.attempts >= config('JOB_MAX_ATTEMPTS', 5):
+            values = {'status': FAILED, 'finished_at': datetime.utcnow()}
+        else:
+            delay = config('JOB_RETRY_DELAY', 5) * 2 ** (job.attempts - 1)
+            values = {'status': QUEUED,
+                      'run_at': datetime.utcnow() + timedelta(seconds=delay)}
+
+        db.session.execute(jobs.update().where(jobs.c.id == job.id).values(
+            locked_at=None, locked_by=None, last_error=repr(exc), **values))
+        db.session.commit()
+        return False
+
+    if more:
+        values = {'status': QUEUED, 'attempts': 0,
+                  'run_at': datetime.utcnow()}
+    else:
+        values = {'status': DONE, 'finished_at': datetime.utcnow()}
+
+    db.session.execute(jobs.update().where(jobs.c.id == job.id).values(
+        locked_at=None, locked_by=None, **values))
+    db.session.commit()
+    return True
+
+
+def work_once(worker_id=None, limit=None):
+    """Claim and run one batch of due jobs; return how many ran."""
+
+    worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+    batch = claim(worker_id, limit or config('JOB_BATCH_SIZE', 10))
+
+    for job in batch:
+        run(job)
+
+    return len(batch)
+
+
+def work(worker_id=None):
+    """Run jobs until interrupted, sleeping when the queue is empty."""
+
+    worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+    interval = config('JOB_POLL_INTERVAL', 1.0)
+    stats_interval = config('JOB_STATS_INTERVAL', 60)
+    next_stats = 0
+
+    logger.info("Worker %s started", worker_id)
+
+    while True:
+        if time.monotonic() >= next_stats:
+            requeue_stale()
+            purge_finished()
+            logger.info("Job queue: %s", json.dumps(queue_stats()))
+            next_stats = time.monotonic() + stats_interval
+
+        if not work_once(worker_id):
+            time.sleep(interval)
+
+
+def purge_finished():
+    """Delete done jobs older than JOB_RETENTION seconds."""
+
+    cutoff = datetime.utcnow() - timedelta(
+        seconds=config('JOB_RETENTION', 86400))
+
+    result = db.session.execute(jobs.delete().where(
+        (jobs.c.status == DONE) & (jobs.c.finished_at < cutoff)))
+    db.session.commit()
+
+    return result.rowcount
+
+
+##############################################################################
+# Metrics
+
+
+def queue_stats():
+    """Return job counts by status and the oldest due job's age in seconds."""
+
+    stats = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED)}
+    for status, count in db.session.execute(
+            select([jobs.c.status, func.count()]).group_by(jobs.c.status)):
+        stats[status] = count
+
+    oldest = db.session.execute(
+        select([func.min(jobs.c.run_at)])
+        .where((jobs.c.status == QUEUED)
+               & (jobs.c.run_at <= datetime.utcnow()))).scalar()
+    stats['oldest_due_seconds'] = (
+        round((datetime.utcnow() - oldest).total_seconds(), 1)
+        if oldest else 0)
+
+    return stats
+
+
+def init_app(app):
+    """Add the `flask worker` and `flask job-stats` commands."""
+
+    @app.cli.command('worker')
+    def worker():
+        """Run queued background jobs until interrupted."""
+
+        logging.basicConfig(level=logging.INFO)
+        work()
+
+    @app.cli.command('job-stats')
+    def job_stats():
+        """Print the job queue's depth as JSON."""
+
+        print(json.dumps(queue_stats(), indent=2))
@@ -0,0 +1,236 @@
+"""Which messages has a user liked?
+
+Pages only need to know which of the messages they show the viewer has
+liked. `liked_ids()` answers that from a per-user cached IntSet of every
+message id the user liked, loaded with one id-only query the first time
+it's needed and updated in place as the user likes and unlikes. Users
+with more than LIKED_IDS_CACHE_MAX_LIKES likes aren't cached; for them a
+query scoped to the page's message ids is run instead.
+
+The cache is per process, so another worker's cached set can miss a like
+until its entry expires after LIKED_IDS_CACHE_TTL seconds.
+
+Likes are written by `like()` and `unlike()`: one idempotent INSERT or
+DELETE on the likes table each, without loading either side's
+relationships, so liking twice or unliking something not liked is a
+no-op rather than an error. With LIKE_WRITE_BEHIND on, the toggle route
+hands them to a LikeBuffer instead, which keeps only the latest state per
+(user, message) and writes them in batches.
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+from sqlalchemy import literal, select
+from sqlalchemy.dialects import postgresql
+
+from cache import MemoryCache
+from intset import IntSet
+from models import db, Like, Message
+import counters
+
+logger = logging.getLogger(__name__)
+
+likes_table = Like.__table__
+messages_table = Message.__table__
+
+_cache = None
+
+
+def get_cache():
+    """Return this process's liked-id cache, creating it if needed."""
+
+    global _cache
+
+    if _cache is None:
+        config = db.get_app().config
+        _cache = MemoryCache(
+            max_size=config.get('LIKED_IDS_CACHE_SIZE', 10000),
+            ttl=config.get('LIKED_IDS_CACHE_TTL', 300))
+
+    return _cache
+
+
+def load_liked_ids(user_id):
+    """Return an IntSet of every message id `user_id` has liked."""
+
+    rows = (db.session
+            .query(Like.message_id)
+            .filter(Like.user_id == user_id)
+            .order_by(Like.message_id))
+
+    return IntSet.from_sorted(message_id for (message_id,) in rows)
+
+
+def liked_ids(user, message_ids):
+    """Return the set of `message_ids` that `user` has liked."""
+
+    message_ids = list(message_ids)
+
+    if not user or not message_ids:
+        return set()
+
+    cached = get_cache().get(user.id)
+
+    if cached is None:
+        max_likes = db.get_app().config.get('LIKED_IDS_CACHE_MAX_LIKES', 10000)
+
+        if user.likes_count > max_likes:
+            rows = (db.session
+                    .query(Like.message_id)
+                    .filter(Like.user_id == user.id,
+                            Like.message_id.in_(message_ids)))
+            return {message_id for (message_id,) in rows}
+
+        cached = load_liked_ids(user.id)
+        get_cache().set(user.id, cached)
+
+    return {message_id for message_id in message_ids if message_id in cached}
+
+
+def record_like(user_id, message_id):
+    """Add a new like to `user_id`'s cached set, if it is cached."""
+
+    cached = get_cache().get(user_id)
+    if cached is not None:
+        cached.add(message_id)
+
+
+def record_unlike(user_id, message_id):
+    """Remove a like from `user_id`'s cached set, if it is cached."""
+
+    cached = get_cache().get(user_id)
+    if cached is not None:
+        cached.discard(message_id)
+
+
+##############################################################################
+# Writing likes
+
+
+def like(user_id, message_id):
+    """Like `message_id` as `user_id` in the current transaction.
+
+    Returns True if a like was added, False if it already existed or the
+    message doesn't exist.
+    """
+
+    # selecting the message id skips the insert for a missing message
+    rows = select([literal(user_id), messages_table.c.id]).where(
+        messages_table.c.id == message_id)
+
+    if db.session.bind.dialect.name == 'postgresql':
+        stmt = (postgresql.insert(likes_table)
+                .from_select(['user_id', 'message_id'], rows)
+                .on_conflict_do_nothing())
+    else:
+        stmt = (likes_table.insert()
+                .prefix_with('OR IGNORE')
+                .from_select(['user_id', 'message_id'], rows))
+
+    added = db.session.execute(stmt).rowcount > 0
+
+    if added:
+        counters.like_changed(db.session, user_id, message_id, 1)
+
+    return added
+
+
+def unlike(user_id, message_id):
+    """Remove `user_id`'s like of `message_id`, if any, as `like()` does."""
+
+    removed = db.session.execute(
+        likes_table.delete().where((likes_table.c.user_id == user_id) &
+                                   (likes_table.c.message_id == message_id))
+    ).rowcount > 0
+
+    if removed:
+        counters.like_changed(db.session, user_id, message_id, -1)
+
+    return removed
+
+
+class LikeBuffer:
+    """Coalesces like/unlike writes and applies them in batches.
+
+    `set()` records the state a (user, message) pair should end up in,
+    replacing any earlier unwritten state for the pair, so a burst of
+    toggles costs at most one write. Pending states are written by a
+    background thread `interval` seconds after the first one arrives, or
+    as soon as `max_size` pairs are waiting.
+
+    Pending writes live only in this process's memory and are lost if it
+    dies before they're flushed.
+    """
+
+    def __init__(self, app, max_size=500, interval=1.0):
+        self.app = app
+        self.max_size = max_size
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def set(self, user_id, message_id, liked):
+        """Record that `user_id` should end up liking `message_id` or not."""
+
+        with self._lock:
+            self._pending[(user_id, message_id)] = liked
+
+            if len(self._pending) >= self.max_size:
+                threading.Thread(target=self.flush, daemon=True).start()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Write every pending state in one transaction."""
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        if not pending:
+            return
+
+        start = time.perf_counter()
+
+        with self.app.app_context():
+            try:
+                for (user_id, message_id), liked in pending.items():
+                    if liked:
+                        like(user_id, message_id)
+                    else:
+                        unlike(user_id, message_id)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                logger.exception("Dropped %d buffered likes", len(pending))
+                return
+
+        logger.debug("Wrote %d buffered likes in %.1fms", len(pending),
+                     (time.perf_counter() - start) * 1000)
+
+
+_buffer = None
+
+
+def get_buffer():
+    """Return this process's LikeBuffer, creating it if needed."""
+
+    global _buffer
+
+    if _buffer is None:
+        app = db.get_app()
+        _buffer = LikeBuffer(app,
+                             max_size=app.config.get('LIKE_BUFFER_SIZE', 500),
+                             interval=app.config.get('LIKE_BUFFER_INTERVAL',
+                                                     1.0))
+        atexit.register(_buffer.flush)
+
+    return _buffer
@@ -0,0 +1,224 @@
+"""Bulk loading of the generator/*.csv files.
+
+`load()` streams each CSV into its table in batches of `batch_size` rows,
+so memory use doesn't grow with the file. On PostgreSQL each batch is
+sent with `COPY ... FROM STDIN`; other databases get one executemany
+INSERT per batch.
+
+Secondary indexes on the loaded tables are dropped before the first
+batch and rebuilt once every file is in, which is much faster than
+maintaining them row by row. Primary keys and unique indexes stay, since
+they enforce constraints.
+
+The files have no id column; other files refer to users and messages by
+their line number. So rather than take ids from the sequences, which a
+failed batch would use up and shift every later id, row N of a file is
+loaded with id N, and each table's sequence is moved past the largest id
+once the load is done.
+
+Each batch commits together with the count of rows loaded so far from
+its file (the `seed_progress` table), and dropped index definitions are
+saved in `seed_indexes` until they're rebuilt. So after a failure,
+`load(..., resume=True)` skips what's already loaded and carries on.
+"""
+
+import csv
+import io
+import os
+import time
+from datetime import datetime
+from itertools import islice
+
+from models import db
+
+DEFAULT_BATCH_SIZE = 10000
+
+# (table, file) in load order; files that don't exist are skipped
+FILES = [
+    ('users', 'users.csv'),
+    ('messages', 'messages.csv'),
+    ('follows', 'follows.csv'),
+    ('likes', 'likes.csv'),
+]
+
+seed_progress = db.Table(
+    'seed_progress',
+    db.Column('file', db.Text, primary_key=True),
+    db.Column('rows_loaded', db.Integer, nullable=False),
+)
+
+seed_indexes = db.Table(
+    'seed_indexes',
+    db.Column('name', db.Text, primary_key=True),
+    db.Column('definition', db.Text, nullable=False),
+)
+
+
+def load(data_dir='generator', batch_size=DEFAULT_BATCH_SIZE, resume=False,
+         engine=None):
+    """Load every CSV in `data_dir` that has a table in FILES.
+
+    Without `resume`, any progress left by an earlier run is forgotten and
+    every file is loaded from its first row.
+    """
+
+    engine = engine or db.engine
+    seed_progress.create(engine, checkfirst=True)
+    seed_indexes.create(engine, checkfirst=True)
+
+    if not resume:
+        with engine.begin() as conn:
+            conn.execute(seed_progress.delete())
+            rebuild_indexes(conn)
+
+    files = [(db.metadata.tables[table], os.path.join(data_dir, filename))
+             for table, filename in FILES
+             if os.path.exists(os.path.join(data_dir, filename))]
+
+    with engine.begin() as conn:
+        for table, path in files:
+            drop_indexes(conn, table.name)
+
+    for table, path in files:
+        load_file(engine, table, path, batch_size)
+
+    with engine.begin() as conn:
+        for table, path in files:
+            reset_sequence(conn, table)
+        rebuild_indexes(conn)
+
+
+def load_file(engine, table, path, batch_size=DEFAULT_BATCH_SIZE):
+    """Stream the CSV at `path` into `table`, picking up where it left off."""
+
+    with engine.connect() as conn:
+        done = conn.execute(
+            db.select([seed_progress.c.rows_loaded])
+            .where(seed_progress.c.file == path)).scalar() or 0
+
+    start = time.perf_counter()
+    loaded = 0
+
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+        rows = islice(reader, done, None)
+
+        if 'id' in table.c and 'id' not in columns:
+            columns = ['id'] + columns
+            rows = ([str(n)] + row for n, row in enumerate(rows, done + 1))
+
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+
+            with engine.begin() as conn:
+                insert_batch(conn, table, columns, batch)
+                save_progress(conn, path, done + loaded + len(batch))
+
+            loaded += len(batch)
+            rate = loaded / (time.perf_counter() - start)
+            print(f"{table.name}: {done + loaded:,} rows "
+                  f"({rate:,.0f} rows/sec)", flush=True)
+
+
+def insert_batch(conn, table, columns, rows):
+    """Insert `rows` (lists of CSV strings, in `columns` order) into `table`.
+
+    Empty strings are loaded as NULL either way, as COPY does.
+    """
+
+    if conn.dialect.name == 'postgresql':
+        buf = io.StringIO()
+        csv.writer(buf).writerows(rows)
+        buf.seek(0)
+
+        cursor = conn.connection.cursor()
+        cursor.copy_expert(f'COPY {table.name} ({", ".join(columns)}) '
+                           f'FROM STDIN WITH (FORMAT csv)', buf)
+        return
+
+    convert = [converter(table.c[column]) for column in columns]
+    conn.execute(table.insert(), [
+        {column: fn(value) if value != '' else None
+         for column, fn, value in zip(columns, convert, row)}
+        for row in rows
+    ])
+
+
+def converter(column):
+    """Return a function turning a CSV string into `column`'s Python type."""
+
+    if isinstance(column.type, db.DateTime):
+        return datetime.fromisoformat
+    if isinstance(column.type, db.Integer):
+        return int
+    if isinstance(column.type, db.Float):
+        return float
+    return str
+
+
+def reset_sequence(conn, table):
+    """Make `table`'s id sequence continue after its largest id."""
+
+    if conn.dialect.name != 'postgresql' or 'id' not in table.c:
+        return
+
+    # on other databases a new row already gets the largest id + 1
+    conn.execute(db.text(
+        f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+        f"coalesce(max(id), 1), max(id) IS NOT NULL) FROM {table.name}"))
+
+
+def save_progress(conn, path, rows_loaded):
+    """Record that the first `rows_loaded` rows of `path` are in."""
+
+    updated = conn.execute(seed_progress.update()
+                           .where(seed_progress.c.file == path)
+                           .values(rows_loaded=rows_loaded)).rowcount
+    if not updated:
+        conn.execute(seed_progress.insert().values(file=path,
+                                                   rows_loaded=rows_loaded))
+
+
+##############################################################################
+# Dropping and rebuilding secondary indexes
+
+
+def secondary_indexes(conn, table):
+    """Return (name, CREATE INDEX statement) for `table`'s droppable indexes."""
+
+    if conn.dialect.name == 'postgresql':
+        sql = """SELECT i.relname, pg_get_indexdef(i.oid)
+                 FROM pg_index x
+                 JOIN pg_class i ON i.oid = x.indexrelid
+                 JOIN pg_class t ON t.oid = x.indrelid
+                 WHERE t.relname = :table
+                   AND NOT x.indisprimary AND NOT x.indisunique"""
+    else:
+        sql = """SELECT name, sql FROM sqlite_master
+                 WHERE type = 'index' AND tbl_name = :table
+                   AND sql IS NOT NULL
+                   AND upper(sql) NOT LIKE 'CREATE UNIQUE%'"""
+
+    return list(conn.execute(db.text(sql), table=table))
+
+
+def drop_indexes(conn, table):
+    """Drop `table`'s secondary indexes, saving how to rebuild them."""
+
+    for name, definition in secondary_indexes(conn, table):
+        conn.execute(seed_indexes.delete().where(seed_indexes.c.name == name))
+        conn.execute(seed_indexes.insert().values(name=name,
+                                                  definition=definition))
+        conn.execute(f'DROP INDEX {name}')
+
+
+def rebuild_indexes(conn):
+    """Recreate every index `drop_indexes()` dropped."""
+
+    for name, definition in conn.execute(db.select([seed_indexes])).fetchall():
+        print(f"rebuilding index {name}", flush=True)
+        conn.execute(definition)
+        conn.execute(seed_indexes.delete().where(seed_indexes.c.name == name))
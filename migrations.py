@@ -0,0 +1,270 @@
+"""Schema migrations for Warbler.
+
+`db.create_all()` only creates missing tables, so changes to existing
+tables (new indexes, columns, extensions) are applied here. `upgrade()`
+creates any missing tables, then runs each pending migration: a function
+that gets a connection inside a transaction, and is recorded in the
+`schema_migrations` table once it has run.
+
+Migrations must be safe to run against a database that `create_all()` just
+built from the current models, since seed.py and the tests do exactly that
+before calling `upgrade()`. Once released they are frozen: they use SQL of
+their own rather than application code that may change later.
+
+Run them with:
+
+    FLASK_APP=app flask upgrade-db
+
+or set AUTO_MIGRATE in the app config to run them from connect_db().
+"""
+
+from datetime import datetime
+
+from sqlalchemy import inspect
+
+from models import db
+
+MIGRATIONS = []
+
+schema_migrations = db.Table(
+    'schema_migrations',
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('name', db.Text, nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False),
+)
+
+
+def migration(version):
+    """Register the decorated function as migration number `version`."""
+
+    def register(fn):
+        MIGRATIONS.append((version, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+
+    return register
+
+
+def applied_versions(conn):
+    """Return the set of migration versions already applied."""
+
+    return {version for (version,)
+            in conn.execute(db.select([schema_migrations.c.version]))}
+
+
+def upgrade(engine=None):
+    """Create missing tables, then apply every pending migration.
+
+    Each migration runs in its own transaction.
+    """
+
+    engine = engine or db.engine
+    db.metadata.create_all(engine)
+
+    with engine.connect() as conn:
+        done = applied_versions(conn)
+
+    for version, fn in MIGRATIONS:
+        if version in done:
+            continue
+
+        with engine.begin() as conn:
+            fn(conn)
+            conn.execute(schema_migrations.insert().values(
+                version=version,
+                name=fn.__name__,
+                applied_at=datetime.utcnow()))
+
+
+##############################################################################
+# Helpers for writing migrations
+
+
+def create_index(conn, name, table, columns, postgresql_using=None):
+    """Create an index unless one with that name already exists.
+
+    `columns` is raw SQL, so it may hold sort orders or expressions.
+    """
+
+    using = ''
+    if postgresql_using and conn.dialect.name == 'postgresql':
+        using = f' USING {postgresql_using}'
+
+    conn.execute(
+        f'CREATE INDEX IF NOT EXISTS {name} ON {table}{using} ({columns})')
+
+
+def has_column(conn, table, column):
+    """Does `table` already have `column`?"""
+
+    return column in {c['name'] for c in inspect(conn).get_columns(table)}
+
+
+def index_definition(conn, name):
+    """Return the CREATE INDEX statement for index `name`, or None."""
+
+    if conn.dialect.name == 'postgresql':
+        sql = 'SELECT indexdef FROM pg_indexes WHERE indexname = :name'
+    else:
+        sql = ("SELECT sql FROM sqlite_master "
+               "WHERE type = 'index' AND name = :name")
+
+    return conn.execute(db.text(sql), name=name).scalar()
+
+
+##############################################################################
+# Query plan checks
+
+
+def query_plan(query):
+    """Return the database's plan for an ORM query as a single string."""
+
+    conn = db.session.connection()
+    compiled = query.statement.compile(dialect=conn.dialect)
+
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    else:
+        params = compiled.params
+
+    if conn.dialect.name == 'sqlite':
+        sql = f'EXPLAIN QUERY PLAN {compiled}'
+    else:
+        sql = f'EXPLAIN {compiled}'
+
+    return '\n'.join(' '.join(str(col) for col in row)
+                     for row in conn.execute(sql, params))
+
+
+def uses_index(query, index_name):
+    """Does the plan for `query` use the index named `index_name`?"""
+
+    return index_name in query_plan(query)
+
+
+##############################################################################
+# Migrations
+
+
+@migration(1)
+def add_hot_path_indexes(conn):
+    """Index the columns behind feeds, reverse follows/likes and search."""
+
+    create_index(conn, 'ix_messages_user_id_timestamp', 'messages',
+                 'user_id, timestamp DESC, id DESC')
+    create_index(conn, 'ix_follows_follower_id_followee_id', 'follows',
+                 'follower_id, followee_id')
+    create_index(conn, 'ix_likes_message_id_user_id', 'likes',
+                 'message_id, user_id')
+
+    # lets `username LIKE '%q%'` use an index instead of scanning users
+    if conn.dialect.name == 'postgresql':
+        conn.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        create_index(conn, 'ix_users_username_trgm', 'users',
+                     'username gin_trgm_ops', postgresql_using='gin')
+
+
+@migration(2)
+def add_counter_columns(conn):
+    """Add denormalized counters to users and messages and fill them in."""
+
+    for table, column in (('users', 'message_count'),
+                          ('users', 'following_count'),
+                          ('users', 'follower_count'),
+                          ('users', 'likes_count'),
+                          ('messages', 'like_count')):
+        if not has_column(conn, table, column):
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} '
+                         f'INTEGER NOT NULL DEFAULT 0')
+
+    # followee_id is the user doing the following (see FollowersFollowee)
+    conn.execute("""
+        UPDATE users SET
+            message_count = (SELECT count(*) FROM messages
+                             WHERE messages.user_id = users.id),
+            following_count = (SELECT count(*) FROM follows
+                               WHERE follows.followee_id = users.id),
+            follower_count = (SELECT count(*) FROM follows
+                              WHERE follows.follower_id = users.id),
+            likes_count = (SELECT count(*) FROM likes
+                           WHERE likes.user_id = users.id)
+    """)
+    conn.execute("""
+        UPDATE messages SET
+            like_count = (SELECT count(*) FROM likes
+                          WHERE likes.message_id = messages.id)
+    """)
+
+
+@migration(3)
+def add_message_search(conn):
+    """Index message text for /search, and usernames for prefix matches.
+
+    Other databases search with search.py's in-process index instead.
+    """
+
+    if conn.dialect.name != 'postgresql':
+        return
+
+    if not has_column(conn, 'messages', 'search_vector'):
+        conn.execute("ALTER TABLE messages ADD COLUMN search_vector tsvector "
+                     "GENERATED ALWAYS AS (to_tsvector('english', text)) "
+                     "STORED")
+
+    create_index(conn, 'ix_messages_search_vector', 'messages',
+                 'search_vector', postgresql_using='gin')
+
+    # the unique index on username can't serve LIKE 'q%' outside the C locale
+    create_index(conn, 'ix_users_username_prefix', 'users',
+                 'username text_pattern_ops')
+
+
+@migration(4)
+def add_updated_at(conn):
+    """Add the updated_at timestamps that page ETags are built from."""
+
+    for table in ('users', 'messages'):
+        if has_column(conn, table, 'updated_at'):
+            continue
+
+        # SQLite can't add a column with a non-constant default
+        if conn.dialect.name == 'postgresql':
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN updated_at '
+                         f'TIMESTAMP NOT NULL DEFAULT now()')
+        else:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN updated_at '
+                         f'TIMESTAMP')
+            conn.execute(f'UPDATE {table} SET updated_at = CURRENT_TIMESTAMP')
+
+
+@migration(5)
+def add_timeline_message_index(conn):
+    """Index timeline entries by message, for deleting a user's messages."""
+
+    create_index(conn, 'ix_timelines_message_id', 'timelines', 'message_id')
+
+
+@migration(6)
+def add_deleted_at(conn):
+    """Add the flag that hides users whose accounts are being deleted."""
+
+    if not has_column(conn, 'users', 'deleted_at'):
+        conn.execute('ALTER TABLE users ADD COLUMN deleted_at TIMESTAMP')
+
+
+@migration(7)
+def redefine_timeline_index(conn):
+    """Rebuild the timelines index made before it covered message_id.
+
+    `create_all()` leaves an existing index alone, so databases from before
+    it was redefined kept the old (user_id, timestamp) one.
+    """
+
+    definition = index_definition(conn, 'ix_timelines_user_id_timestamp')
+
+    if definition and 'message_id' in definition:
+        return
+
+    conn.execute('DROP INDEX IF EXISTS ix_timelines_user_id_timestamp')
+    conn.execute('CREATE INDEX ix_timelines_user_id_timestamp ON timelines '
+                 '(user_id, timestamp DESC, message_id DESC)')
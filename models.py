@@ -2,15 +2,21 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from passwords import PasswordHasher
+import replicas
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+hasher = PasswordHasher()
+db = replicas.RoutingSQLAlchemy()
 
 
 class FollowersFollowee(db.Model):
-    """Connection of a follower <-> followee."""
+    """Connection of a follower <-> followee.
+
+    The column names are swapped relative to the relationships on User:
+    `user.following.append(other)` stores followee_id=user.id and
+    follower_id=other.id. Raw queries against this table must treat
+    `followee_id` as the user doing the following.
+    """
 
     __tablename__ = 'follows'
 
@@ -26,6 +32,12 @@ class FollowersFollowee(db.Model):
         primary_key=True,
     )
 
+    # the primary key covers lookups by followee_id; this covers the reverse
+    __table_args__ = (
+        db.Index('ix_follows_follower_id_followee_id',
+                 follower_id, followee_id),
+    )
+
 
 class Like(db.Model):
     """Represents likes by connecting a user to a message that they liked"""
@@ -44,6 +56,11 @@ class Like(db.Model):
         primary_key=True,
     )
 
+    # the primary key covers lookups by user_id; this covers the reverse
+    __table_args__ = (
+        db.Index('ix_likes_message_id_user_id', message_id, user_id),
+    )
+
 
 class User(db.Model):
     """User in the system."""
@@ -90,7 +107,57 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', backref='user', lazy='dynamic')
+    # denormalized counts, maintained by counters.py
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # bumped by any change to the row, counters included; pages showing the
+    # user revalidate against it (see http_cache.py)
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        server_default=db.func.now(),
+    )
+
+    # set when the user deletes their account, which hides them until the
+    # 'delete_user' job removes the row (see deletion.py)
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # leave deleting a user's messages to the ON DELETE CASCADE rather than
+    # having the ORM load them and null out their user_id
+    messages = db.relationship('Message',
+                               backref='user',
+                               lazy='dynamic',
+                               passive_deletes=True)
 
     followers = db.relationship(
         "User",
@@ -113,19 +180,19 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        return bool(self.followers.filter_by(id=other_user.id).first())
+        import follow_graph
+        return follow_graph.is_following(other_user.id, self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        return bool(self.following.filter_by(id=other_user.id).first())
+        import follow_graph
+        return follow_graph.is_following(self.id, other_user.id)
 
-    # this will run a sql query with each call
-    # use a count query instead
     def get_number_of_likes(self):
         """Return the number of messages this user has liked."""
-        
-        return len(self.messages_liked)
+
+        return self.likes_count
 
     @classmethod
     def signup(cls, username, email, password, image_url=None):
@@ -134,7 +201,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash_password(password)
 
         user = User(
             username=username.lower(),
@@ -149,7 +216,7 @@ class User(db.Model):
 
     def verify_password(self, password):
         """Verify that the user-entered password against the hashed password"""
-        return bcrypt.check_password_hash(self.password, password)
+        return hasher.check_password(self.password, password)
 
 
     @classmethod
@@ -160,12 +227,20 @@ class User(db.Model):
         It searches for a user whose password hash matches this password
         and, if it finds such a user, returns that user object.
 
-        If can't find matching user (or if password is wrong), returns False.
+        If can't find matching user (or if password is wrong, or the account
+        was deleted), returns False.
+
+        A hash made with an older, lower cost factor is replaced with one
+        at the current cost; the caller's commit saves it.
         """
 
-        user = cls.query.filter_by(username=username.lower()).first()
+        user = (cls.query
+                .filter_by(username=username.lower(), deleted_at=None)
+                .first())
 
         if user and user.verify_password(password=password):
+            if hasher.needs_rehash(user.password):
+                user.password = hasher.hash_password(password)
             return user
         return False
 
@@ -188,7 +263,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -197,6 +272,64 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # denormalized count, maintained by counters.py
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        server_default=db.func.now(),
+    )
+
+    # backs a user's messages page and pulled timelines, newest first
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp',
+                 user_id, timestamp.desc(), id.desc()),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline.
+
+    Rows are written when a message is posted (fan-out-on-write) and when
+    a user follows someone (backfill), so the homepage can read an
+    already-ordered slice instead of querying every followee's messages.
+    """
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    # copy of Message.timestamp so the timeline can be ordered by index
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp',
+                 user_id, timestamp.desc(), message_id.desc()),
+        # finds a message's entries when it or its author is deleted
+        db.Index('ix_timelines_message_id', message_id),
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -205,4 +338,18 @@ def connect_db(app):
     """
 
     db.app = app
+    replicas.init_app(app)
     db.init_app(app)
+    hasher.init_app(app)
+
+    @app.cli.command('upgrade-db')
+    def upgrade_db():
+        """Apply any pending schema migrations."""
+
+        import migrations
+        migrations.upgrade()
+
+    if app.config.get('AUTO_MIGRATE'):
+        import migrations
+        with app.app_context():
+            migrations.upgrade()
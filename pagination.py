@@ -0,0 +1,112 @@
+"""Keyset (cursor) pagination helpers for Warbler listings.
+
+Messages are paged on (timestamp, id) and users on id, both newest first;
+search results are paged on (rank, id), best match first. Each page
+filters on the last row of the previous page instead of using OFFSET, so
+a deep page costs the same as the first one.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from flask import abort
+from sqlalchemy import tuple_
+
+PAGE_SIZE = 100
+
+CURSOR_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+def message_cursor(message):
+    """Return the cursor pointing just past `message`."""
+
+    return f"{message.timestamp.strftime(CURSOR_TIMESTAMP_FORMAT)}_{message.id}"
+
+
+def parse_message_cursor(cursor):
+    """Parse a message cursor into a (timestamp, id) tuple.
+
+    Returns None for a missing cursor and aborts with a 400 for a bad one.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        timestamp, message_id = cursor.rsplit('_', 1)
+        return (datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT),
+                int(message_id))
+    except ValueError:
+        abort(400)
+
+
+def user_cursor(user):
+    """Return the cursor pointing just past `user`."""
+
+    return str(user.id)
+
+
+def parse_user_cursor(cursor):
+    """Parse a user cursor into an id, as parse_message_cursor does."""
+
+    if not cursor:
+        return None
+
+    try:
+        return int(cursor)
+    except ValueError:
+        abort(400)
+
+
+def search_cursor(rank, message_id):
+    """Return the cursor pointing just past a search result."""
+
+    return f"{rank}_{message_id}"
+
+
+def parse_search_cursor(cursor):
+    """Parse a search cursor into a (rank, id) tuple, as above."""
+
+    if not cursor:
+        return None
+
+    try:
+        rank, message_id = cursor.rsplit('_', 1)
+        rank = Decimal(rank)
+        if not rank.is_finite():
+            raise ValueError(rank)
+        return (rank, int(message_id))
+    except (ValueError, InvalidOperation):
+        abort(400)
+
+
+def before(query, columns, cursor):
+    """Filter `query` to rows strictly before `cursor` in `columns` order.
+
+    `columns` and `cursor` are matching tuples, e.g.
+    (Message.timestamp, Message.id) and (timestamp, id).
+    """
+
+    if cursor is None:
+        return query
+
+    return query.filter(tuple_(*columns) < tuple_(*cursor))
+
+
+def make_page(rows, cursor_for, page_size=None):
+    """Build a Page from up to `page_size` + 1 rows.
+
+    Callers fetch one extra row so we know whether another page exists
+    without running a COUNT. `page_size` defaults to PAGE_SIZE.
+    """
+
+    page_size = page_size or PAGE_SIZE
+    items = rows[:page_size]
+
+    if len(rows) > page_size:
+        return Page(items, cursor_for(items[-1]))
+
+    return Page(items, None)
@@ -0,0 +1,209 @@
+"""Password hashing off the request workers.
+
+bcrypt is deliberately slow. The PasswordHasher runs hashes and checks in
+a small process pool, with a bound on how many may be queued at once:
+when the pool is saturated `hash_password()` and `check_password()` raise
+HasherBusy straight away rather than letting logins pile up, and app.py
+turns that into a 503 with a Retry-After header.
+
+The pool takes bcrypt off the web workers' CPUs and caps how much hashing
+runs at once, but the request still waits for its result. A sync gunicorn
+worker is tied up for the whole hash all the same. Only gevent workers,
+where the wait yields to other requests, and asgi.py, which runs requests
+on a thread pool so the wait holds one of its threads, go on serving
+meanwhile. See gunicorn.conf.py.
+
+Settings (read by `init_app()`):
+
+- BCRYPT_LOG_ROUNDS: the cost factor for new hashes. Hashes made with a
+  lower cost report `needs_rehash()`, and `User.authenticate()` replaces
+  them on the next successful login.
+- PASSWORD_HASH_WORKERS: pool size; 0 hashes inline in the worker.
+- PASSWORD_HASH_QUEUE: how many hashes may be running or waiting.
+- PASSWORD_HASH_TIMEOUT: seconds to wait for a queued hash.
+- PASSWORD_HASH_RETRY_AFTER: the Retry-After sent with a 503.
+
+Every hash and check is timed; the totals for this process are in
+`hasher.stats` and the current request's time is added to its
+Server-Timing header.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import bcrypt
+from flask import g, has_app_context
+
+DEFAULT_ROUNDS = 12
+
+
+class HasherBusy(Exception):
+    """Raised when the hashing pool can't take any more work."""
+
+    def __init__(self, retry_after):
+        super().__init__("Password hashing pool is saturated")
+        self.retry_after = retry_after
+
+
+class HashStats:
+    """Count and time of password hashes and checks in this process."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def record(self, duration):
+        """Record one hash or check that took `duration` seconds."""
+
+        with self._lock:
+            self.count += 1
+            self.total_time += duration
+            self.max_time = max(self.max_time, duration)
+
+        if has_app_context():
+            g.hash_time = g.get('hash_time', 0.0) + duration
+
+    def record_rejected(self):
+        """Record a hash turned away because the pool was full."""
+
+        with self._lock:
+            self.rejected += 1
+
+    @property
+    def mean_time(self):
+        """Average seconds per hash or check."""
+
+        return self.total_time / self.count if self.count else 0.0
+
+
+def hash_with_cost(password, rounds):
+    """Return a bcrypt hash of `password` at cost `rounds`."""
+
+    return bcrypt.hashpw(password.encode('utf-8'),
+                         bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def matches(password, hashed):
+    """Does `password` match the bcrypt hash `hashed`?"""
+
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+def cost_of(hashed):
+    """Return the cost factor a bcrypt hash was made with."""
+
+    return int(hashed.split('$')[2])
+
+
+def request_hash_time():
+    """Seconds the current request spent hashing, or None if it didn't."""
+
+    return g.get('hash_time') if has_app_context() else None
+
+
+class PasswordHasher:
+    """Hashes and checks passwords in a bounded process pool."""
+
+    def __init__(self, app=None):
+        self.rounds = DEFAULT_ROUNDS
+        self.workers = 0
+        self.queue_size = 0
+        self.timeout = None
+        self.retry_after = 1
+        self.stats = HashStats()
+        self._pool = None
+        self._pool_pid = None
+        self._slots = None
+        self._pool_lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read this hasher's settings from `app.config`."""
+
+        self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_ROUNDS)
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', 0)
+        self.queue_size = app.config.get('PASSWORD_HASH_QUEUE',
+                                         self.workers * 4)
+        self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', 10)
+        self.retry_after = app.config.get('PASSWORD_HASH_RETRY_AFTER', 1)
+        self.shutdown()
+
+    def hash_password(self, password):
+        """Return a new hash of `password` at the configured cost."""
+
+        return self._run(hash_with_cost, password, self.rounds)
+
+    def check_password(self, hashed, password):
+        """Does `password` match `hashed`?"""
+
+        return self._run(matches, password, hashed)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a lower cost than we use now?"""
+
+        return cost_of(hashed) < self.rounds
+
+    def shutdown(self):
+        """Stop this process's pool; it restarts on the next hash."""
+
+        with self._pool_lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def _get_pool(self):
+        """Return this process's pool, starting it if needed.
+
+        Gunicorn forks workers after the app is imported, so each worker
+        starts its own pool rather than sharing its parent's.
+        """
+
+        with self._pool_lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                self._pool_pid = os.getpid()
+                self._slots = threading.BoundedSemaphore(
+                    self.queue_size or self.workers)
+
+            return self._pool, self._slots
+
+    def _run(self, fn, *args):
+        """Run `fn(*args)` in the pool (or inline) and time it."""
+
+        start = time.perf_counter()
+
+        if not self.workers:
+            result = fn(*args)
+            self.stats.record(time.perf_counter() - start)
+            return result
+
+        pool, slots = self._get_pool()
+
+        if not slots.acquire(blocking=False):
+            self.stats.record_rejected()
+            raise HasherBusy(self.retry_after)
+
+        try:
+            future = pool.submit(fn, *args)
+        except Exception:
+            slots.release()
+            raise
+
+        future.add_done_callback(lambda future: slots.release())
+
+        # this blocks a sync worker; under gevent it yields to other requests
+        try:
+            result = future.result(timeout=self.timeout)
+        except TimeoutError:
+            self.stats.record_rejected()
+            raise HasherBusy(self.retry_after)
+
+        self.stats.record(time.perf_counter() - start)
+        return result
@@ -0,0 +1,129 @@
+"""Read queries shared by Warbler's routes and templates.
+
+Listing pages render an author and a follow button per row. These helpers
+load everything a page needs in a fixed number of queries (authors are
+eager-loaded, the viewer's follows come from the follow graph) so templates
+never trigger a lazy load or a per-row query.
+
+Users who deleted their account (see deletion.py) are left out of every
+listing here, along with their messages, from the moment they delete it.
+"""
+
+from flask import abort
+from sqlalchemy.orm import contains_eager
+
+from intset import IntSet
+from models import Like, Message, User
+import follow_graph
+import pagination
+
+
+def with_authors(query):
+    """Load each message's author in the same query as the message.
+
+    Messages by deleted users are left out.
+    """
+
+    return (query
+            .join(Message.user)
+            .filter(User.deleted_at.is_(None))
+            .options(contains_eager(Message.user)))
+
+
+def active_user_or_404(user_id):
+    """Return the User with `user_id`, or 404 if there's none or they
+    deleted their account."""
+
+    user = User.query.get(user_id)
+
+    if user is None or user.deleted_at is not None:
+        abort(404)
+
+    return user
+
+
+def user_messages(user_id):
+    """Query for the messages `user_id` posted."""
+
+    return Message.query.filter(Message.user_id == user_id)
+
+
+def liked_messages(user_id):
+    """Query for the messages `user_id` liked."""
+
+    return (Message
+            .query
+            .join(Like, Like.message_id == Message.id)
+            .filter(Like.user_id == user_id))
+
+
+def message_page(query, before):
+    """Return the Page of `query`'s messages, newest first, before a cursor."""
+
+    messages = (with_authors(pagination
+                             .before(query,
+                                     (Message.timestamp, Message.id),
+                                     before))
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(pagination.PAGE_SIZE + 1)
+                .all())
+
+    return pagination.make_page(messages, pagination.message_cursor)
+
+
+def user_page(query, before):
+    """Return the Page of `query`'s users, newest first, before a cursor."""
+
+    query = query.filter(User.deleted_at.is_(None))
+
+    if before is not None:
+        query = query.filter(User.id < before)
+
+    users = (query
+             .order_by(User.id.desc())
+             .limit(pagination.PAGE_SIZE + 1)
+             .all())
+
+    return pagination.make_page(users, pagination.user_cursor)
+
+
+def user_id_page(ids, before):
+    """Return the Page of users in the IntSet `ids`, newest first, before a
+    cursor.
+
+    The page's ids are picked from the set, so only those users are read;
+    if some turn out to be deleted, the next ids are read in their place.
+    """
+
+    users = []
+
+    while len(users) <= pagination.PAGE_SIZE:
+        wanted = pagination.PAGE_SIZE + 1 - len(users)
+        page_ids = ids.before(before, wanted)
+
+        if page_ids:
+            users += (User.query
+                      .filter(User.id.in_(page_ids))
+                      .filter(User.deleted_at.is_(None))
+                      .order_by(User.id.desc())
+                      .all())
+
+        if len(page_ids) < wanted:
+            break
+
+        before = page_ids[-1]
+
+    return pagination.make_page(users, pagination.user_cursor)
+
+
+def following_ids(user):
+    """Return the ids `user` follows, or an empty set if no user.
+
+    Templates test `other.id in following_ids` instead of calling
+    `user.is_following(other)` per row. Only for the request's own user.
+    """
+
+    if not user:
+        return IntSet()
+
+    return follow_graph.own_following_ids(user.id)
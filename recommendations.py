@@ -0,0 +1,234 @@
+"""Who to follow.
+
+`recompute()` ranks, for every user, the users they don't follow yet by
+
+    score = friends-of-friends + RECOMMEND_LIKES_WEIGHT * shared likes
+
+where friends-of-friends counts the people they follow who follow the
+candidate, and shared likes counts the messages both of them liked. Both
+are sparse matrix products over the whole graph: with F the user x user
+follows matrix and L the user x message likes matrix, the scores for a
+block of users b are F[b] @ F + w * L[b] @ L.T. Messages with more than
+RECOMMEND_MAX_LIKERS likes are left out of L; sharing one says little
+about two users, and they would make L @ L.T nearly dense.
+
+Users are scored RECOMMEND_BLOCK_SIZE at a time, so memory is bounded by
+one block's products, and each block's top RECOMMEND_TOP_K per user
+replace that block's rows in `recommendations`, one transaction a block.
+Picking the top K is vectorized too, so no Python code runs per user.
+
+Pages read a user's suggestions with `for_user()`: one primary-key range
+scan of their rows in rank order, joined to the suggested users. Anyone
+they have followed, or who deleted their account, since the last
+recompute is skipped.
+
+Recompute from cron or the Heroku Scheduler with:
+
+    FLASK_APP=app flask recommend
+
+It needs numpy and scipy; the web workers don't.
+"""
+
+import time
+
+from flask import current_app
+from sqlalchemy import func, select
+
+from models import db, FollowersFollowee, Like, User
+import follow_graph
+import loader
+
+FETCH_SIZE = 100000
+
+recommendations = db.Table(
+    'recommendations',
+    db.Column('user_id', db.Integer, primary_key=True),
+    db.Column('rank', db.Integer, primary_key=True),
+    db.Column('candidate_id', db.Integer, nullable=False),
+    db.Column('score', db.Float, nullable=False),
+)
+
+users = User.__table__
+follows = FollowersFollowee.__table__
+likes = Like.__table__
+
+
+def config(name, default):
+    """Return the app's `name` setting, or `default`."""
+
+    return current_app.config.get(name, default)
+
+
+##############################################################################
+# Lookups
+
+
+def for_user(user):
+    """Return the users suggested for `user`, best first."""
+
+    if not user:
+        return []
+
+    suggested = (User.query
+                 .join(recommendations,
+                       recommendations.c.candidate_id == User.id)
+                 .filter(recommendations.c.user_id == user.id)
+                 .filter(User.deleted_at.is_(None))
+                 .order_by(recommendations.c.rank)
+                 .all())
+
+    following = follow_graph.own_following_ids(user.id)
+
+    return [other for other in suggested if other.id not in following]
+
+
+##############################################################################
+# Recomputing
+
+
+def _read_array(conn, query):
+    """Return the integer rows of `query` as an (n, columns) array."""
+
+    import numpy as np
+
+    result = conn.execution_options(stream_results=True).execute(query)
+    chunks = [np.empty((0, len(query.c)), dtype=np.int64)]
+
+    while True:
+        rows = result.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        chunks.append(np.array([tuple(row) for row in rows],
+                               dtype=np.int64))
+
+    return np.concatenate(chunks)
+
+
+def load_matrices(conn, max_likers):
+    """Return (F, L, active) for every user id below the largest one.
+
+    F[a, b] is 1 if a follows b; L[a, m] is 1 if a liked the m'th message
+    with at most `max_likers` likes; active[a] is False for deleted users
+    and ids with no user.
+    """
+
+    import numpy as np
+    from scipy import sparse
+
+    num_users = (conn.execute(select([func.max(users.c.id)])).scalar()
+                 or 0) + 1
+
+    active = np.zeros(num_users, dtype=bool)
+    active[_read_array(conn, select([users.c.id])
+                       .where(users.c.deleted_at.is_(None)))[:, 0]] = True
+
+    # followee_id is the user doing the following (see FollowersFollowee)
+    pairs = _read_array(conn, select([follows.c.followee_id,
+                                      follows.c.follower_id]))
+    F = sparse.csr_matrix(
+        (np.ones(len(pairs), dtype=np.float32), (pairs[:, 0], pairs[:, 1])),
+        shape=(num_users, num_users))
+
+    pairs = _read_array(conn, select([likes.c.user_id, likes.c.message_id]))
+    message_ids, columns, num_likers = np.unique(
+        pairs[:, 1], return_inverse=True, return_counts=True)
+    shared = (num_likers[columns] <= max_likers) & (num_likers[columns] > 1)
+    L = sparse.csr_matrix(
+        (np.ones(shared.sum(), dtype=np.float32),
+         (pairs[shared, 0], columns[shared].ravel())),
+        shape=(num_users, len(message_ids)))
+
+    return F, L, active
+
+
+def top_k(scores, offset, F_block, active, k):
+    """Return (user_ids, ranks, candidate_ids, scores) of each row's top `k`.
+
+    `scores` holds the block of users starting at id `offset`. Users
+    already followed, the user themselves and inactive users are dropped.
+    """
+
+    import numpy as np
+
+    # subtracting the followed users' own scores zeroes them
+    scores = (scores - scores.multiply(F_block)).tocoo()
+
+    rows, cols, data = scores.row, scores.col, scores.data
+    keep = ((data > 0) & (cols != rows + offset)
+            & active[cols] & active[rows + offset])
+    rows, cols, data = rows[keep], cols[keep], data[keep]
+
+    # by user, then best score first, ties to the older account
+    order = np.lexsort((cols, -data, rows))
+    rows, cols, data = rows[order], cols[order], data[order]
+
+    ranks = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    best = ranks < k
+
+    return rows[best] + offset, ranks[best], cols[best], data[best]
+
+
+def recompute(engine=None):
+    """Recompute every user's suggestions; return how many were stored."""
+
+    engine = engine or db.engine
+    block_size = config('RECOMMEND_BLOCK_SIZE', 2000)
+    k = config('RECOMMEND_TOP_K', 20)
+    likes_weight = config('RECOMMEND_LIKES_WEIGHT', 0.5)
+
+    start = time.perf_counter()
+
+    with engine.connect() as conn:
+        F, L, active = load_matrices(
+            conn, config('RECOMMEND_MAX_LIKERS', 1000))
+
+    LT = L.T.tocsr()
+    num_users = F.shape[0]
+    stored = 0
+
+    for offset in range(0, num_users, block_size):
+        end = min(offset + block_size, num_users)
+        F_block = F[offset:end]
+
+        scores = F_block @ F
+        if likes_weight and LT.nnz:
+            scores = scores + likes_weight * (L[offset:end] @ LT)
+
+        user_ids, ranks, candidate_ids, values = top_k(
+            scores, offset, F_block, active, k)
+
+        rows = [[str(u), str(r), str(c), repr(float(s))]
+                for u, r, c, s in zip(user_ids.tolist(), ranks.tolist(),
+                                      candidate_ids.tolist(),
+                                      values.tolist())]
+
+        with engine.begin() as conn:
+            conn.execute(recommendations.delete().where(
+                (recommendations.c.user_id >= offset)
+                & (recommendations.c.user_id < end)))
+            if rows:
+                loader.insert_batch(conn, recommendations,
+                                    ['user_id', 'rank', 'candidate_id',
+                                     'score'],
+                                    rows)
+
+        stored += len(rows)
+        print(f"recommendations: {end:,} of {num_users:,} users "
+              f"({time.perf_counter() - start:,.0f}s)", flush=True)
+
+    with engine.begin() as conn:
+        conn.execute(recommendations.delete().where(
+            recommendations.c.user_id >= num_users))
+
+    return stored
+
+
+def init_app(app):
+    """Add the `flask recommend` command."""
+
+    @app.cli.command('recommend')
+    def recommend():
+        """Recompute every user's who-to-follow suggestions."""
+
+        stored = recompute()
+        print(f"Stored {stored:,} suggestions")
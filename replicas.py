@@ -0,0 +1,126 @@
+"""Connection pool settings and read-replica routing.
+
+`RoutingSQLAlchemy` is the Flask-SQLAlchemy extension models.py uses. It
+applies the DB_POOL_* settings to every server database engine, and gives
+the app a session that can send reads to a replica:
+
+- views marked `@read_only` are served from one of the REPLICA_URLS,
+  picked per request (they're registered as SQLALCHEMY_BINDS named
+  replica0, replica1, ...);
+- only SELECTs go to the replica. Flushes, INSERT/UPDATE/DELETE and raw
+  connections use the primary, and once a request has written anything
+  the rest of it reads from the primary too;
+- after a request that writes, the browser's reads stay on the primary
+  for REPLICA_STICKY_SECONDS, so someone who just posted or followed
+  sees it even if the replicas are behind.
+
+With no REPLICA_URLS everything goes to the primary as before.
+"""
+
+import random
+import time
+
+from flask import g, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import orm
+from sqlalchemy.sql.expression import CompoundSelect, Select
+
+STICKY_KEY = 'primary_until'
+
+POOL_OPTIONS = {
+    'pool_size': 'DB_POOL_SIZE',
+    'max_overflow': 'DB_MAX_OVERFLOW',
+    'pool_timeout': 'DB_POOL_TIMEOUT',
+    'pool_recycle': 'DB_POOL_RECYCLE',
+    'pool_pre_ping': 'DB_POOL_PRE_PING',
+}
+
+
+def replica_binds(config):
+    """Return the bind names of the configured replicas."""
+
+    return sorted(name for name in config.get('SQLALCHEMY_BINDS') or {}
+                  if name.startswith('replica'))
+
+
+class RoutingSession(SignallingSession):
+    """Session that reads from the request's replica until it writes."""
+
+    def get_bind(self, mapper=None, clause=None):
+        # outside a request there's no replica to choose
+        if not g:
+            return super().get_bind(mapper, clause)
+
+        reading = (isinstance(clause, (Select, CompoundSelect))
+                   and clause._for_update_arg is None
+                   and not self._flushing
+                   and not g.get('db_wrote'))
+
+        if not reading:
+            g.db_wrote = True
+        elif g.get('db_replica'):
+            return get_state(self.app).db.get_engine(self.app,
+                                                     bind=g.db_replica)
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with pool settings and a RoutingSession."""
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+
+        # SQLite's pools don't take these
+        if not sa_url.drivername.startswith('sqlite'):
+            for option, key in POOL_OPTIONS.items():
+                if app.config.get(key) is not None:
+                    options[option] = app.config[key]
+
+        return sa_url, options
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def read_only(view):
+    """Mark `view` as safe to serve from a replica."""
+
+    view.read_only = True
+    return view
+
+
+def choose_bind(app):
+    """Pick a replica for this request if its view is read-only."""
+
+    g.db_replica = None
+
+    view = app.view_functions.get(request.endpoint)
+    replicas = replica_binds(app.config)
+
+    if (replicas and getattr(view, 'read_only', False)
+            and request.method in ('GET', 'HEAD')
+            and session.get(STICKY_KEY, 0) < time.time()):
+        g.db_replica = random.choice(replicas)
+
+
+def stick_to_primary(app, resp):
+    """Keep this browser on the primary for a while if the request wrote."""
+
+    if g.get('db_wrote') and replica_binds(app.config):
+        session[STICKY_KEY] = (time.time()
+                               + app.config.get('REPLICA_STICKY_SECONDS', 10))
+
+    return resp
+
+
+def init_app(app):
+    """Register REPLICA_URLS as binds and route read-only views to them."""
+
+    binds = app.config.setdefault('SQLALCHEMY_BINDS', {}) or {}
+    for i, url in enumerate(app.config.get('REPLICA_URLS') or []):
+        binds[f'replica{i}'] = url
+    app.config['SQLALCHEMY_BINDS'] = binds
+
+    app.before_request(lambda: choose_bind(app))
+    app.after_request(lambda resp: stick_to_primary(app, resp))
@@ -0,0 +1,220 @@
+"""Full-text search over messages, and username prefix matches.
+
+On PostgreSQL, messages have a generated `search_vector` tsvector column
+with a GIN index (migration 3), so the database keeps the index current
+as rows come and go and ranks matches with `ts_rank`.
+
+Other databases (SQLite test runs) get an in-process inverted index
+instead: term -> {message id: term count}, built from the messages table
+the first time it's searched and updated by `index_message()` and
+`unindex_message()` as messages_add and messages_destroy run. Matches
+must contain every query term and are ranked by tf-idf. The index lives
+in one process, so it only sees other processes' changes when rebuilt.
+
+Either way, results are ranked best first and paged with a
+(rank, id) cursor; ranks are rounded to RANK_PLACES decimal places so a
+cursor compares exactly against them.
+"""
+
+import math
+import re
+import threading
+from collections import defaultdict
+from decimal import Decimal
+
+from models import db, Message, User
+import pagination
+import queries
+
+SEARCH_CONFIG = 'english'
+RANK_PLACES = Decimal('0.000001')
+USER_MATCHES = 10
+
+_TERM = re.compile(r'\w+')
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def uses_database_index():
+    """Does this database index message text itself?"""
+
+    return db.engine.dialect.name == 'postgresql'
+
+
+def terms(text):
+    """Split `text` into lowercase search terms."""
+
+    return _TERM.findall(text.lower())
+
+
+##############################################################################
+# Searching
+
+
+def search_messages(q, before=None):
+    """Return the Page of messages matching `q`, best match first.
+
+    `before` is a parsed search cursor, (rank, id).
+    """
+
+    if uses_database_index():
+        rows = _database_matches(q, before)
+    else:
+        rows = _index_matches(q, before)
+
+    page = pagination.make_page(
+        rows, lambda row: pagination.search_cursor(row[1], row[0].id))
+
+    return pagination.Page([msg for msg, rank in page.items],
+                           page.next_cursor)
+
+
+def search_users(q, limit=USER_MATCHES):
+    """Return up to `limit` users whose username starts with `q`."""
+
+    prefix = q.strip().lower()
+    if not prefix:
+        return []
+
+    escaped = re.sub(r'([\\%_])', r'\\\1', prefix)
+
+    return (User.query
+            .filter(User.deleted_at.is_(None))
+            .filter(User.username.like(f'{escaped}%', escape='\\'))
+            .order_by(User.username)
+            .limit(limit)
+            .all())
+
+
+def _database_matches(q, before):
+    """(message, rank) rows from the tsvector index, as search_messages."""
+
+    tsquery = db.func.plainto_tsquery(SEARCH_CONFIG, q)
+    vector = db.literal_column('messages.search_vector')
+    rank = db.cast(db.func.ts_rank(vector, tsquery), db.Numeric(12, 6))
+
+    query = pagination.before(
+        queries.with_authors(Message.query.filter(vector.op('@@')(tsquery))),
+        (rank, Message.id),
+        before)
+
+    return (query
+            .add_columns(rank)
+            .order_by(rank.desc(), Message.id.desc())
+            .limit(pagination.PAGE_SIZE + 1)
+            .all())
+
+
+def _index_matches(q, before):
+    """(message, rank) rows from the in-process index."""
+
+    ranked = sorted(((rank, message_id)
+                     for message_id, rank in get_index().search(terms(q))),
+                    reverse=True)
+
+    if before is not None:
+        ranked = [row for row in ranked if row < before]
+
+    ranked = ranked[:pagination.PAGE_SIZE + 1]
+
+    messages = {msg.id: msg for msg in
+                queries.with_authors(Message.query.filter(
+                    Message.id.in_([message_id for _, message_id in ranked])))}
+
+    return [(messages[message_id], rank) for rank, message_id in ranked
+            if message_id in messages]
+
+
+##############################################################################
+# In-process index
+
+
+class InvertedIndex:
+    """Maps terms to the messages containing them, with term counts."""
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.documents = 0
+        self._lock = threading.Lock()
+
+    def add(self, message_id, text):
+        """Index the message `message_id` with `text`."""
+
+        counts = defaultdict(int)
+        for term in terms(text):
+            counts[term] += 1
+
+        with self._lock:
+            for term, count in counts.items():
+                self.postings[term][message_id] = count
+            self.documents += 1
+
+    def remove(self, message_id, text):
+        """Drop the message `message_id`, which had `text`."""
+
+        with self._lock:
+            for term in set(terms(text)):
+                postings = self.postings.get(term)
+                if postings is not None:
+                    postings.pop(message_id, None)
+                    if not postings:
+                        del self.postings[term]
+            self.documents -= 1
+
+    def search(self, query_terms):
+        """Yield (message id, rank) for messages with every term."""
+
+        with self._lock:
+            postings = [dict(self.postings.get(term, {}))
+                        for term in set(query_terms)]
+            documents = max(self.documents, 1)
+
+        if not postings:
+            return
+
+        postings.sort(key=len)
+        idfs = [math.log(1 + documents / len(p)) if p else 0 for p in postings]
+
+        for message_id in postings[0]:
+            if all(message_id in p for p in postings[1:]):
+                rank = sum(p[message_id] * idf
+                           for p, idf in zip(postings, idfs))
+                yield message_id, Decimal(rank).quantize(RANK_PLACES)
+
+
+def get_index():
+    """Return this process's index, building it from the database if needed."""
+
+    global _index
+
+    with _index_lock:
+        if _index is None:
+            index = InvertedIndex()
+            rows = db.session.query(Message.id, Message.text).yield_per(10000)
+            for message_id, text in rows:
+                index.add(message_id, text)
+            _index = index
+
+        return _index
+
+
+def reset_index():
+    """Forget the in-process index; the next search rebuilds it."""
+
+    global _index
+    _index = None
+
+
+def index_message(msg):
+    """Add a newly committed message to the index."""
+
+    if _index is not None and not uses_database_index():
+        _index.add(msg.id, msg.text)
+
+
+def unindex_message(message_id, text):
+    """Remove a deleted message from the index."""
+
+    if _index is not None and not uses_database_index():
+        _index.remove(message_id, text)
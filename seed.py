@@ -1,20 +1,35 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, FollowersFollowee
+    python seed.py                  # drop everything and load generator/*.csv
+    python seed.py --resume         # carry on after a failed load
+    python seed.py --data-dir DIR --batch-size N
+
+See loader.py for how the files are loaded.
+"""
 
+import argparse
+
+from app import db
+import counters
+import loader
+import migrations
+import timeline
 
-db.drop_all()
-db.create_all()
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--data-dir', default='generator')
+parser.add_argument('--batch-size', type=int, default=loader.DEFAULT_BATCH_SIZE)
+parser.add_argument('--resume', action='store_true',
+                    help="keep existing rows and skip what's already loaded")
+args = parser.parse_args()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+if not args.resume:
+    db.drop_all()
+    db.create_all()
+    migrations.upgrade()
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+loader.load(args.data_dir, batch_size=args.batch_size, resume=args.resume)
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(FollowersFollowee, DictReader(follows))
+counters.reconcile()
+timeline.rebuild_all()
 
 db.session.commit()
@@ -1,29 +1,132 @@
 $(document).ready(function() {
-    $('#messages').on('click', '.fa-star', function(evt) {
-        evt.preventDefault();
-        let $clicked = $(evt.target);
+    const $messages = $('#messages');
 
-        let action;
-        if (/far/.test($clicked.attr('class'))) {
-            action = 'add';
-        } else {
-            action = 'remove';
-        }
+    // Star clicks are queued and sent together to /api/v1/likes:batch a
+    // moment after the last click, so a burst of clicks is one request.
+    const LIKE_BATCH_DELAY = 300;
+    let pendingOps = [];
+    let likeTimer = null;
 
-        $clicked.toggleClass('far fas');
-        let message_id = $clicked.attr('data-message-id');
+    function sendLikes() {
+        likeTimer = null;
+        let ops = pendingOps;
+        pendingOps = [];
 
-        // send request to server to like post
         $.ajax({
-            url: `/like/${action}`, 
+            url: '/api/v1/likes:batch',
             method: 'post',
-            data: {
-                message_id, 
-            },
+            contentType: 'application/json',
+            data: JSON.stringify({ ops }),
             dataType: 'json',
             success: (res) => {
                 console.log('success! received response:', res);
             }
         });
-    })
-});
\ No newline at end of file
+    }
+
+    $messages.on('click', '.fa-star', function(evt) {
+        evt.preventDefault();
+        let $clicked = $(evt.target);
+
+        let op = /far/.test($clicked.attr('class')) ? 'like' : 'unlike';
+        $clicked.toggleClass('far fas');
+
+        let message_id = Number($clicked.attr('data-message-id'));
+        pendingOps.push({ op, message_id });
+
+        clearTimeout(likeTimer);
+        likeTimer = setTimeout(sendLikes, LIKE_BATCH_DELAY);
+    });
+
+    // An ajax request started as the page goes away is cancelled, so
+    // clicks still queued then are sent with fetch's keepalive, which the
+    // browser delivers after the page is gone. 'pagehide' and a hidden tab
+    // are the last moments a page reliably gets to run code;
+    // 'beforeunload' isn't fired at all on many mobile browsers.
+    function flushLikes() {
+        if (!pendingOps.length) return;
+        clearTimeout(likeTimer);
+        likeTimer = null;
+
+        let ops = pendingOps;
+        let sent;
+
+        try {
+            sent = fetch('/api/v1/likes:batch', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ ops }),
+                keepalive: true
+            });
+        } catch (err) {
+            // no fetch: leave the clicks queued
+            return;
+        }
+
+        pendingOps = [];
+
+        // refused (say, over the keepalive size limit): if the page comes
+        // back, the clicks are sent with the next batch
+        sent.catch(() => {
+            pendingOps = ops.concat(pendingOps);
+        });
+    }
+
+    $(document).on('visibilitychange', function() {
+        if (document.visibilityState === 'hidden') flushLikes();
+    });
+    $(window).on('pagehide', flushLikes);
+
+    // Infinite scroll: lists with a data-api-url load the next page as
+    // JSON when scrolled near the bottom, instead of following the
+    // "Older" link to a new page.
+    const apiUrl = $messages.data('api-url');
+    let nextCursor = $messages.data('next-cursor');
+    let loading = false;
+
+    function renderMessage(msg) {
+        let userUrl = `/users/${msg.user.id}`;
+        let date = new Date(msg.timestamp + 'Z').toLocaleDateString(
+            'en-GB', { day: '2-digit', month: 'long', year: 'numeric' });
+
+        return $('<li class="list-group-item">').append(
+            $('<a class="message-link">').attr('href', `/messages/${msg.id}`),
+            $('<a>').attr('href', userUrl).append(
+                $('<img alt="" class="timeline-image">')
+                    .attr('src', msg.user.image_url)),
+            $('<div class="message-area">').append(
+                $('<a>').attr('href', userUrl).text(`@${msg.user.username}`),
+                ' ',
+                $('<span class="text-muted">').text(date),
+                $('<p>').text(msg.text),
+                $('<div class="row" id="interactions">').append(
+                    $('<a href="#">')
+                        .addClass(msg.liked ? 'fas fa-star' : 'far fa-star')
+                        .attr('data-message-id', msg.id))));
+    }
+
+    function loadMore() {
+        if (!apiUrl || !nextCursor || loading) return;
+        loading = true;
+
+        $.getJSON(apiUrl, { before: nextCursor }, (res) => {
+            $messages.append(res.messages.map(renderMessage));
+            nextCursor = res.next_cursor;
+            if (!nextCursor) $('.pager-older').remove();
+        }).always(() => {
+            loading = false;
+        });
+    }
+
+    if (apiUrl) {
+        $(window).on('scroll', function() {
+            let bottom = $(window).scrollTop() + $(window).height();
+            if (bottom > $(document).height() - 400) loadMore();
+        });
+
+        $(document).on('click', '.pager-older a', function(evt) {
+            evt.preventDefault();
+            loadMore();
+        });
+    }
+});
@@ -0,0 +1,134 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Like, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import pagination
+import timeline
+
+db.create_all()
+
+
+class APITestCase(TestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        """Create a user with three messages, logged in."""
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        Like.query.delete()
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        user = User(email="ed@test.com",
+                    username="edward",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+        messages = [Message(text=f"message {i}", user_id=user.id)
+                    for i in range(3)]
+        db.session.add_all(messages)
+        db.session.flush()
+        for msg in messages:
+            timeline.fan_out(msg)
+        db.session.commit()
+        self.message_ids = [msg.id for msg in messages]
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        pagination.PAGE_SIZE = 100
+        db.session.rollback()
+        self.ctx.pop()
+
+    def batch(self, *ops):
+        return self.client.post('/api/v1/likes:batch', json={
+            'ops': [{'op': op, 'message_id': message_id}
+                    for op, message_id in ops]})
+
+    def test_user_messages_pages_with_cursor(self):
+        """Messages come back newest first with a cursor to the rest"""
+
+        pagination.PAGE_SIZE = 2
+
+        resp = self.client.get(f'/api/v1/users/{self.user_id}/messages')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([m['text'] for m in resp.json['messages']],
+                         ["message 2", "message 1"])
+        self.assertEqual(resp.json['messages'][0]['user']['username'],
+                         "edward")
+
+        resp = self.client.get(f'/api/v1/users/{self.user_id}/messages',
+                               query_string={'before':
+                                             resp.json['next_cursor']})
+        self.assertEqual([m['text'] for m in resp.json['messages']],
+                         ["message 0"])
+        self.assertIsNone(resp.json['next_cursor'])
+
+    def test_etag(self):
+        """An unchanged listing is a 304 for a client with its ETag"""
+
+        resp = self.client.get('/api/v1/timeline')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.json['messages']), 3)
+
+        etag = resp.headers['ETag']
+        resp = self.client.get('/api/v1/timeline',
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        self.batch(('like', self.message_ids[0]))
+        resp = self.client.get('/api/v1/timeline',
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_likes_batch(self):
+        """Ops apply together, and the last op for a message wins"""
+
+        first, second, third = self.message_ids
+
+        resp = self.batch(('like', first), ('like', second),
+                          ('unlike', second), ('like', third))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['changed'], 2)
+
+        liked = {like.message_id for like in Like.query}
+        self.assertEqual(liked, {first, third})
+        self.assertEqual(User.query.get(self.user_id).likes_count, 2)
+
+        resp = self.batch(('unlike', first), ('like', third))
+        self.assertEqual(resp.json['changed'], 1)
+        self.assertEqual({like.message_id for like in Like.query}, {third})
+
+    def test_likes_batch_errors(self):
+        """Bad ops and unknown messages reject the whole batch"""
+
+        resp = self.batch(('like', self.message_ids[0]), ('love', 1))
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.batch(('like', self.message_ids[0]),
+                          ('like', max(self.message_ids) + 1))
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(Like.query.count(), 0)
+
+        with self.client.session_transaction() as sess:
+            del sess[CURR_USER_KEY]
+        self.assertEqual(self.batch(('like', 1)).status_code, 401)
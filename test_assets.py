@@ -0,0 +1,92 @@
+"""Static asset build and serving tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import assets
+
+
+class AssetsTestCase(TestCase):
+    """Test fingerprinting, the manifest and precompressed serving."""
+
+    def setUp(self):
+        """Build a small static folder in a temporary directory."""
+
+        self.static_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.static_dir, 'images'))
+        os.makedirs(os.path.join(self.static_dir, 'stylesheets'))
+
+        with open(os.path.join(self.static_dir, 'images', 'bg.png'),
+                  'wb') as f:
+            f.write(b'\x89PNG not really')
+        with open(os.path.join(self.static_dir, 'stylesheets', 'style.css'),
+                  'w') as f:
+            f.write('body { background: url("/static/images/bg.png"); }\n'
+                    * 50)
+
+        self.original_static = app.static_folder
+        app.static_folder = self.static_dir
+        assets.reset_manifest()
+
+        self.manifest = assets.build(self.static_dir)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.static_folder = self.original_static
+        assets.reset_manifest()
+        shutil.rmtree(self.static_dir)
+
+    def test_build(self):
+        """Every file gets a content-hashed copy, stylesheets link them"""
+
+        css = self.manifest['stylesheets/style.css']
+        png = self.manifest['images/bg.png']
+        self.assertRegex(css, r'^dist/stylesheets/style\.[0-9a-f]{12}\.css$')
+
+        with open(os.path.join(self.static_dir, css)) as f:
+            self.assertIn(f'url("/static/{png}")', f.read())
+
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.static_dir, css + '.gz')))
+        self.assertFalse(os.path.isfile(
+            os.path.join(self.static_dir, png + '.gz')))
+
+        self.assertEqual(assets.build(self.static_dir), self.manifest)
+
+    def test_asset_url(self):
+        """asset_url links the fingerprinted file, or the plain one unbuilt"""
+
+        with app.test_request_context():
+            self.assertEqual(assets.asset_url('images/bg.png'),
+                             f"/static/{self.manifest['images/bg.png']}")
+            self.assertEqual(assets.asset_url('missing.js'),
+                             '/static/missing.js')
+
+    def test_precompressed(self):
+        """Clients accepting gzip get the .gz copy, others the plain file"""
+
+        url = f"/static/{self.manifest['stylesheets/style.css']}"
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        body = gzip.decompress(resp.get_data())
+        resp.close()
+
+        resp = self.client.get(url)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.get_data(), body)
+        resp.close()
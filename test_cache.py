@@ -0,0 +1,160 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from cache import MemoryCache, RedisCache
+from instrumentation import QueryCountAssertions
+import user_cache
+
+db.create_all()
+
+
+class MemoryCacheTestCase(TestCase):
+    """Test LRU eviction and expiry of the in-process cache."""
+
+    def test_lru_eviction(self):
+        """The least recently used entry is evicted when full"""
+
+        cache = MemoryCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_ttl(self):
+        """Entries expire after the TTL"""
+
+        cache = MemoryCache(ttl=10)
+
+        with patch('cache.time.monotonic', return_value=100):
+            cache.set('a', 1)
+
+        with patch('cache.time.monotonic', return_value=105):
+            self.assertEqual(cache.get('a'), 1)
+
+        with patch('cache.time.monotonic', return_value=111):
+            self.assertIsNone(cache.get('a'))
+
+
+class FakeRedis:
+    """The part of the redis client RedisCache uses, kept in a dict."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setex(self, key, ttl, value):
+        self.data[key] = value.encode() if isinstance(value, str) else value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def scan_iter(self, pattern):
+        prefix = pattern.rstrip('*')
+        return [key for key in list(self.data) if key.startswith(prefix)]
+
+
+class RedisCacheTestCase(TestCase):
+    """Test the shared cache against a stand-in client."""
+
+    def test_round_trip(self):
+        """Values are stored as JSON under the prefix, and cleared by it"""
+
+        client = FakeRedis()
+        cache = RedisCache(client, 'user')
+
+        cache.set(1, {'username': 'edward', 'likes_count': 2})
+        self.assertEqual(cache.get(1), {'username': 'edward',
+                                        'likes_count': 2})
+        self.assertIn('user:1', client.data)
+        self.assertIsNone(cache.get(2))
+
+        cache.delete(1)
+        self.assertIsNone(cache.get(1))
+
+        cache.set(1, 'a')
+        cache.set(2, 'b')
+        cache.clear()
+        self.assertEqual(client.data, {})
+
+
+class UserCacheTestCase(QueryCountAssertions, TestCase):
+    """Test the logged-in user snapshot cache."""
+
+    def setUp(self):
+        """Create a user and start with an empty cache."""
+
+        User.query.delete()
+        db.session.commit()
+        user_cache.get_cache().clear()
+
+        user = User(email="ed@test.com",
+                    username="edward",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+
+        self.user_id = user.id
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_cached_load_skips_query(self):
+        """A second load in a new session doesn't query the database"""
+
+        user_cache.load_user(self.user_id)
+        db.session.remove()
+
+        with self.assertMaxQueries(0):
+            user = user_cache.load_user(self.user_id)
+            self.assertEqual(user.username, "edward")
+
+        # the password hash isn't cached, so it loads when needed
+        self.assertEqual(user.password, "HASHED_PASSWORD")
+
+    def test_commit_invalidates(self):
+        """Changing a user drops their snapshot"""
+
+        user = user_cache.load_user(self.user_id)
+        user.bio = "new bio"
+        db.session.commit()
+
+        self.assertIsNone(user_cache.get_cache().get(self.user_id))
+        db.session.remove()
+
+        self.assertEqual(user_cache.load_user(self.user_id).bio, "new bio")
+
+    def test_redis_snapshot(self):
+        """Snapshots, timestamps included, survive JSON in Redis"""
+
+        user = User.query.get(self.user_id)
+        updated_at = user.updated_at
+        db.session.remove()
+
+        with patch('user_cache._cache', RedisCache(FakeRedis(), 'user')):
+            user_cache.load_user(self.user_id)
+            db.session.remove()
+
+            with self.assertMaxQueries(0):
+                user = user_cache.load_user(self.user_id)
+                self.assertEqual(user.updated_at, updated_at)
+                self.assertIsNone(user.deleted_at)
@@ -0,0 +1,107 @@
+"""Denormalized counter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_counters.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import counters
+
+db.create_all()
+
+
+class CountersTestCase(TestCase):
+    """Test that counters follow writes and that reconcile repairs them."""
+
+    def setUp(self):
+        """Create two users."""
+
+        User.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+
+        self.edward = User(email="ed@test.com",
+                           username="edward",
+                           password="HASHED_PASSWORD")
+        self.juan = User(email="juanton@test.com",
+                         username="juan",
+                         password="HASHED_PASSWORD")
+
+        db.session.add_all([self.edward, self.juan])
+        db.session.commit()
+
+    def tearDown(self):
+        """Roll back anything a failed test left behind."""
+
+        db.session.rollback()
+
+    def test_follow_counts(self):
+        """Following and unfollowing adjust both users' counts"""
+
+        self.edward.following.append(self.juan)
+        db.session.commit()
+
+        self.assertEqual(self.edward.following_count, 1)
+        self.assertEqual(self.edward.follower_count, 0)
+        self.assertEqual(self.juan.follower_count, 1)
+
+        self.edward.following.remove(self.juan)
+        db.session.commit()
+
+        self.assertEqual(self.edward.following_count, 0)
+        self.assertEqual(self.juan.follower_count, 0)
+
+    def test_message_and_like_counts(self):
+        """Posting, liking and deleting adjust message and like counts"""
+
+        msg = Message(text="hello", user_id=self.juan.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.assertEqual(self.juan.message_count, 1)
+
+        self.edward.messages_liked.append(msg)
+        db.session.commit()
+
+        self.assertEqual(self.edward.likes_count, 1)
+        self.assertEqual(msg.like_count, 1)
+
+        db.session.delete(msg)
+        db.session.commit()
+
+        self.assertEqual(self.juan.message_count, 0)
+        self.assertEqual(self.edward.likes_count, 0)
+
+    def test_rolled_back_writes_are_not_counted(self):
+        """A rolled back follow leaves the counts alone"""
+
+        self.edward.following.append(self.juan)
+        db.session.rollback()
+        db.session.commit()
+
+        self.assertEqual(self.edward.following_count, 0)
+        self.assertEqual(self.juan.follower_count, 0)
+
+    def test_reconcile(self):
+        """reconcile repairs counters that bulk writes left behind"""
+
+        db.session.add(FollowersFollowee(followee_id=self.edward.id,
+                                         follower_id=self.juan.id))
+        db.session.commit()
+
+        self.assertEqual(self.edward.following_count, 0)
+
+        self.assertEqual(counters.reconcile(), 2)
+        db.session.commit()
+
+        self.assertEqual(self.edward.following_count, 1)
+        self.assertEqual(self.juan.follower_count, 1)
+        self.assertEqual(counters.reconcile(), 0)
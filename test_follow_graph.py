@@ -0,0 +1,215 @@
+"""Follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from instrumentation import QueryCountAssertions
+import deletion
+import follow_graph
+import jobs
+import pagination
+import queries
+
+db.create_all()
+
+
+class FollowGraphTestCase(QueryCountAssertions, TestCase):
+    """Test the in-memory follow graph and its incremental updates."""
+
+    def setUp(self):
+        """Three users; edward and juan follow each other, ann follows juan."""
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        User.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        db.session.execute(deletion.progress.delete())
+        db.session.commit()
+
+        self.edward = User(email="ed@test.com",
+                           username="edward",
+                           password="HASHED_PASSWORD")
+        self.juan = User(email="juanton@test.com",
+                         username="juan",
+                         password="HASHED_PASSWORD")
+        self.ann = User(email="ann@test.com",
+                        username="ann",
+                        password="HASHED_PASSWORD")
+        db.session.add_all([self.edward, self.juan, self.ann])
+        db.session.commit()
+
+        self.edward.following.append(self.juan)
+        self.juan.following.append(self.edward)
+        self.ann.following.append(self.juan)
+        db.session.commit()
+
+        self.edward_id = self.edward.id
+        self.juan_id = self.juan.id
+        self.ann_id = self.ann.id
+
+    def tearDown(self):
+        app.config['FOLLOW_GRAPH'] = True
+        app.config['FOLLOW_GRAPH_TTL'] = 300
+        db.session.rollback()
+        self.ctx.pop()
+
+    def test_load(self):
+        """The graph loads both directions from the follows table"""
+
+        graph = follow_graph.FollowGraph.load()
+
+        self.assertEqual(list(graph.following(self.edward_id)),
+                         [self.juan_id])
+        self.assertEqual(list(graph.followers(self.juan_id)),
+                         sorted([self.edward_id, self.ann_id]))
+        self.assertEqual(list(graph.following(self.juan_id)),
+                         [self.edward_id])
+        self.assertEqual(len(graph.following(12345)), 0)
+
+    def test_updates_on_commit(self):
+        """Follows are applied once committed, and rolled back ones never"""
+
+        follow_graph.get_graph()
+        self.assertFalse(self.edward.is_following(self.ann))
+
+        self.edward.following.append(self.ann)
+        db.session.flush()
+        self.assertFalse(self.edward.is_following(self.ann))
+        db.session.rollback()
+        self.assertFalse(self.edward.is_following(self.ann))
+
+        self.edward.following.append(self.ann)
+        db.session.commit()
+        self.assertTrue(self.edward.is_following(self.ann))
+        self.assertTrue(self.ann.is_followed_by(self.edward))
+
+        self.edward.following.remove(self.juan)
+        db.session.commit()
+        self.assertFalse(self.edward.is_following(self.juan))
+        self.assertEqual(list(follow_graph.follower_ids(self.juan_id)),
+                         [self.ann_id])
+
+    def test_reload_and_fallback(self):
+        """Expired graphs are reloaded, and FOLLOW_GRAPH=0 reads the table"""
+
+        graph = follow_graph.get_graph()
+        self.assertIs(follow_graph.get_graph(), graph)
+
+        # written behind the graph's back, as another worker would
+        db.session.execute(FollowersFollowee.__table__.insert().values(
+            followee_id=self.edward_id, follower_id=self.ann_id))
+        db.session.commit()
+        self.assertFalse(follow_graph.is_following(self.edward_id,
+                                                   self.ann_id))
+
+        app.config['FOLLOW_GRAPH'] = False
+        self.assertTrue(follow_graph.is_following(self.edward_id,
+                                                  self.ann_id))
+
+        app.config['FOLLOW_GRAPH'] = True
+        app.config['FOLLOW_GRAPH_TTL'] = 0
+        self.assertIsNot(follow_graph.get_graph(), graph)
+        self.assertTrue(follow_graph.is_following(self.edward_id,
+                                                  self.ann_id))
+
+    def test_own_follows_are_fresh(self):
+        """Users see their own follows before the graph has them"""
+
+        follow_graph.get_graph()
+
+        # taken by another worker
+        db.session.execute(FollowersFollowee.__table__.insert().values(
+            followee_id=self.edward_id, follower_id=self.ann_id))
+        db.session.commit()
+
+        with app.test_request_context():
+            # someone else's browser is served from the graph
+            self.assertNotIn(self.ann_id, queries.following_ids(self.edward))
+
+            # edward's, which made the follow, reads the database
+            follow_graph.mark_changed()
+            self.assertIn(self.ann_id, queries.following_ids(self.edward))
+            self.assertEqual(
+                list(follow_graph.followed_by_followees(self.edward_id,
+                                                        self.juan_id)),
+                [self.ann_id])
+
+            # until the graph has been reloaded since
+            app.config['FOLLOW_GRAPH_TTL'] = 0
+            follow_graph.get_graph()
+            app.config['FOLLOW_GRAPH_TTL'] = 300
+            with self.assertMaxQueries(0):
+                self.assertIn(self.ann_id,
+                              queries.following_ids(self.edward))
+
+    def test_followed_by_followees(self):
+        """Intersects who the viewer follows with who follows the user"""
+
+        self.edward.following.append(self.ann)
+        db.session.commit()
+
+        self.assertEqual(
+            list(follow_graph.followed_by_followees(self.edward_id,
+                                                    self.juan_id)),
+            [self.ann_id])
+        self.assertEqual(
+            len(follow_graph.followed_by_followees(self.ann_id,
+                                                   self.edward_id)),
+            1)
+
+    def test_deleted_user(self):
+        """Deleting a user drops them from the graph and from id pages"""
+
+        follow_graph.get_graph()
+        app.config['JOBS_EAGER'] = False
+
+        try:
+            deletion.soft_delete(self.ann)
+            db.session.commit()
+
+            page = queries.user_id_page(
+                follow_graph.follower_ids(self.juan_id), None)
+            self.assertEqual([u.id for u in page.items], [self.edward_id])
+
+            while deletion.delete_chunk(self.ann_id):
+                pass
+            db.session.commit()
+
+        finally:
+            app.config['JOBS_EAGER'] = True
+            db.session.execute(jobs.jobs.delete())
+            db.session.commit()
+
+        self.assertEqual(list(follow_graph.follower_ids(self.juan_id)),
+                         [self.edward_id])
+
+    def test_user_id_page(self):
+        """Pages of ids from the graph follow the user cursor"""
+
+        pagination.PAGE_SIZE = 1
+        try:
+            ids = follow_graph.follower_ids(self.juan_id)
+            first = queries.user_id_page(ids, None)
+            self.assertEqual([u.id for u in first.items],
+                             [max(self.edward_id, self.ann_id)])
+
+            second = queries.user_id_page(
+                ids, pagination.parse_user_cursor(first.next_cursor))
+            self.assertEqual([u.id for u in second.items],
+                             [min(self.edward_id, self.ann_id)])
+            self.assertIsNone(second.next_cursor)
+
+        finally:
+            pagination.PAGE_SIZE = 100
@@ -0,0 +1,128 @@
+"""HTTP caching tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_http_cache.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Like, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+
+class HTTPCacheTestCase(TestCase):
+    """Test cache policies and conditional GETs of profile/message pages."""
+
+    def setUp(self):
+        """Create a viewer, and an author with a message, logged in."""
+
+        Like.query.delete()
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        viewer = User(email="ed@test.com",
+                      username="edward",
+                      password="HASHED_PASSWORD")
+        author = User(email="juanton@test.com",
+                      username="juan",
+                      password="HASHED_PASSWORD")
+        db.session.add_all([viewer, author])
+        db.session.commit()
+        self.viewer_id = viewer.id
+        self.author_id = author.id
+
+        msg = Message(text="hello", user_id=author.id)
+        db.session.add(msg)
+        db.session.commit()
+        self.message_id = msg.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer_id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def fresh_etag(self, url):
+        """GET `url` as a fresh page and return its weak ETag."""
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+        etag = resp.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        return etag
+
+    def test_static_policy(self):
+        """Plain static files revalidate, pages stay out of shared caches"""
+
+        resp = self.client.get('/static/stylesheets/style.css')
+        self.assertEqual(resp.headers['Cache-Control'], 'public, no-cache')
+        resp.close()
+
+        resp = self.client.get('/static/stylesheets/style.0123abcd.css')
+        self.assertEqual(resp.status_code, 404)
+        self.assertNotIn('immutable', resp.headers['Cache-Control'])
+
+        resp = self.client.get('/users')
+        self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+        self.assertNotIn('ETag', resp.headers)
+
+    def test_user_page_not_modified(self):
+        """A profile is a 304 until the author posts or the viewer likes"""
+
+        url = f'/users/{self.author_id}'
+        etag = self.fresh_etag(url)
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+
+        self.client.post('/api/v1/likes:batch', json={
+            'ops': [{'op': 'like', 'message_id': self.message_id}]})
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+
+        etag = resp.headers['ETag']
+        db.session.add(Message(text="again", user_id=self.author_id))
+        db.session.commit()
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'again', resp.data)
+
+    def test_message_page_not_modified(self):
+        """A message page is a 304 only for the viewer it was rendered for"""
+
+        url = f'/messages/{self.message_id}'
+        etag = self.fresh_etag(url)
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_flash_is_rendered(self):
+        """A pending flash message always gets a full page"""
+
+        url = f'/users/{self.author_id}'
+        etag = self.fresh_etag(url)
+
+        with self.client.session_transaction() as sess:
+            sess['_flashes'] = [('success', 'Saved!')]
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'Saved!', resp.data)
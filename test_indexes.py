@@ -0,0 +1,101 @@
+"""Index usage tests for hot queries."""
+
+# run these tests like:
+#
+#    python -m unittest test_indexes.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import migrations
+
+db.create_all()
+migrations.upgrade()
+
+
+class IndexUsageTestCase(TestCase):
+    """Fail if a hot query stops using the index that backs it."""
+
+    def setUp(self):
+        """Make the planner prefer indexes even on tiny test tables."""
+
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute('SET enable_seqscan = off')
+
+    def tearDown(self):
+        """Throw away the planner setting."""
+
+        db.session.rollback()
+
+    def assertUsesIndex(self, query, index_name):
+        plan = migrations.query_plan(query)
+        self.assertIn(index_name, plan, f"{index_name} not used:\n{plan}")
+
+    def test_user_messages(self):
+        """A user's messages page uses (user_id, timestamp DESC)"""
+
+        query = (Message
+                 .query
+                 .filter(Message.user_id == 1)
+                 .order_by(Message.timestamp.desc(), Message.id.desc())
+                 .limit(100))
+
+        self.assertUsesIndex(query, 'ix_messages_user_id_timestamp')
+
+    def test_timeline(self):
+        """Reading a timeline uses (user_id, timestamp DESC)"""
+
+        query = (TimelineEntry
+                 .query
+                 .filter(TimelineEntry.user_id == 1)
+                 .order_by(TimelineEntry.timestamp.desc(),
+                           TimelineEntry.message_id.desc())
+                 .limit(100))
+
+        self.assertUsesIndex(query, 'ix_timelines_user_id_timestamp')
+
+    def test_followers(self):
+        """Looking up who follows a user uses the reverse follows index"""
+
+        query = FollowersFollowee.query.filter(
+            FollowersFollowee.follower_id == 1)
+
+        self.assertUsesIndex(query, 'ix_follows_follower_id_followee_id')
+
+    def test_message_likes(self):
+        """Looking up who liked a message uses the reverse likes index"""
+
+        query = Like.query.filter(Like.message_id == 1)
+
+        self.assertUsesIndex(query, 'ix_likes_message_id_user_id')
+
+    def test_username_search(self):
+        """Username substring search uses the trigram index"""
+
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest("trigram indexes need PostgreSQL")
+
+        query = User.query.filter(User.username.like('%edw%'))
+
+        self.assertUsesIndex(query, 'ix_users_username_trgm')
+
+    def test_old_timeline_index_rebuilt(self):
+        """Migration 7 replaces a timelines index without message_id"""
+
+        name = 'ix_timelines_user_id_timestamp'
+
+        with db.engine.begin() as conn:
+            conn.execute(f'DROP INDEX {name}')
+            conn.execute(f'CREATE INDEX {name} ON timelines '
+                         f'(user_id, timestamp)')
+
+            migrations.redefine_timeline_index(conn)
+
+            self.assertIn('message_id',
+                          migrations.index_definition(conn, name))
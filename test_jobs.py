@@ -0,0 +1,240 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Like, FollowersFollowee, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import counters
+import deletion
+import jobs
+
+db.create_all()
+
+
+@jobs.handler('test_flaky')
+def flaky(failures):
+    """Fail the first `failures` times it runs."""
+
+    flaky.calls += 1
+    if flaky.calls <= failures:
+        raise RuntimeError("flaky")
+
+
+class JobsTestCase(TestCase):
+    """Test queueing, running and retrying jobs, and chunked deletion."""
+
+    def setUp(self):
+        """Queue jobs instead of running them, with two users."""
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        app.config['JOBS_EAGER'] = False
+        flaky.calls = 0
+
+        db.session.execute(jobs.jobs.delete())
+        db.session.execute(deletion.progress.delete())
+        Like.query.delete()
+        TimelineEntry.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.edward = User(email="ed@test.com",
+                           username="edward",
+                           password="HASHED_PASSWORD")
+        self.juan = User(email="juanton@test.com",
+                         username="juan",
+                         password="HASHED_PASSWORD")
+        db.session.add_all([self.edward, self.juan])
+        db.session.commit()
+
+    def tearDown(self):
+        app.config['JOBS_EAGER'] = True
+        app.config['JOB_MAX_ATTEMPTS'] = 5
+        app.config['DELETE_CHUNK_SIZE'] = 1000
+        db.session.rollback()
+        self.ctx.pop()
+
+    def job(self):
+        """Return the only job in the queue."""
+
+        return db.session.execute(jobs.jobs.select()).fetchone()
+
+    def make_due(self):
+        """Make every queued job due now, skipping its retry delay."""
+
+        db.session.execute(jobs.jobs.update().values(
+            run_at=datetime.utcnow() - timedelta(seconds=1)))
+        db.session.commit()
+
+    def test_queued_until_worked(self):
+        """A job runs when a worker claims it, and keys dedupe jobs"""
+
+        self.juan.following.append(self.edward)
+        msg = Message(text="hello", user_id=self.edward.id)
+        db.session.add(msg)
+        db.session.flush()
+
+        self.assertTrue(jobs.enqueue('fan_out', key=f'fan_out:{msg.id}',
+                                     message_id=msg.id))
+        self.assertFalse(jobs.enqueue('fan_out', key=f'fan_out:{msg.id}',
+                                      message_id=msg.id))
+        db.session.commit()
+
+        self.assertEqual(TimelineEntry.query.count(), 0)
+        self.assertEqual(jobs.queue_stats()[jobs.QUEUED], 1)
+
+        self.assertEqual(jobs.work_once(), 1)
+        self.assertEqual(TimelineEntry.query.count(), 2)
+        self.assertEqual(self.job().status, jobs.DONE)
+        self.assertEqual(jobs.work_once(), 0)
+
+    def test_backfill_before_fan_out(self):
+        """A fan-out that runs after the follower's backfill still succeeds"""
+
+        msg = Message(text="hello", user_id=self.edward.id)
+        db.session.add(msg)
+        db.session.flush()
+        jobs.enqueue('fan_out', key=f'fan_out:{msg.id}', message_id=msg.id)
+        db.session.commit()
+
+        # juan follows edward before the fan-out job is worked
+        self.juan.following.append(self.edward)
+        app.config['JOBS_EAGER'] = True
+        jobs.enqueue('backfill', user_id=self.juan.id,
+                     followee_id=self.edward.id)
+        db.session.commit()
+        app.config['JOBS_EAGER'] = False
+        self.assertEqual(TimelineEntry.query.count(), 1)
+
+        self.assertEqual(jobs.work_once(), 1)
+        self.assertEqual(self.job().status, jobs.DONE)
+        self.assertEqual(
+            sorted(user_id for (user_id,) in
+                   db.session.query(TimelineEntry.user_id)),
+            sorted([self.edward.id, self.juan.id]))
+
+    def test_retries(self):
+        """Failed jobs are retried later, then given up on"""
+
+        jobs.enqueue('test_flaky', failures=1)
+        db.session.commit()
+
+        jobs.work_once()
+        job = self.job()
+        self.assertEqual(job.status, jobs.QUEUED)
+        self.assertEqual(job.attempts, 1)
+        self.assertIn('flaky', job.last_error)
+        self.assertEqual(jobs.work_once(), 0)
+
+        self.make_due()
+        jobs.work_once()
+        self.assertEqual(self.job().status, jobs.DONE)
+
+        app.config['JOB_MAX_ATTEMPTS'] = 1
+        db.session.execute(jobs.jobs.delete())
+        flaky.calls = 0
+        jobs.enqueue('test_flaky', failures=1)
+        db.session.commit()
+
+        jobs.work_once()
+        self.assertEqual(self.job().status, jobs.FAILED)
+        self.assertEqual(jobs.queue_stats()[jobs.FAILED], 1)
+
+    def test_stale_jobs_requeued(self):
+        """Jobs left running by a dead worker go back on the queue"""
+
+        jobs.enqueue('test_flaky', failures=0)
+        db.session.commit()
+        jobs.claim('dead-worker', 10)
+        self.assertEqual(self.job().status, jobs.RUNNING)
+
+        self.assertEqual(jobs.requeue_stale(), 0)
+
+        db.session.execute(jobs.jobs.update().values(
+            locked_at=datetime.utcnow() - timedelta(hours=1)))
+        db.session.commit()
+        self.assertEqual(jobs.requeue_stale(), 1)
+        self.assertEqual(jobs.work_once(), 1)
+
+    def test_chunked_deletion(self):
+        """Deleting a user in one-row chunks leaves everyone's counts right"""
+
+        edward_id, juan_id = self.edward.id, self.juan.id
+
+        own = Message(text="edward's", user_id=edward_id)
+        other = Message(text="juan's", user_id=juan_id)
+        db.session.add_all([own, other])
+        db.session.flush()
+        self.edward.following.append(self.juan)
+        self.juan.following.append(self.edward)
+        self.edward.messages_liked.append(other)
+        self.juan.messages_liked.append(own)
+        db.session.add(TimelineEntry(user_id=juan_id, message_id=own.id,
+                                     timestamp=own.timestamp))
+        db.session.add(TimelineEntry(user_id=edward_id, message_id=other.id,
+                                     timestamp=other.timestamp))
+        db.session.commit()
+
+        app.config['DELETE_CHUNK_SIZE'] = 1
+        jobs.enqueue('delete_user', key=f'delete_user:{edward_id}',
+                     user_id=edward_id)
+        db.session.commit()
+
+        # two likes, two follows, two timeline entries, a message, the user
+        runs = 0
+        while jobs.work_once():
+            runs += 1
+        self.assertEqual(runs, 8)
+
+        db.session.expire_all()
+        self.assertIsNone(User.query.get(edward_id))
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+        juan = User.query.get(juan_id)
+        self.assertEqual((juan.follower_count, juan.following_count,
+                          juan.likes_count), (0, 0, 0))
+        self.assertEqual(counters.reconcile(), 0)
+
+    def test_deletion_resumes(self):
+        """A soft-deleted user's data goes a batch a run, from the last step"""
+
+        edward_id = self.edward.id
+        self.edward.following.append(self.juan)
+        self.juan.following.append(self.edward)
+        db.session.commit()
+
+        app.config['DELETE_CHUNK_SIZE'] = 1
+        deletion.soft_delete(self.edward)
+        db.session.commit()
+        self.assertIsNotNone(User.query.get(edward_id).deleted_at)
+
+        def progress():
+            return db.session.execute(deletion.progress.select()).fetchone()
+
+        # no likes, so the first run skips to the first follows step
+        jobs.work_once()
+        self.assertEqual((progress().step, progress().rows_deleted), (2, 1))
+
+        jobs.work_once()
+        self.assertEqual((progress().step, progress().rows_deleted), (3, 2))
+
+        while jobs.work_once():
+            pass
+
+        self.assertIsNone(progress())
+        self.assertIsNone(User.query.get(edward_id))
+        self.assertEqual(counters.reconcile(), 0)
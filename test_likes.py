@@ -0,0 +1,188 @@
+"""Liked message id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_likes.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from instrumentation import QueryCountAssertions
+from intset import IntSet
+import likes
+
+db.create_all()
+
+
+class IntSetTestCase(TestCase):
+    """Test the sorted id array."""
+
+    def test_membership(self):
+        """Ids are deduped, sorted and found by bisection"""
+
+        ids = IntSet([5, 1, 3, 3])
+
+        self.assertEqual(list(ids), [1, 3, 5])
+        self.assertIn(3, ids)
+        self.assertNotIn(4, ids)
+
+    def test_add_and_discard(self):
+        """Adding and discarding keep the array sorted and unique"""
+
+        ids = IntSet([1, 5])
+        ids.add(3)
+        ids.add(3)
+        ids.discard(1)
+        ids.discard(2)
+
+        self.assertEqual(list(ids), [3, 5])
+
+    def test_intersection(self):
+        """Intersection works with IntSets and plain iterables"""
+
+        ids = IntSet([1, 2, 3, 5, 8])
+
+        self.assertEqual(list(ids.intersection(IntSet([2, 5, 7]))), [2, 5])
+        self.assertEqual(list(ids.intersection([8, 4, 1])), [1, 8])
+
+    def test_before(self):
+        """Ids before a cursor come largest first, up to a limit"""
+
+        ids = IntSet([1, 2, 3, 5, 8])
+
+        self.assertEqual(ids.before(None, 2), [8, 5])
+        self.assertEqual(ids.before(5, 10), [3, 2, 1])
+        self.assertEqual(ids.before(1, 10), [])
+
+
+class LikedIdsTestCase(QueryCountAssertions, TestCase):
+    """Test looking up which messages on a page a user liked."""
+
+    def setUp(self):
+        """Create a user who liked one of two messages."""
+
+        User.query.delete()
+        Message.query.delete()
+        db.session.commit()
+        likes.get_cache().clear()
+
+        self.user = User(email="ed@test.com",
+                         username="edward",
+                         password="HASHED_PASSWORD")
+        db.session.add(self.user)
+        db.session.commit()
+
+        self.liked = Message(text="liked", user_id=self.user.id)
+        self.other = Message(text="other", user_id=self.user.id)
+        db.session.add_all([self.liked, self.other])
+        db.session.commit()
+
+        self.user.messages_liked.append(self.liked)
+        db.session.commit()
+
+        self.page = [self.liked.id, self.other.id]
+
+    def tearDown(self):
+        app.config['LIKED_IDS_CACHE_MAX_LIKES'] = 10000
+        db.session.rollback()
+
+    def test_cached(self):
+        """The first lookup loads the user's ids and later ones don't query"""
+
+        self.assertEqual(likes.liked_ids(self.user, self.page),
+                         {self.liked.id})
+
+        with self.assertMaxQueries(0):
+            self.assertEqual(likes.liked_ids(self.user, self.page),
+                             {self.liked.id})
+
+            likes.record_unlike(self.user.id, self.liked.id)
+            likes.record_like(self.user.id, self.other.id)
+
+            self.assertEqual(likes.liked_ids(self.user, self.page),
+                             {self.other.id})
+
+    def test_heavy_liker(self):
+        """Users over the cache limit get a query scoped to the page"""
+
+        app.config['LIKED_IDS_CACHE_MAX_LIKES'] = 0
+
+        self.assertEqual(likes.liked_ids(self.user, self.page),
+                         {self.liked.id})
+        self.assertIsNone(likes.get_cache().get(self.user.id))
+
+    def test_no_user(self):
+        """Anonymous viewers have liked nothing"""
+
+        self.assertEqual(likes.liked_ids(None, self.page), set())
+
+
+class LikeWritesTestCase(TestCase):
+    """Test the single-statement like writes and the write-behind buffer."""
+
+    def setUp(self):
+        """Create a user and a message."""
+
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        user = User(email="ed@test.com",
+                    username="edward",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+        msg = Message(text="hello", user_id=user.id)
+        db.session.add(msg)
+        db.session.commit()
+        self.message_id = msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def counts(self):
+        db.session.expire_all()
+        return (Like.query.count(),
+                User.query.get(self.user_id).likes_count,
+                Message.query.get(self.message_id).like_count)
+
+    def test_idempotent(self):
+        """Liking twice or unliking twice changes the rows once"""
+
+        self.assertTrue(likes.like(self.user_id, self.message_id))
+        self.assertFalse(likes.like(self.user_id, self.message_id))
+        db.session.commit()
+        self.assertEqual(self.counts(), (1, 1, 1))
+
+        self.assertTrue(likes.unlike(self.user_id, self.message_id))
+        self.assertFalse(likes.unlike(self.user_id, self.message_id))
+        db.session.commit()
+        self.assertEqual(self.counts(), (0, 0, 0))
+
+    def test_missing_message(self):
+        """Liking a message that doesn't exist writes nothing"""
+
+        self.assertFalse(likes.like(self.user_id, self.message_id + 1))
+        db.session.commit()
+        self.assertEqual(Like.query.count(), 0)
+
+    def test_buffer_coalesces(self):
+        """Only the last buffered state for a pair is written"""
+
+        buffer = likes.LikeBuffer(app, interval=60)
+        buffer.set(self.user_id, self.message_id, True)
+        buffer.set(self.user_id, self.message_id, False)
+        buffer.set(self.user_id, self.message_id, True)
+        self.assertEqual(Like.query.count(), 0)
+
+        buffer.flush()
+        self.assertEqual(self.counts(), (1, 1, 1))
@@ -0,0 +1,117 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import loader
+
+db.create_all()
+
+USERS_CSV = """email,username,image_url,password,bio,header_image_url,location
+ed@test.com,edward,/ed.png,HASHED_PASSWORD,,,
+jo@test.com,joanna,/jo.png,HASHED_PASSWORD,Hi,,Oakland
+"""
+
+MESSAGES_CSV = """text,timestamp,user_id
+first,2017-01-21 11:04:53.522807,{ed}
+second,2017-01-22 11:04:53.522807,{ed}
+third,2017-01-23 11:04:53.522807,{jo}
+"""
+
+
+class LoaderTestCase(TestCase):
+    """Test streaming CSVs into the database."""
+
+    def setUp(self):
+        """Start with empty tables and a directory of CSVs."""
+
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.data_dir = tempfile.mkdtemp()
+        self.write('users.csv', USERS_CSV)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+        db.session.rollback()
+
+    def write(self, filename, text):
+        with open(os.path.join(self.data_dir, filename), 'w') as f:
+            f.write(text)
+
+    def index_names(self):
+        with db.engine.connect() as conn:
+            return {name for name, _ in
+                    loader.secondary_indexes(conn, 'messages')}
+
+    def test_resume_after_failure(self):
+        """A failed load picks up after the last committed batch"""
+
+        indexes = self.index_names()
+        loader.load(self.data_dir, batch_size=1)
+
+        ed, jo = (User.query.filter_by(username=name).one().id
+                  for name in ('edward', 'joanna'))
+        self.write('messages.csv', MESSAGES_CSV.format(ed=ed, jo=jo))
+
+        insert_batch = loader.insert_batch
+        calls = []
+
+        def fail_on_second_batch(conn, table, columns, rows):
+            calls.append(rows)
+            if table.name == 'messages' and len(calls) == 2:
+                raise RuntimeError("connection lost")
+            insert_batch(conn, table, columns, rows)
+
+        with patch('loader.insert_batch', fail_on_second_batch):
+            with self.assertRaises(RuntimeError):
+                loader.load(self.data_dir, batch_size=2, resume=True)
+
+        self.assertEqual(Message.query.count(), 2)
+        self.assertFalse(indexes & self.index_names())
+
+        loader.load(self.data_dir, batch_size=2, resume=True)
+
+        self.assertEqual(User.query.count(), 2)
+        self.assertEqual([(m.id, m.text)
+                          for m in Message.query.order_by(Message.id)],
+                         [(1, "first"), (2, "second"), (3, "third")])
+        self.assertEqual(self.index_names(), indexes)
+
+        # the sequence carries on after the loaded ids
+        message = Message(text="fourth", user_id=ed)
+        db.session.add(message)
+        db.session.commit()
+        self.assertEqual(message.id, 4)
+
+    def test_ids_are_line_numbers(self):
+        """Rows get their line number as id, whatever the sequence says"""
+
+        loader.load(self.data_dir)
+
+        self.assertEqual([(u.id, u.username)
+                          for u in User.query.order_by(User.id)],
+                         [(1, "edward"), (2, "joanna")])
+
+    def test_empty_fields_are_null(self):
+        """Empty CSV fields load as NULL"""
+
+        loader.load(self.data_dir)
+
+        ed = User.query.filter_by(username="edward").one()
+        self.assertIsNone(ed.bio)
+        self.assertEqual(ed.message_count, 0)
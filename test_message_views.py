@@ -7,6 +7,7 @@
 
 import os
 from unittest import TestCase
+from unittest.mock import patch
 
 from models import db, connect_db, Message, User
 
@@ -21,6 +22,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import fragments
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -41,6 +43,7 @@ class MessageViewTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
+        fragments.get_cache().clear()
 
         self.client = app.test_client()
 
@@ -71,3 +74,59 @@ class MessageViewTestCase(TestCase):
 
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
+
+    def test_cached_message_follows_author(self):
+        """Do cached message list items pick up a renamed author?"""
+
+        user_id = self.testuser.id
+        msg = Message(text="Cached hello", user_id=user_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.get(f"/users/{user_id}")
+            self.assertIn(b"@testuser</a>", resp.data)
+
+            user = User.query.get(user_id)
+            user.username = "renamed"
+            db.session.commit()
+
+            resp = c.get(f"/users/{user_id}")
+            self.assertIn(b"@renamed</a>", resp.data)
+            self.assertNotIn(b"@testuser</a>", resp.data)
+            self.assertIn(b"Cached hello", resp.data)
+
+    def test_cached_message_keeps_star_like_text(self):
+        """Is message text left alone when the star is filled in?"""
+
+        user_id = self.testuser.id
+        msg = Message(text="__warbler_star__ <star> fas", user_id=user_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            for _ in range(2):
+                resp = c.get(f"/users/{user_id}")
+                self.assertIn(b"__warbler_star__ &lt;star&gt; fas",
+                              resp.data)
+                self.assertIn(b'class="far fa-star"', resp.data)
+
+    def test_fragment_key_has_template_version(self):
+        """Does a new template or asset build change fragment keys?"""
+
+        msg = Message(text="Cached hello", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        with app.app_context():
+            msg = Message.query.get(msg.id)
+            key = fragments.fragment_key(msg)
+
+            with patch('fragments._template_version', 'deployed'):
+                self.assertNotEqual(fragments.fragment_key(msg), key)
@@ -0,0 +1,81 @@
+"""Password hashing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, hasher, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import passwords
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test hashing in the pool, rehashing and back-pressure."""
+
+    def setUp(self):
+        """Start with no users."""
+
+        User.query.delete()
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        hasher.init_app(app)
+        db.session.rollback()
+
+    def test_pool_round_trip(self):
+        """Hashes made in the pool check out, and are timed"""
+
+        count = hasher.stats.count
+        hashed = hasher.hash_password("secret")
+
+        self.assertTrue(hasher.check_password(hashed, "secret"))
+        self.assertFalse(hasher.check_password(hashed, "wrong"))
+        self.assertEqual(hasher.stats.count, count + 3)
+
+    def test_rehash_on_login(self):
+        """Logging in replaces a hash made at a lower cost"""
+
+        user = User.signup("edward", "ed@test.com", "secret")
+        user.password = passwords.hash_with_cost("secret", 4)
+        db.session.commit()
+
+        resp = self.client.post("/login", data={"username": "edward",
+                                                "password": "secret"})
+        self.assertEqual(resp.status_code, 302)
+
+        hashed = User.query.filter_by(username="edward").one().password
+        self.assertEqual(passwords.cost_of(hashed), hasher.rounds)
+        self.assertTrue(passwords.matches("secret", hashed))
+
+    def test_saturated(self):
+        """A full pool turns signups away with a 503 and Retry-After"""
+
+        app.config['PASSWORD_HASH_QUEUE'] = 1
+        hasher.init_app(app)
+
+        pool, slots = hasher._get_pool()
+        slots.acquire()
+        try:
+            resp = self.client.post("/signup", data={"username": "edward",
+                                                     "password": "secret",
+                                                     "email": "ed@test.com"})
+        finally:
+            slots.release()
+            app.config['PASSWORD_HASH_QUEUE'] = 8
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        self.assertEqual(User.query.count(), 0)
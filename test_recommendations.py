@@ -0,0 +1,131 @@
+"""Who-to-follow tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Like, FollowersFollowee
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import recommendations
+
+db.create_all()
+
+
+class RecommendationsTestCase(TestCase):
+    """Test recomputing and reading suggestions."""
+
+    def setUp(self):
+        """Edward follows juan, who follows ann and bob; bob shares a like
+        with edward."""
+
+        try:
+            import numpy, scipy
+        except ImportError:
+            self.skipTest("recomputing needs numpy and scipy")
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.session.execute(recommendations.recommendations.delete())
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        names = ['edward', 'juan', 'ann', 'bob', 'cy']
+        people = [User(email=f"{name}@test.com",
+                       username=name,
+                       password="HASHED_PASSWORD")
+                  for name in names]
+        db.session.add_all(people)
+        db.session.commit()
+
+        edward, juan, ann, bob, cy = people
+        edward.following.append(juan)
+        juan.following.append(ann)
+        juan.following.append(bob)
+        cy.following.append(ann)
+
+        msg = Message(text="hello", user_id=cy.id)
+        db.session.add(msg)
+        db.session.flush()
+        edward.messages_liked.append(msg)
+        bob.messages_liked.append(msg)
+        db.session.commit()
+
+        self.ids = {name: user.id for name, user in zip(names, people)}
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+
+    def suggested(self, name):
+        """Return the usernames suggested for `name`."""
+
+        user = User.query.get(self.ids[name])
+        return [other.username for other in recommendations.for_user(user)]
+
+    def test_recompute(self):
+        """Friends of friends rank first, then shared likes"""
+
+        stored = recommendations.recompute()
+
+        # edward: bob (followed by juan, and a shared like), then ann
+        self.assertEqual(self.suggested('edward'), ['bob', 'ann'])
+        # juan's followees follow nobody, and juan liked nothing
+        self.assertEqual(self.suggested('juan'), [])
+        self.assertEqual(self.suggested('bob'), ['edward'])
+        self.assertEqual(stored, 3)
+
+        app.config['RECOMMEND_TOP_K'] = 1
+        app.config['RECOMMEND_BLOCK_SIZE'] = 2
+        try:
+            self.assertEqual(recommendations.recompute(), 2)
+        finally:
+            app.config['RECOMMEND_TOP_K'] = 20
+            app.config['RECOMMEND_BLOCK_SIZE'] = 2000
+
+        self.assertEqual(self.suggested('edward'), ['bob'])
+
+    def test_stale_suggestions_skipped(self):
+        """Users followed or deleted since the recompute aren't suggested"""
+
+        recommendations.recompute()
+
+        edward = User.query.get(self.ids['edward'])
+        edward.following.append(User.query.get(self.ids['bob']))
+        db.session.commit()
+        self.assertEqual(self.suggested('edward'), ['ann'])
+
+        User.query.get(self.ids['ann']).deleted_at = db.func.now()
+        db.session.commit()
+        self.assertEqual(self.suggested('edward'), [])
+
+    def test_routes(self):
+        """The page and the API list the logged-in user's suggestions"""
+
+        recommendations.recompute()
+        client = app.test_client()
+
+        with client as c:
+            self.assertEqual(c.get('/api/v1/suggestions').status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids['edward']
+
+            resp = c.get('/users/suggestions')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b'@bob', resp.data)
+            self.assertNotIn(b'@cy', resp.data)
+
+            resp = c.get('/api/v1/suggestions')
+            self.assertEqual([u['username'] for u in resp.json['users']],
+                             ['bob', 'ann'])
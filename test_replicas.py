@@ -0,0 +1,110 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from flask_sqlalchemy import get_state
+from sqlalchemy.engine.url import make_url
+
+from models import db, User, Message, Like, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import replicas
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicaTestCase(TestCase):
+    """Test routing read-only pages to a replica database file."""
+
+    def setUp(self):
+        """Create a shared user, plus one user only on each database."""
+
+        Like.query.delete()
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        shared = User(email="ed@test.com",
+                      username="edward",
+                      password="HASHED_PASSWORD")
+        primary_only = User(email="pat@test.com",
+                            username="primaryonly",
+                            password="HASHED_PASSWORD")
+        db.session.add_all([shared, primary_only])
+        db.session.commit()
+        self.user_id = shared.id
+
+        fd, self.replica_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        app.config['SQLALCHEMY_BINDS']['replica0'] = (
+            f'sqlite:///{self.replica_path}')
+
+        replica = db.get_engine(app, bind='replica0')
+        db.metadata.create_all(replica)
+        replica.execute(User.__table__.insert(), id=shared.id,
+                        email=shared.email, username=shared.username,
+                        password=shared.password)
+        replica.execute(User.__table__.insert(), email="rae@test.com",
+                        username="replicaonly", password="HASHED_PASSWORD")
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        get_state(app).connectors.pop('replica0').get_engine().dispose()
+        del app.config['SQLALCHEMY_BINDS']['replica0']
+        os.remove(self.replica_path)
+
+    def test_read_only_pages_use_replica(self):
+        """Read-only pages read the replica, others the primary"""
+
+        resp = self.client.get('/users')
+        self.assertIn(b'@replicaonly', resp.data)
+        self.assertNotIn(b'@primaryonly', resp.data)
+
+        resp = self.client.get('/signup')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_writes_stick_to_primary(self):
+        """A browser that just posted reads the primary for a while"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        resp = self.client.post('/messages/new', data={"text": "fresh"})
+        self.assertEqual(resp.status_code, 302)
+
+        resp = self.client.get(f'/users/{self.user_id}')
+        self.assertIn(b'fresh', resp.data)
+
+        with self.client.session_transaction() as sess:
+            self.assertIn(replicas.STICKY_KEY, sess)
+            sess[replicas.STICKY_KEY] = 0
+
+        resp = self.client.get(f'/users/{self.user_id}')
+        self.assertNotIn(b'fresh', resp.data)
+
+    def test_pool_options(self):
+        """Pool settings apply to server databases but not SQLite"""
+
+        url, options = db.apply_driver_hacks(
+            app, make_url('postgresql://localhost/warbler'), {})
+        self.assertEqual(options['pool_size'], app.config['DB_POOL_SIZE'])
+        self.assertTrue(options['pool_pre_ping'])
+
+        url, options = db.apply_driver_hacks(
+            app, make_url(f'sqlite:///{self.replica_path}'), {})
+        self.assertNotIn('pool_size', options)
@@ -0,0 +1,128 @@
+"""Search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+
+import os
+import re
+from unittest import TestCase
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import fragments
+import likes
+import migrations
+import pagination
+import search
+
+db.create_all()
+migrations.upgrade()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class SearchTestCase(TestCase):
+    """Test /search over messages and usernames."""
+
+    def setUp(self):
+        """Create two users with a few messages."""
+
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        search.reset_index()
+
+        # ids can be reused, so nothing cached about old rows may survive
+        likes.get_cache().clear()
+        fragments.get_cache().clear()
+
+        self.edward = User(email="ed@test.com",
+                           username="edward",
+                           password="HASHED_PASSWORD")
+        self.edna = User(email="edna@test.com",
+                         username="edna",
+                         password="HASHED_PASSWORD")
+        db.session.add_all([self.edward, self.edna])
+        db.session.commit()
+
+        self.edward_id = self.edward.id
+
+        db.session.add_all([
+            Message(text="Rainy day in Oakland", user_id=self.edward_id),
+            Message(text="Oakland rain again, rain all week",
+                    user_id=self.edna.id),
+            Message(text="Sunny in Berkeley", user_id=self.edna.id),
+        ])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        pagination.PAGE_SIZE = 100
+        db.session.rollback()
+
+    def test_messages_match_every_term(self):
+        """Only messages with all the terms match"""
+
+        resp = self.client.get('/search?q=oakland')
+        self.assertIn(b'Rainy day in Oakland', resp.data)
+        self.assertIn(b'Oakland rain again', resp.data)
+        self.assertNotIn(b'Sunny in Berkeley', resp.data)
+
+        resp = self.client.get('/search?q=oakland+again')
+        self.assertNotIn(b'Rainy day in Oakland', resp.data)
+        self.assertIn(b'Oakland rain again', resp.data)
+
+    def test_username_prefix(self):
+        """Usernames starting with the query are listed"""
+
+        resp = self.client.get('/search?q=edn')
+        self.assertIn(b'@edna</a>', resp.data)
+        self.assertNotIn(b'@edward</a>', resp.data)
+
+        resp = self.client.get('/search?q=ed')
+        self.assertIn(b'@edna</a>', resp.data)
+        self.assertIn(b'@edward</a>', resp.data)
+
+    def test_pagination(self):
+        """A cursor pages through the rest of the ranked results"""
+
+        pagination.PAGE_SIZE = 1
+
+        seen = []
+        url = '/search?q=oakland'
+        while url:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            seen += re.findall(rb'<p>([^<]*Oakland[^<]*)</p>', resp.data)
+            match = re.search(rb'href="([^"]*before=[^"]*)"', resp.data)
+            url = match and match.group(1).decode().replace('&amp;', '&')
+
+        self.assertEqual(sorted(seen), [b'Oakland rain again, rain all week',
+                                        b'Rainy day in Oakland'])
+        self.assertEqual(self.client.get('/search?q=x&before=NaN_1')
+                         .status_code, 400)
+
+    def test_index_follows_adds_and_deletes(self):
+        """Messages added and deleted through the app are found and dropped"""
+
+        self.assertNotIn(b'Hail in Oakland',
+                         self.client.get('/search?q=hail').data)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.edward_id
+
+            c.post('/messages/new', data={"text": "Hail in Oakland"})
+            self.assertIn(b'Hail in Oakland',
+                          c.get('/search?q=hail').data)
+
+            msg = Message.query.filter_by(text="Hail in Oakland").one()
+            c.post(f'/messages/{msg.id}/delete')
+            self.assertNotIn(b'Hail in Oakland',
+                             c.get('/search?q=hail').data)
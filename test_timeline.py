@@ -0,0 +1,199 @@
+"""Timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import jobs
+import timeline
+
+db.create_all()
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out, backfill and pruning of materialized timelines."""
+
+    def setUp(self):
+        """Create two users with no follows."""
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        User.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        TimelineEntry.query.delete()
+        db.session.execute(timeline.pulled_authors.delete())
+
+        self.edward = User(email="ed@test.com",
+                           username="edward",
+                           password="HASHED_PASSWORD")
+        self.juan = User(email="juanton@test.com",
+                         username="juan",
+                         password="HASHED_PASSWORD")
+
+        db.session.add_all([self.edward, self.juan])
+        db.session.commit()
+
+    def tearDown(self):
+        """Roll back anything a failed test left behind."""
+
+        db.session.rollback()
+        self.ctx.pop()
+
+    def post(self, user, text):
+        """Post and fan out a message the way the messages_add route does."""
+
+        msg = Message(text=text, user_id=user.id)
+        db.session.add(msg)
+        db.session.flush()
+        timeline.fan_out(msg)
+        db.session.commit()
+        return msg
+
+    def test_fan_out(self):
+        """New messages land in the author's and followers' timelines"""
+
+        self.edward.following.append(self.juan)
+        db.session.commit()
+
+        msg = self.post(self.juan, "hello")
+
+        self.assertEqual(timeline.get_timeline(self.edward.id), [msg])
+        self.assertEqual(timeline.get_timeline(self.juan.id), [msg])
+
+    def test_self_follow(self):
+        """A user following themselves doesn't get their messages twice"""
+
+        # left over from before add_follow refused self-follows
+        db.session.execute(FollowersFollowee.__table__.insert().values(
+            followee_id=self.juan.id, follower_id=self.juan.id))
+        db.session.commit()
+
+        msg = self.post(self.juan, "hello")
+        self.assertEqual(timeline.get_timeline(self.juan.id), [msg])
+
+        timeline.rebuild_all()
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.count(), 1)
+
+    def test_backfill_and_prune(self):
+        """Following backfills old messages and unfollowing removes them"""
+
+        msg = self.post(self.juan, "hello")
+        self.assertEqual(timeline.get_timeline(self.edward.id), [])
+
+        self.edward.following.append(self.juan)
+        timeline.backfill(self.edward.id, self.juan.id)
+        db.session.commit()
+
+        self.assertEqual(timeline.get_timeline(self.edward.id), [msg])
+
+        self.edward.following.remove(self.juan)
+        timeline.prune(self.edward.id, self.juan.id)
+        db.session.commit()
+
+        self.assertEqual(timeline.get_timeline(self.edward.id), [])
+        self.assertEqual(timeline.get_timeline(self.juan.id), [msg])
+
+    def test_pulled_author(self):
+        """Messages by high-follower authors are merged in at read time"""
+
+        app.config['TIMELINE_PULL_THRESHOLD'] = 1
+
+        try:
+            self.edward.following.append(self.juan)
+            timeline.backfill(self.edward.id, self.juan.id)
+            db.session.commit()
+
+            old_msg = self.post(self.juan, "before")
+            own_msg = self.post(self.edward, "mine")
+            new_msg = self.post(self.juan, "after")
+
+            # juan has a follower, so nothing was pushed to edward for him
+            pushed = (TimelineEntry
+                      .query
+                      .filter_by(user_id=self.edward.id)
+                      .all())
+            self.assertEqual([e.message_id for e in pushed], [own_msg.id])
+
+            self.assertEqual(timeline.get_timeline(self.edward.id),
+                             [new_msg, own_msg, old_msg])
+            self.assertEqual(timeline.get_timeline(self.edward.id, limit=2),
+                             [new_msg, own_msg])
+
+            # rebuilding doesn't push them either
+            timeline.rebuild_all()
+            db.session.commit()
+            pushed = (TimelineEntry
+                      .query
+                      .filter_by(user_id=self.edward.id)
+                      .all())
+            self.assertEqual([e.message_id for e in pushed], [own_msg.id])
+            self.assertEqual(timeline.get_timeline(self.edward.id),
+                             [new_msg, own_msg, old_msg])
+
+        finally:
+            app.config['TIMELINE_PULL_THRESHOLD'] = 10000
+
+    def test_author_drops_under_threshold(self):
+        """Messages posted while pulled are pushed once an author isn't"""
+
+        ann = User(email="ann@test.com",
+                   username="ann",
+                   password="HASHED_PASSWORD")
+        db.session.add(ann)
+        self.edward.following.append(self.juan)
+        ann.following.append(self.juan)
+        db.session.commit()
+
+        app.config['TIMELINE_PULL_THRESHOLD'] = 2
+
+        try:
+            msg = self.post(self.juan, "while pulled")
+            self.assertEqual(
+                TimelineEntry.query.filter_by(message_id=msg.id).count(), 1)
+
+            # ann unfollows the way stop_following does, so juan has one
+            # follower left and is pushed to again
+            ann.following.remove(self.juan)
+            jobs.enqueue('prune', user_id=ann.id, followee_id=self.juan.id)
+            db.session.commit()
+
+            self.assertEqual(timeline.pulled_followee_ids(self.edward.id), [])
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=self.edward.id).count(),
+                1)
+            self.assertEqual(timeline.get_timeline(self.edward.id), [msg])
+
+        finally:
+            app.config['TIMELINE_PULL_THRESHOLD'] = 10000
+
+    def test_pulled_until_repushed(self):
+        """An author back under the threshold is pulled until repushed"""
+
+        self.edward.following.append(self.juan)
+        db.session.commit()
+
+        app.config['TIMELINE_PULL_THRESHOLD'] = 1
+        msg = self.post(self.juan, "while pulled")
+        app.config['TIMELINE_PULL_THRESHOLD'] = 10000
+
+        self.assertEqual(timeline.pulled_followee_ids(self.edward.id),
+                         [self.juan.id])
+        self.assertEqual(timeline.get_timeline(self.edward.id), [msg])
+
+        timeline.repush(self.juan.id)
+        db.session.commit()
+
+        self.assertEqual(timeline.pulled_followee_ids(self.edward.id), [])
+        self.assertEqual(timeline.get_timeline(self.edward.id), [msg])
@@ -8,12 +8,18 @@ from models import db, connect_db, User, Message, FollowersFollowee
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 from app import app, CURR_USER_KEY
+from instrumentation import QueryCountAssertions
+import fragments
+import jobs
+import likes
+import pagination
+import user_cache
 
 db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
-class UserViewTestCase(TestCase):
+class UserViewTestCase(QueryCountAssertions, TestCase):
     """Test User routes."""
 
     def setUp(self):
@@ -25,6 +31,11 @@ class UserViewTestCase(TestCase):
 
         db.session.commit()
 
+        # ids can be reused, so nothing cached about old rows may survive
+        likes.get_cache().clear()
+        fragments.get_cache().clear()
+        user_cache.get_cache().clear()
+
         self.client = app.test_client()
 
     def test_list_users(self):
@@ -60,6 +71,41 @@ class UserViewTestCase(TestCase):
             self.assertIn(b'@edward', resp.data)
             self.assertNotIn(b'@juan', resp.data)
 
+    def test_list_users_pagination(self):
+        """Test that /users pages back through users with a cursor"""
+
+        users = [User(email=f"user{i}@test.com",
+                      username=f"user{i}",
+                      password="HASHED_PASSWORD")
+                 for i in range(3)]
+
+        db.session.add_all(users)
+        db.session.commit()
+
+        pagination.PAGE_SIZE = 2
+
+        try:
+            with self.client as c:
+                resp = c.get('/users')
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn(b'@user2', resp.data)
+                self.assertIn(b'@user1', resp.data)
+                self.assertNotIn(b'@user0', resp.data)
+                self.assertIn(f'before={users[1].id}'.encode(), resp.data)
+
+                resp = c.get(f'/users?before={users[1].id}')
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn(b'@user0', resp.data)
+                self.assertNotIn(b'@user1', resp.data)
+                self.assertNotIn(b'before=', resp.data)
+
+                resp = c.get('/users?before=nope')
+                self.assertEqual(resp.status_code, 400)
+
+        finally:
+            pagination.PAGE_SIZE = 100
 
     def test_users_show(self):
         """Test that /user/user_id shows that users profile"""
@@ -366,16 +412,165 @@ class UserViewTestCase(TestCase):
             # Assert that Edwars is IN Juan's followers
             self.assertIn(edward, juan.followers)
 
+            # Following Juan again changes nothing
+            resp = c.post(f'/users/follow/{user_ids["juan"]}')
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(
+                FollowersFollowee.query
+                .filter_by(followee_id=user_ids['edward'],
+                           follower_id=user_ids['juan'])
+                .count(), 1)
+
+            # Edward can't follow himself
+            resp = c.post(f'/users/follow/{user_ids["edward"]}')
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(
+                FollowersFollowee.query
+                .filter_by(followee_id=user_ids['edward'],
+                           follower_id=user_ids['edward'])
+                .count(), 0)
+
+
+
+    def test_listing_query_counts(self):
+        """Test that listing pages don't run a query per user shown"""
+
+        edward = User(
+            email="ed@test.com",
+            username="edward",
+            password="HASHED_PASSWORD"
+        )
+
+        others = [User(email=f"user{i}@test.com",
+                       username=f"user{i}",
+                       password="HASHED_PASSWORD")
+                  for i in range(20)]
+
+        db.session.add(edward)
+        db.session.add_all(others)
+        db.session.commit()
+
+        for other in others:
+            other.following.append(edward)
+            edward.following.append(other)
+            db.session.add(Message(text=f"hi from {other.username}",
+                                   user_id=other.id))
+
+        db.session.commit()
+
+        edward_id = edward.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = edward_id
 
+            for url in ['/users',
+                        f'/users/{edward_id}/followers',
+                        f'/users/{edward_id}/following']:
+                with self.assertMaxQueries(6):
+                    resp = c.get(url)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('Server-Timing', resp.headers)
 
     def test_stop_following(self):
-        pass
+        """Test the /users/stop-following/user_id page"""
+
+        edward = User.signup("edward", "ed@test.com", "password", None)
+        juan = User(email="juanton@test.com",
+                    username="juan",
+                    password="HASHED_PASSWORD")
+        db.session.add(juan)
+        db.session.commit()
+        edward.following.append(juan)
+        db.session.commit()
+
+        edward_id, juan_id = edward.id, juan.id
+
+        app.config['JOBS_EAGER'] = False
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = edward_id
+
+                # the second is a double click, and changes nothing
+                for _ in range(2):
+                    resp = c.post(f'/users/stop-following/{juan_id}')
+                    self.assertEqual(resp.status_code, 302)
+
+                self.assertEqual(FollowersFollowee.query.count(), 0)
+                self.assertEqual(db.session.query(jobs.jobs).count(), 1)
+
+                resp = c.post('/users/stop-following/12345678')
+                self.assertEqual(resp.status_code, 404)
+
+        finally:
+            app.config['JOBS_EAGER'] = True
+            db.session.execute(jobs.jobs.delete())
+            db.session.commit()
 
     def test_profile(self):
         pass
 
     def test_delete_user(self):
-        pass
+        """Deleting an account hides it at once, then a worker removes it"""
+
+        edward = User.signup("edward", "ed@test.com", "password", None)
+        juan = User(email="juanton@test.com",
+                    username="juan",
+                    password="HASHED_PASSWORD")
+        db.session.add(juan)
+        db.session.commit()
+        edward.following.append(juan)
+        juan.following.append(edward)
+        msg = Message(text="edward's", user_id=edward.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        edward_id, juan_id, msg_id = edward.id, juan.id, msg.id
+
+        app.config['JOBS_EAGER'] = False
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = edward_id
+
+                resp = c.post('/users/delete')
+                self.assertEqual(resp.status_code, 302)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = juan_id
+
+                self.assertEqual(c.get(f'/users/{edward_id}').status_code,
+                                 404)
+                self.assertEqual(c.get(f'/messages/{msg_id}').status_code,
+                                 404)
+                self.assertNotIn(b'@edward', c.get('/users').data)
+                self.assertNotIn(b'@edward',
+                                 c.get(f'/users/{juan_id}/followers').data)
+                self.assertNotIn(b"edward's", c.get('/').data)
+                self.assertFalse(User.authenticate("edward", "password"))
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = edward_id
+
+                resp = c.get('/')
+                self.assertNotIn(b"edward's", resp.data)
+                with c.session_transaction() as sess:
+                    self.assertNotIn(CURR_USER_KEY, sess)
+
+            with app.app_context():
+                while jobs.work_once():
+                    pass
+
+                self.assertIsNone(User.query.get(edward_id))
+                self.assertIsNone(Message.query.get(msg_id))
+                self.assertEqual(User.query.get(juan_id).follower_count, 0)
+                db.session.execute(jobs.jobs.delete())
+                db.session.commit()
+
+        finally:
+            app.config['JOBS_EAGER'] = True
 
     # def test_signup(self):
     #     pass
@@ -0,0 +1,349 @@
+"""Home timelines for Warbler.
+
+Messages from most authors are pushed into the `timelines` table when they
+are posted (fan-out-on-write). Authors with at least TIMELINE_PULL_THRESHOLD
+followers are skipped at write time; their messages are pulled when a
+follower reads their timeline and merged with the pushed entries.
+
+Authors skipped that way are recorded in `pulled_authors`. If one drops
+back below the threshold (unfollows, or a follower's account deleted),
+what they posted meanwhile was never pushed, so a 'repush' job pushes
+their messages to every follower. Until it has run they're still pulled
+at read time, so nothing goes missing in between.
+
+Routes queue fan-out, backfill and prune as jobs (see jobs.py), so with a
+worker they happen after the response; the jobs re-check the follow so
+a quick follow/unfollow can't leave the timeline in the wrong state.
+"""
+
+import heapq
+from itertools import islice
+
+from sqlalchemy import and_, exists, literal, or_, select
+from sqlalchemy.dialects import postgresql
+
+from models import db, FollowersFollowee, Message, TimelineEntry, User
+import jobs
+import pagination
+import queries
+
+TIMELINE_COLUMNS = ['user_id', 'message_id', 'timestamp']
+
+DEFAULT_PULL_THRESHOLD = 10000
+
+pulled_authors = db.Table(
+    'pulled_authors',
+    db.Column('user_id', db.Integer, primary_key=True),
+)
+
+
+def pull_threshold():
+    """Return the follower count at which an author's messages are pulled."""
+
+    return db.get_app().config.get('TIMELINE_PULL_THRESHOLD',
+                                   DEFAULT_PULL_THRESHOLD)
+
+
+def is_pulled(user_id):
+    """Is `user_id` followed by too many users to fan out to?"""
+
+    num_followers = (db.session
+                     .query(User.follower_count)
+                     .filter(User.id == user_id)
+                     .scalar())
+
+    return (num_followers or 0) >= pull_threshold()
+
+
+def pulled_followee_ids(user_id):
+    """Return ids of users `user_id` follows whose messages are pulled.
+
+    That includes authors back under the threshold whose repush hasn't run.
+    """
+
+    was_pulled = User.id.in_(select([pulled_authors.c.user_id]))
+
+    # followee_id is the user doing the following (see FollowersFollowee)
+    rows = (db.session
+            .query(User.id)
+            .join(FollowersFollowee, FollowersFollowee.follower_id == User.id)
+            .filter(FollowersFollowee.followee_id == user_id)
+            .filter(or_(User.follower_count >= pull_threshold(), was_pulled))
+            .all())
+
+    return [author_id for (author_id,) in rows]
+
+
+def mark_pulled(user_id):
+    """Record that `user_id`'s messages were left to be pulled."""
+
+    table = pulled_authors
+
+    if db.session.bind.dialect.name == 'postgresql':
+        stmt = (postgresql.insert(table)
+                .values(user_id=user_id)
+                .on_conflict_do_nothing())
+    else:
+        stmt = table.insert().prefix_with('OR IGNORE').values(user_id=user_id)
+
+    db.session.execute(stmt)
+
+
+def check_unpulled(user_ids):
+    """Queue a repush for any of `user_ids` now back under the threshold."""
+
+    rows = (db.session
+            .query(User.id)
+            .join(pulled_authors, pulled_authors.c.user_id == User.id)
+            .filter(User.id.in_(user_ids))
+            .filter(User.follower_count < pull_threshold()))
+
+    for (author_id,) in rows.all():
+        jobs.enqueue('repush', key=f'repush:{author_id}', author_id=author_id)
+
+
+def is_following(user_id, followee_id):
+    """Does `user_id` currently follow `followee_id`?"""
+
+    # followee_id is the user doing the following (see FollowersFollowee)
+    return db.session.query(exists().where(and_(
+        FollowersFollowee.followee_id == user_id,
+        FollowersFollowee.follower_id == followee_id))).scalar()
+
+
+def insert_entries(query):
+    """INSERT ... SELECT `query`'s (user_id, message_id, timestamp) rows.
+
+    Callers filter out entries already there; on PostgreSQL, one inserted
+    by a concurrent transaction in the meantime is skipped too.
+    """
+
+    rows = query.subquery().select()
+    table = TimelineEntry.__table__
+
+    if db.session.bind.dialect.name == 'postgresql':
+        stmt = (postgresql.insert(table)
+                .from_select(TIMELINE_COLUMNS, rows)
+                .on_conflict_do_nothing())
+    else:
+        stmt = table.insert().from_select(TIMELINE_COLUMNS, rows)
+
+    db.session.execute(stmt)
+
+
+def fan_out(message):
+    """Push a new message into its author's and followers' timelines.
+
+    The message must already be flushed so it has an id and timestamp.
+    Messages by pulled authors only go into the author's own timeline.
+    """
+
+    db.session.add(TimelineEntry(user_id=message.user_id,
+                                 message_id=message.id,
+                                 timestamp=message.timestamp))
+
+    if is_pulled(message.user_id):
+        mark_pulled(message.user_id)
+        return
+
+    # a follower's backfill may have got there first
+    already_there = exists().where(and_(
+        TimelineEntry.user_id == FollowersFollowee.followee_id,
+        TimelineEntry.message_id == message.id))
+
+    # followee_id is the user doing the following (see FollowersFollowee)
+    followers = (db.session
+                 .query(FollowersFollowee.followee_id,
+                        literal(message.id),
+                        literal(message.timestamp))
+                 .filter(FollowersFollowee.follower_id == message.user_id)
+                 .filter(FollowersFollowee.followee_id != message.user_id)
+                 .filter(~already_there))
+
+    insert_entries(followers)
+
+
+def backfill(user_id, followee_id):
+    """Copy `followee_id`'s messages into `user_id`'s timeline.
+
+    Pulled authors are skipped; their messages are merged in at read time.
+    """
+
+    if is_pulled(followee_id):
+        mark_pulled(followee_id)
+        return
+
+    already_there = exists().where(and_(
+        TimelineEntry.user_id == user_id,
+        TimelineEntry.message_id == Message.id))
+
+    messages = (db.session
+                .query(literal(user_id), Message.id, Message.timestamp)
+                .filter(Message.user_id == followee_id)
+                .filter(~already_there))
+
+    insert_entries(messages)
+
+
+def repush(author_id):
+    """Push every message by `author_id` into all their followers'
+    timelines, and stop pulling them.
+
+    Does nothing if they're over the threshold again.
+    """
+
+    if is_pulled(author_id):
+        return
+
+    already_there = exists().where(and_(
+        TimelineEntry.user_id == FollowersFollowee.followee_id,
+        TimelineEntry.message_id == Message.id))
+
+    # followee_id is the user doing the following (see FollowersFollowee)
+    entries = (db.session
+               .query(FollowersFollowee.followee_id,
+                      Message.id,
+                      Message.timestamp)
+               .join(Message,
+                     Message.user_id == FollowersFollowee.follower_id)
+               .filter(FollowersFollowee.follower_id == author_id)
+               .filter(FollowersFollowee.followee_id != author_id)
+               .filter(~already_there))
+
+    insert_entries(entries)
+    db.session.execute(pulled_authors.delete()
+                       .where(pulled_authors.c.user_id == author_id))
+
+
+def prune(user_id, followee_id):
+    """Remove `followee_id`'s messages from `user_id`'s timeline."""
+
+    followee_messages = (db.session
+                         .query(Message.id)
+                         .filter(Message.user_id == followee_id))
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == user_id,
+             TimelineEntry.message_id.in_(followee_messages.subquery()))
+     .delete(synchronize_session=False))
+
+
+@jobs.handler('fan_out')
+def fan_out_job(message_id):
+    """Fan out a posted message, unless it was deleted first."""
+
+    message = Message.query.get(message_id)
+    if message is not None:
+        fan_out(message)
+
+
+@jobs.handler('backfill')
+def backfill_job(user_id, followee_id):
+    """Backfill a new followee's messages, if the follow still stands."""
+
+    if is_following(user_id, followee_id):
+        backfill(user_id, followee_id)
+
+
+@jobs.handler('prune')
+def prune_job(user_id, followee_id):
+    """Prune an unfollowed user's messages, unless followed again since."""
+
+    if not is_following(user_id, followee_id):
+        prune(user_id, followee_id)
+
+    check_unpulled([followee_id])
+
+
+@jobs.handler('repush')
+def repush_job(author_id):
+    """Push a formerly pulled author's messages to their followers."""
+
+    repush(author_id)
+
+
+def rebuild_all():
+    """Rebuild every timeline from the messages and follows tables.
+
+    Used after bulk loads (e.g. seed.py) that bypass fan-out. As with
+    fan-out, pulled authors' messages only go into their own timelines.
+    """
+
+    TimelineEntry.query.delete()
+    db.session.execute(pulled_authors.delete())
+
+    db.session.execute(pulled_authors.insert().from_select(
+        ['user_id'],
+        select([User.id]).where(User.follower_count >= pull_threshold())))
+
+    own = db.session.query(Message.user_id, Message.id, Message.timestamp)
+
+    followed = (db.session
+                .query(FollowersFollowee.followee_id,
+                       Message.id,
+                       Message.timestamp)
+                .join(Message,
+                      Message.user_id == FollowersFollowee.follower_id)
+                .join(User, User.id == FollowersFollowee.follower_id)
+                .filter(FollowersFollowee.followee_id
+                        != FollowersFollowee.follower_id)
+                .filter(User.follower_count < pull_threshold()))
+
+    insert_entries(own.union_all(followed))
+
+
+def get_timeline(user_id, limit=100, before=None):
+    """Return the most recent `limit` messages in a user's timeline.
+
+    `before` is an optional (timestamp, id) cursor to page back from.
+
+    Pushed entries and the latest messages of each pulled followee are
+    k-way merged by timestamp. A message can appear in both streams if its
+    author crossed the threshold after it was pushed, so ids are deduped.
+    """
+
+    pushed = (queries
+              .with_authors(Message.query)
+              .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+              .filter(TimelineEntry.user_id == user_id))
+
+    pushed = (pagination
+              .before(pushed,
+                      (TimelineEntry.timestamp, TimelineEntry.message_id),
+                      before)
+              .order_by(TimelineEntry.timestamp.desc(),
+                        TimelineEntry.message_id.desc())
+              .limit(limit)
+              .all())
+
+    streams = [pushed]
+
+    for author_id in pulled_followee_ids(user_id):
+        pulled = queries.with_authors(queries.user_messages(author_id))
+
+        streams.append(pagination
+                       .before(pulled, (Message.timestamp, Message.id), before)
+                       .order_by(Message.timestamp.desc(), Message.id.desc())
+                       .limit(limit)
+                       .all())
+
+    if len(streams) == 1:
+        return pushed
+
+    merged = heapq.merge(*streams,
+                         key=lambda msg: (msg.timestamp, msg.id),
+                         reverse=True)
+
+    return list(islice(_unique(merged), limit))
+
+
+def _unique(messages):
+    """Yield messages, skipping ids that have already been seen."""
+
+    seen = set()
+
+    for msg in messages:
+        if msg.id not in seen:
+            seen.add(msg.id)
+            yield msg
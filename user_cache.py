@@ -0,0 +1,120 @@
+"""Cache of logged-in users, so a request doesn't start with a query.
+
+`load_user()` keeps a snapshot of each user's columns keyed by id. On a
+hit the snapshot is attached to the session as a persistent User without
+touching the database; relationships stay lazy and only load if the route
+uses them. The password hash is left out of snapshots and loads on demand.
+Timestamps are stored as ISO strings, so snapshots can be JSON-encoded for
+the Redis backend.
+
+Snapshots are invalidated after any commit that changes a user, whether
+through the ORM or through counters.py, and explicitly by the routes that
+edit or delete an account.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+
+from cache import make_cache
+from models import db, User
+
+CHANGED_KEY = 'changed_user_ids'
+
+UNCACHED_COLUMNS = {'password'}
+
+_cache = None
+
+
+def get_cache():
+    """Return this process's user snapshot cache, creating it if needed."""
+
+    global _cache
+
+    if _cache is None:
+        config = db.get_app().config
+        _cache = make_cache(config, 'user',
+                            ttl=config.get('USER_CACHE_TTL', 300),
+                            max_size=config.get('USER_CACHE_SIZE', 10000))
+
+    return _cache
+
+
+def snapshot(user):
+    """Return a cacheable dict of `user`'s column values."""
+
+    values = {}
+
+    for attr in User.__mapper__.column_attrs:
+        if attr.key in UNCACHED_COLUMNS:
+            continue
+
+        value = getattr(user, attr.key)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        values[attr.key] = value
+
+    return values
+
+
+def restore(values):
+    """Return a User built from a `snapshot()` dict."""
+
+    values = dict(values)
+
+    for attr in User.__mapper__.column_attrs:
+        value = values.get(attr.key)
+        if (isinstance(value, str)
+                and isinstance(attr.columns[0].type, db.DateTime)):
+            values[attr.key] = datetime.fromisoformat(value)
+
+    return User(**values)
+
+
+def load_user(user_id):
+    """Return the User with `user_id`, from the cache when possible."""
+
+    cached = get_cache().get(user_id)
+
+    if cached is None:
+        user = User.query.get(user_id)
+
+        if user is not None:
+            get_cache().set(user_id, snapshot(user))
+
+        return user
+
+    user = restore(cached)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def invalidate(user_id):
+    """Drop the cached snapshot for `user_id`."""
+
+    get_cache().delete(user_id)
+
+
+def mark_changed(session, user_id):
+    """Invalidate `user_id`'s snapshot once `session` commits."""
+
+    session.info.setdefault(CHANGED_KEY, set()).add(user_id)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _after_flush(session, flush_context):
+    for obj in session.dirty | session.deleted:
+        if isinstance(obj, User) and obj.id is not None:
+            mark_changed(session, obj.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _after_commit(session):
+    for user_id in session.info.pop(CHANGED_KEY, ()):
+        invalidate(user_id)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _after_soft_rollback(session, previous_transaction):
+    session.info.pop(CHANGED_KEY, None)